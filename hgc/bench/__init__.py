@@ -0,0 +1,6 @@
+# coding: utf-8
+
+"""
+Microbenchmarks of hgcalsim internals that run without CMSSW. Each module can be executed
+directly, e.g. ``python -m hgc.bench.cms_log``.
+"""
@@ -0,0 +1,148 @@
+# coding: utf-8
+
+"""
+Benchmark of the HTCondor job start latency, i.e., the time to run the rendered
+htcondor_bootstrap.sh, with the full setup and with environment snapshots. setup.sh is executed in
+a sandbox (see :py:func:`hgc.bench.chain.create_sandbox`) in which scramv1 is replaced by a
+stand-in that takes HGC_BENCH_SCRAM_TIME seconds to evaluate the CMSSW runtime environment. It is
+checked that restored environments are identical to the one of the full setup, and that the
+snapshot is rewritten when the CMSSW area changes.
+"""
+
+
+import os
+import sys
+import time
+import shutil
+import getpass
+import argparse
+import tempfile
+import subprocess
+
+import hgc
+from hgc.bench.chain import create_sandbox
+
+
+# variables that differ between shells regardless of the setup, or between the modes
+volatile_variables = {"PWD", "OLDPWD", "SHLVL", "_", "HGC_ENV_SNAPSHOT"}
+
+
+def prepare_sandbox(base, scram_time):
+    """
+    Creates a sandbox in *base* with setup.sh, an existing CMSSW area and software directory, and
+    returns the environment of a job.
+    """
+    repo_base = os.path.dirname(os.path.dirname(os.path.abspath(hgc.__file__)))
+    env = create_sandbox(base)
+    shutil.copy2(os.path.join(repo_base, "setup.sh"), os.path.join(base, "setup.sh"))
+
+    user = getpass.getuser()
+    cmssw_base = os.path.join(base, "cmssw", user, "CMSSW_11_0_0_pre5")
+    for path in [
+        os.path.join(cmssw_base, "src"),
+        os.path.join(cmssw_base, ".SCRAM", "slc7_amd64_gcc700"),
+        os.path.join(env["HGC_DATA"], "software", user, "lib", "python2.7", "site-packages"),
+        os.path.join(base, "job"),
+    ]:
+        os.makedirs(path)
+
+    # jobs start with the environment of the submitting machine, which did not run the setup
+    for name in ["HGC_SETUP", "HGC_SOFTWARE", "HGC_LOCAL_CACHE"]:
+        env.pop(name, None)
+    env.update({
+        "HGC_GRID_USER": user,
+        "LAW_JOB_HOME": os.path.join(base, "job"),
+        "HGC_BENCH_SCRAM_TIME": str(scram_time),
+    })
+
+    # the index is created by the setup on the submitting machine
+    subprocess.check_call(["law", "index"], env=env, stdout=open(os.devnull, "w"))
+
+    return env, cmssw_base
+
+
+def render_bootstrap(base, snapshot):
+    repo_base = os.path.dirname(os.path.dirname(os.path.abspath(hgc.__file__)))
+    with open(os.path.join(repo_base, "hgc", "files", "htcondor_bootstrap.sh"), "r") as f:
+        content = f.read()
+    for key, value in [("hgc_base", base),
+            ("hgc_env_snapshot", "1" if snapshot else "0")]:
+        content = content.replace("{{" + key + "}}", value)
+
+    path = os.path.join(base, "bootstrap_{}.sh".format(int(snapshot)))
+    with open(path, "w") as f:
+        f.write(content)
+    return path
+
+
+def run_bootstrap(path, env):
+    """
+    Sources the bootstrap file at *path* in a new bash and returns the time and the resulting
+    environment.
+    """
+    env_file = path + ".env"
+    cmd = "source \"{}\" > /dev/null && env -0 > \"{}\"".format(path, env_file)
+    t0 = time.time()
+    subprocess.check_call(["bash", "-c", cmd], env=env, stderr=open(os.devnull, "w"))
+    dt = time.time() - t0
+
+    with open(env_file, "rb") as f:
+        entries = f.read().decode("utf-8").split("\0")
+    job_env = dict(entry.split("=", 1) for entry in entries if "=" in entry)
+
+    # exported functions are not part of snapshots
+    job_env = {
+        name: value for name, value in job_env.items()
+        if name not in volatile_variables and not name.startswith("BASH_FUNC_")
+    }
+
+    return dt, job_env
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--jobs", "-n", type=int, default=5, help="number of job starts per "
+        "mode, default: 5")
+    parser.add_argument("--scram-time", type=float, default=1.0, help="seconds to evaluate the "
+        "CMSSW runtime environment, default: 1.0")
+    args = parser.parse_args(argv)
+
+    base = tempfile.mkdtemp(prefix="hgc_bench_bootstrap_")
+    try:
+        env, cmssw_base = prepare_sandbox(base, args.scram_time)
+        full_bootstrap = render_bootstrap(base, False)
+        snapshot_bootstrap = render_bootstrap(base, True)
+        snapshot_dir = os.path.join(env["HGC_DATA"], "env_snapshots")
+
+        full = [run_bootstrap(full_bootstrap, env) for _ in range(args.jobs)]
+        first = run_bootstrap(snapshot_bootstrap, env)
+        restored = [run_bootstrap(snapshot_bootstrap, env) for _ in range(args.jobs)]
+
+        # changes of the CMSSW area invalidate the snapshot
+        mtime = os.stat(cmssw_base).st_mtime
+        os.utime(cmssw_base, (mtime - 100, mtime - 100))
+        invalidated = run_bootstrap(snapshot_bootstrap, env)
+
+        for name, results in [("full setup", full), ("writing snapshot", [first]),
+                ("restored snapshot", restored), ("after invalidation", [invalidated])]:
+            times = [dt for dt, _ in results]
+            print("{:>18s}: mean {:.3f} s, min {:.3f} s".format(name, sum(times) / len(times),
+                min(times)))
+
+        snapshots = os.listdir(snapshot_dir) if os.path.exists(snapshot_dir) else []
+        rewritten = False
+        if snapshots:
+            with open(os.path.join(snapshot_dir, snapshots[0]), "r") as f:
+                rewritten = "# check {} {}\n".format(int(mtime - 100), cmssw_base) in f.read()
+        identical = all(job_env == full[0][1] for _, job_env in [first, invalidated] + restored)
+        speedup = min(dt for dt, _ in full) / min(dt for dt, _ in restored)
+        print("snapshots: {}, identical environments: {}, rewritten after invalidation: {}, "
+            "speedup: {:.1f}x".format(len(snapshots), identical, rewritten, speedup))
+    finally:
+        shutil.rmtree(base)
+
+    return 0 if identical and rewritten and len(snapshots) == 1 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
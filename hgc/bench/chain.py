@@ -0,0 +1,210 @@
+# coding: utf-8
+
+"""
+Benchmark of the orchestration overhead of the GSD -> NTUP -> ConverterTask ->
+MergeConvertedFiles -> CreateMLDataset chain with the stand-in tools of
+:py:mod:`hgc.bench.fake_tools`. The tasks are run with "law run ... --workflow local" in a
+sandbox with its own HGC_BASE, store and law config. For each number of branches, the time per
+stage, the per-branch overhead (stage time minus the time spent in external commands as recorded
+by :py:func:`hgc.util.accounted_popen`), the log parsing cost and the merge throughput are
+reported.
+"""
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import collections
+
+import hgc
+from hgc.bench import fake_tools
+
+
+# stage name, task family, labels of external commands, additional parameters
+stages = [
+    ("simulation", "sim.NtupTask", ["cmsRun gsd_cfg.py", "cmsRun reco_cfg.py",
+        "cmsRun ntup_cfg.py"], []),
+    ("conversion", "gnn.ConverterTask", ["converter"], []),
+    ("merging", "gnn.MergeConvertedFiles", ["hadd"], ["--n-merged-files"]),
+    ("dataset", "gnn.CreateMLDataset", ["convertFromRoot"], ["--n-merged-files"]),
+]
+
+config_template = """input_dir = {input_dir}
+input_file = {input_file}
+output_dir = {output_dir}
+hist_output_file = {hist_output_file}
+skim_output_prefix = {skim_output_prefix}
+"""
+
+
+def create_sandbox(base):
+    """
+    Creates the directory structure expected by the tasks in *base*, with shims of the stand-in
+    tools, and returns the environment to run tasks in.
+    """
+    repo_base = os.path.dirname(os.path.dirname(os.path.abspath(hgc.__file__)))
+    fake_tools_file = os.path.splitext(os.path.abspath(fake_tools.__file__))[0] + ".py"
+
+    def makedirs(*parts):
+        path = os.path.join(base, *parts)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return path
+
+    def write(path, content, executable=False):
+        with open(path, "w") as f:
+            f.write(content)
+        if executable:
+            os.chmod(path, 0o755)
+
+    def shim(path, tool):
+        write(path, "#!/usr/bin/env bash\nexec \"{}\" \"{}\" \"{}\" \"$@\"\n".format(
+            sys.executable, fake_tools_file, tool), executable=True)
+
+    os.symlink(os.path.join(repo_base, "hgc"), os.path.join(base, "hgc"))
+    shutil.copy2(os.path.join(repo_base, "law.cfg"), os.path.join(base, "law.cfg"))
+
+    bin_dir = makedirs("bin")
+    for tool in ["cmsRun", "hadd", "convertFromRoot.py", "scram", "scramv1"]:
+        shim(os.path.join(bin_dir, tool), tool)
+    shim(os.path.join(makedirs("conda", "bin"), "conda"), "conda")
+
+    converter_dir = makedirs("modules", "hgcal-rechit-input-dat-gen")
+    shim(os.path.join(converter_dir, "analyser"), "analyser")
+    write(os.path.join(converter_dir, "env.sh"), "")
+    write(os.path.join(makedirs("modules", "hgcal-rechit-input-dat-gen", "config"),
+        "config_template.txt"), config_template)
+    write(os.path.join(makedirs("modules", "DeepJetCore"), "env.sh"), "")
+    write(os.path.join(makedirs("modules", "DeepJetCore", "compiled"), "classdict.so"), "")
+    makedirs("modules", "HGCalML")
+
+    env = os.environ.copy()
+    python_path = os.pathsep.join(p for p in [base, env.get("PYTHONPATH")] if p)
+    env.update({
+        "HGC_BASE": base,
+        "HGC_STORE": makedirs("store"),
+        "HGC_DATA": makedirs("data"),
+        "HGC_LOCAL_CACHE": makedirs("data", "cache"),
+        "HGC_CONDA_DIR": os.path.join(base, "conda"),
+        "HGC_PYTHONPATH_ORIG": python_path,
+        "HGC_SCHEDULER_HOST": "",
+        "HGC_SCHEDULER_PORT": "80",
+        "HGC_LUIGI_WORKER_KEEP_ALIVE": "False",
+        "HGC_LUIGI_WORKER_FORCE_MULTIPROCESSING": "False",
+        "HGC_RESOURCE_LOG": os.path.join(base, "data", "resources.jsonl"),
+        "HGC_TELEGRAM_TOKEN": "",
+        "HGC_TELEGRAM_CHAT": "",
+        "LAW_HOME": os.path.join(base, ".law"),
+        "LAW_CONFIG_FILE": os.path.join(base, "law.cfg"),
+        "PATH": os.pathsep.join([bin_dir, env.get("PATH", "")]),
+        "PYTHONPATH": python_path,
+    })
+
+    return env
+
+
+def run_law(args, env):
+    t0 = time.time()
+    code = subprocess.call(["law"] + args, env=env, stdout=open(os.devnull, "w"),
+        stderr=subprocess.STDOUT)
+    if code != 0:
+        raise Exception("law {} failed with exit code {}".format(" ".join(args), code))
+    return time.time() - t0
+
+
+def collect_records(log_path):
+    records = collections.defaultdict(list)
+    if os.path.exists(log_path):
+        with open(log_path, "r") as f:
+            for line in f:
+                record = json.loads(line)
+                records[record["label"]].append(record)
+    return records
+
+
+def measure_log_parsing(n_events, n_noise):
+    from hgc.util import CMSRunLogStream
+
+    lines = list(fake_tools.cms_run_log(n_events, n_noise))
+    t0 = time.time()
+    with CMSRunLogStream(echo=False, n_events=n_events) as stream:
+        for line in lines:
+            stream.feed(line)
+    return (time.time() - t0) / len(lines), len(lines)
+
+
+def benchmark(n_branches, n_events, n_merged_files, tmp_dir=None, keep=False):
+    base = tempfile.mkdtemp(dir=tmp_dir)
+    try:
+        env = create_sandbox(base)
+        t_index = run_law(["index"], env)
+        print("\n{} branches, {} events per branch (law index: {:.2f} s)".format(n_branches,
+            n_events, t_index))
+
+        common = ["--version", "bench", "--n-tasks", str(n_branches), "--n-events",
+            str(n_events), "--workflow", "local", "--local-scheduler"]
+        results = []
+        for name, family, labels, extra in stages:
+            args = ["run", family] + common
+            if "--n-merged-files" in extra:
+                args += ["--n-merged-files", str(n_merged_files)]
+            dt = run_law(args, env)
+
+            records = collect_records(env["HGC_RESOURCE_LOG"])
+            cmd_time = sum(r["wall_time"] for label in labels for r in records[label])
+            results.append((name, dt, cmd_time))
+
+        print("{:>12s}  {:>10s}  {:>12s}  {:>18s}".format("stage", "time / s", "commands / s",
+            "overhead / branch"))
+        for name, dt, cmd_time in results:
+            print("{:>12s}  {:10.2f}  {:12.2f}  {:16.1f}ms".format(name, dt, cmd_time,
+                1000. * (dt - cmd_time) / n_branches))
+
+        # log parsing cost of the three cmsRun steps
+        n_noise = int(fake_tools.env_float("HGC_BENCH_NOISE_LINES", 20))
+        per_line, n_lines = measure_log_parsing(n_events, n_noise)
+        print("log parsing: {:.2f} us per line, {:.1f} ms per branch".format(1e6 * per_line,
+            3e3 * per_line * n_lines))
+
+        # merge throughput
+        records = collect_records(env["HGC_RESOURCE_LOG"])
+        conv_dir = os.path.join(env["HGC_STORE"], "gnn.ConverterTask")
+        merged_bytes = sum(
+            os.stat(os.path.join(root, name)).st_size
+            for root, _, files in os.walk(conv_dir)
+            for name in files if name.startswith("tuple_") and name.endswith(".root")
+        )
+        hadd_time = sum(r["wall_time"] for r in records["hadd"])
+        if hadd_time:
+            print("merge throughput: {:.1f} MB/s".format(merged_bytes / 1024.**2 / hadd_time))
+    finally:
+        if keep:
+            print("sandbox kept at {}".format(base))
+        else:
+            shutil.rmtree(base)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--branches", "-b", default="10,100", help="comma-separated numbers of "
+        "branches, default: 10,100")
+    parser.add_argument("--events", "-n", type=int, default=10, help="number of events per "
+        "branch, default: 10")
+    parser.add_argument("--merged-files", "-m", type=int, default=1, help="number of merged "
+        "files, default: 1")
+    parser.add_argument("--tmp-dir", default=None, help="directory in which sandboxes are created")
+    parser.add_argument("--keep", action="store_true", help="keep sandboxes")
+    args = parser.parse_args(argv)
+
+    for n_branches in [int(b) for b in args.branches.split(",")]:
+        benchmark(n_branches, args.events, args.merged_files, tmp_dir=args.tmp_dir,
+            keep=args.keep)
+
+
+if __name__ == "__main__":
+    main()
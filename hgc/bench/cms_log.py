@@ -0,0 +1,90 @@
+# coding: utf-8
+
+"""
+Microbenchmark of the cmsRun log processing in :py:func:`hgc.util.cms_run_and_publish`. A
+synthetic cmsRun log is fed through the legacy per-line implementation and through
+:py:class:`hgc.util.CMSRunLogStream`, counting the scheduler calls made by both.
+"""
+
+
+import os
+import re
+import sys
+import time
+import argparse
+
+from hgc.util import CMSRunLogStream
+from hgc.bench.fake_tools import cms_run_log
+
+
+class DummyTask(object):
+
+    def __init__(self, n_events):
+        super(DummyTask, self).__init__()
+
+        self.n_events = n_events
+        self.n_calls = 0
+
+    def publish_progress(self, perc):
+        self.n_calls += 1
+
+    def _publish_message(self, msg):
+        self.n_calls += 1
+
+
+def legacy_process(task, lines, out):
+    # mirrors the former implementation: print and regex per line, two scheduler calls per event
+    for line in lines:
+        out.write(line + "\n")
+        match = re.match(r"^Begin\sprocessing\sthe\s(\d+)\w{2,2}\srecord\..+$", line.strip())
+        if match:
+            n_event = int(match.group(1))
+            task.publish_progress(100. * n_event / task.n_events)
+            task._publish_message("processing event {}".format(n_event))
+
+
+def stream_process(task, lines, out):
+    stdout = sys.stdout
+    sys.stdout = out
+    try:
+        with CMSRunLogStream(task, progress_interval=30., progress_step=5.) as stream:
+            for line in lines:
+                stream.feed(line)
+            stream.finish()
+    finally:
+        sys.stdout = stdout
+
+
+def measure(func, n_events, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        task = DummyTask(n_events)
+        with open(os.devnull, "w") as out:
+            t0 = time.time()
+            func(task, lines, out)
+            dt = time.time() - t0
+        best = dt if best is None else min(best, dt)
+    return best, task.n_calls
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--events", "-n", type=int, default=10000, help="number of events in the "
+        "synthetic log, default: 10000")
+    parser.add_argument("--noise", type=int, default=20, help="number of non-event lines per "
+        "event, default: 20")
+    parser.add_argument("--repeat", "-r", type=int, default=3, help="number of repetitions, the "
+        "best time is reported, default: 3")
+    args = parser.parse_args(argv)
+
+    lines = list(cms_run_log(args.events, args.noise))
+    print("synthetic log with {} lines and {} events".format(len(lines), args.events))
+
+    for name, func in [("legacy", legacy_process), ("stream", stream_process)]:
+        dt, n_calls = measure(func, args.events, lines, args.repeat)
+        print("{:>8s}: {:8.3f} s, {:10.0f} lines/s, {:6d} scheduler calls".format(
+            name, dt, len(lines) / dt, n_calls))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# coding: utf-8
+
+"""
+Stand-ins for the external tools used by hgcalsim tasks (cmsRun, hadd, the converter analyser,
+convertFromRoot.py, scram and conda) that emit realistic logs and write synthetic outputs at
+configurable rates, so that the orchestration can be benchmarked without CMSSW. This file only
+depends on the standard library and is executed as ``python fake_tools.py <tool> [args]``.
+Rates are configured through environment variables:
+
+- ``HGC_BENCH_EVENT_TIME``: seconds per event in cmsRun, default: 0.001
+- ``HGC_BENCH_EVENT_SIZE``: bytes per event in cmsRun outputs, default: 10000
+- ``HGC_BENCH_NOISE_LINES``: number of log lines per event in cmsRun, default: 20
+- ``HGC_BENCH_TUPLE_EVENT_SIZE``: bytes per event in converter outputs, default: 2000
+- ``HGC_BENCH_SCRAM_TIME``: seconds to evaluate the CMSSW runtime environment, default: 1.0
+"""
+
+
+import os
+import sys
+import time
+import datetime
+
+
+def env_float(name, default):
+    return float(os.getenv(name, default))
+
+
+def ordinal(n):
+    if 10 <= n % 100 <= 20:
+        return "{}th".format(n)
+    return "{}{}".format(n, {1: "st", 2: "nd", 3: "rd"}.get(n % 10, "th"))
+
+
+def write_fake_file(path, n_events, event_size, inputs=None):
+    # fake files consist of a header line with the number of events and a payload that is either
+    # copied from *inputs* or zero-filled
+    chunk_size = 1024**2
+    with open(path, "wb") as f:
+        f.write("FAKEROOT {}\n".format(n_events).encode("utf-8"))
+        if inputs:
+            for inp in inputs:
+                with open(inp, "rb") as fi:
+                    fi.readline()
+                    while True:
+                        chunk = fi.read(chunk_size)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+        else:
+            n_bytes = int(n_events * event_size)
+            zeros = b"\0" * chunk_size
+            while n_bytes > 0:
+                f.write(zeros[:min(n_bytes, chunk_size)])
+                n_bytes -= chunk_size
+
+
+def read_n_events(path):
+    if path.startswith("file:"):
+        path = path[5:]
+    with open(path, "rb") as f:
+        return int(f.readline().decode("utf-8").split()[1])
+
+
+def cms_run_log(n_events, n_noise=20):
+    """
+    Generator of cmsRun-like log lines for *n_events*.
+    """
+    now = datetime.datetime.now().strftime("%d-%b-%Y %H:%M:%S.%f")[:-3]
+    noise = [
+        "%MSG-w HGCalGeometry:  HGCalRecHitWorkerSimple:hgcalRecHit  {} CEST".format(now),
+        "Run: 1 Event: {}",
+        " invalid detid 0x{:08x} in layer 12",
+        "%MSG",
+    ]
+    yield "{} CEST  Initiating request to open file".format(now)
+    for i in range(1, n_events + 1):
+        yield ("Begin processing the {} record. Run 1, Event {}, LumiSection 1 on stream 0 at "
+            "{} CEST".format(ordinal(i), i, now))
+        for j in range(n_noise):
+            yield noise[j % len(noise)].format(i, j)
+    yield "dropped waiting message count 0"
+
+
+def cms_run(args):
+    cfg_file, opts = args[0], {}
+    for arg in args[1:]:
+        key, value = arg.split("=", 1)
+        opts.setdefault(key, []).append(value)
+
+    step = os.path.basename(cfg_file).split("_", 1)[0]
+    if "inputFiles" in opts:
+        n_events = sum(read_n_events(path) for path in opts["inputFiles"])
+    else:
+        n_events = int(opts.get("maxEvents", ["1"])[0])
+
+    event_time = env_float("HGC_BENCH_EVENT_TIME", 0.001)
+    n_noise = int(env_float("HGC_BENCH_NOISE_LINES", 20))
+    for line in cms_run_log(n_events, n_noise):
+        print(line)
+        if line.startswith("Begin processing"):
+            sys.stdout.flush()
+            time.sleep(event_time)
+
+    event_size = env_float("HGC_BENCH_EVENT_SIZE", 10000)
+    # ntuples are smaller than gsd and reco files
+    if step == "ntup":
+        event_size /= 5.
+    write_fake_file(opts["outputFile"][0], n_events, event_size)
+    if "outputFileDQM" in opts:
+        write_fake_file(opts["outputFileDQM"][0], 0, 0)
+
+    return 0
+
+
+def hadd(args):
+    # hadd -n 0 -d <tmp_dir> <output> <inputs...>
+    args = list(args)
+    while args and args[0].startswith("-"):
+        args = args[2:]
+    output, inputs = args[0], args[1:]
+    write_fake_file(output, sum(read_n_events(path) for path in inputs), 0, inputs=inputs)
+    return 0
+
+
+def analyser(args):
+    config = {}
+    with open(args[0], "r") as f:
+        for line in f:
+            if "=" in line:
+                key, value = line.split("=", 1)
+                config[key.strip()] = value.strip()
+
+    n_events = read_n_events(os.path.join(config["input_dir"], config["input_file"]))
+    output = os.path.join(config["output_dir"], config["skim_output_prefix"] + "0.root")
+    print("converting {} events".format(n_events))
+    write_fake_file(output, n_events, env_float("HGC_BENCH_TUPLE_EVENT_SIZE", 2000))
+    return 0
+
+
+def convert_from_root(args):
+    output_dir = args[args.index("-o") + 1]
+    with open(args[args.index("-i") + 1], "r") as f:
+        input_path = f.readline().strip()
+
+    n_events = read_n_events(input_path)
+    basename = os.path.splitext(os.path.basename(input_path))[0]
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    write_fake_file(os.path.join(output_dir, basename + ".x.0"), n_events, 1000)
+    write_fake_file(os.path.join(output_dir, basename + ".y.0"), n_events, 100)
+    write_fake_file(os.path.join(output_dir, basename + ".meta"), 0, 0)
+    write_fake_file(os.path.join(output_dir, "dataCollection.dc"), 0, 0)
+    return 0
+
+
+def scram(args):
+    # "scramv1 runtime -sh" prints the commands that set up the CMSSW environment, it is executed
+    # in $CMSSW_BASE/src
+    if args[:1] == ["runtime"]:
+        time.sleep(env_float("HGC_BENCH_SCRAM_TIME", 1.0))
+        cmssw_base = os.path.dirname(os.getcwd())
+        for name, path in [("PATH", "bin"), ("LD_LIBRARY_PATH", "lib"), ("PYTHONPATH", "python")]:
+            paths = [os.path.join(cmssw_base, path, "slc7_amd64_gcc700"), os.getenv(name, "")]
+            print("export {}=\"{}\";".format(name, os.pathsep.join(p for p in paths if p)))
+        print("export CMSSW_RELEASE_BASE=\"{}\";".format(cmssw_base))
+    return 0
+
+
+def noop(args):
+    return 0
+
+
+tools = {
+    "cmsRun": cms_run,
+    "hadd": hadd,
+    "analyser": analyser,
+    "convertFromRoot.py": convert_from_root,
+    "scram": noop,
+    "scramv1": scram,
+    "conda": noop,
+}
+
+
+if __name__ == "__main__":
+    sys.exit(tools[sys.argv[1]](sys.argv[2:]))
@@ -0,0 +1,80 @@
+# coding: utf-8
+
+"""
+Benchmark and cross-check of the grid-based neighbour graphs in :py:mod:`hgc.graphs` on synthetic
+events with hits that are clustered around shower axes on discrete layers. The graphs are compared
+to brute-force graphs that consider all pairs of hits and must be identical.
+"""
+
+
+import sys
+import time
+import argparse
+
+from hgc.graphs import knn_graph, radius_graph, knn_graph_brute, radius_graph_brute
+
+
+def create_points(n_events, mean_hits, n_layers=50, seed=123):
+    """
+    Creates a list of ``(n_hits, 3)`` arrays with x, y and z coordinates of synthetic hits in cm.
+    """
+    import numpy as np
+
+    rnd = np.random.RandomState(seed)
+    events = []
+    for _ in range(n_events):
+        n_hits = rnd.poisson(mean_hits)
+        n_showers = rnd.randint(1, 6)
+        centers = rnd.uniform(-100., 100., size=(n_showers, 2))
+        shower = rnd.randint(0, n_showers, size=n_hits)
+        xy = centers[shower] + rnd.normal(scale=5., size=(n_hits, 2))
+        z = 320. + 1.5 * rnd.randint(0, n_layers, size=n_hits)
+        events.append(np.c_[xy, z])
+    return events
+
+
+def main(argv=None):
+    import numpy as np
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--events", "-e", type=int, default=10, help="number of events, "
+        "default: 10")
+    parser.add_argument("--hits", type=int, default=2000, help="mean number of hits per event, "
+        "default: 2000")
+    parser.add_argument("--k", "-k", type=int, default=8, help="number of neighbours in the knn "
+        "graph, default: 8")
+    parser.add_argument("--radius", "-r", type=float, default=2.0, help="radius of the radius "
+        "graph in cm, default: 2.0")
+    args = parser.parse_args(argv)
+
+    events = create_points(args.events, args.hits)
+    n_hits = sum(len(points) for points in events)
+    print("{} events with {} hits".format(args.events, n_hits))
+
+    identical = True
+    for name, func, brute_func, value in [
+        ("knn", knn_graph, knn_graph_brute, args.k),
+        ("radius", radius_graph, radius_graph_brute, args.radius),
+    ]:
+        results, times = {}, {}
+        for impl, f in [("brute", brute_func), ("grid", func)]:
+            t0 = time.time()
+            results[impl] = [f(points, value) for points in events]
+            times[impl] = time.time() - t0
+            n_edges = sum(len(indices) for _, indices in results[impl])
+            print("{:>6s} {:>5s}: {:8.3f} s, {:10.0f} hits/s, {} edges".format(name, impl,
+                times[impl], n_hits / times[impl], n_edges))
+
+        same = all(
+            np.array_equal(a[0], b[0]) and np.array_equal(a[1], b[1])
+            for a, b in zip(results["brute"], results["grid"])
+        )
+        identical &= same
+        print("{:>6s} identical: {}, speedup: {:.1f}x".format(name, same,
+            times["brute"] / times["grid"]))
+
+    return 0 if identical else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
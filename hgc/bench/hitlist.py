@@ -0,0 +1,380 @@
+# coding: utf-8
+
+"""
+Benchmark and cross-check of the vectorized hitlist builder in :py:mod:`hgc.hitlist` on synthetic
+events in the per-event layout returned by root_numpy. The results are compared to a reference
+implementation that loops over hits and must be identical, also for chunks of events whose
+nested branches are all empty.
+
+With ``--parity [NTUP_FILE]``, the arrays of :py:func:`hgc.hitlist.create_hitlist` are instead
+compared to those of the existing chain, i.e., the converter followed by ``convertFromRoot.py``
+with ``TrainData_hitlist`` of HGCalML. Without a file, a small ntuple with synthetic events is
+written with PyROOT first. This requires the compiled converter and DeepJetCore submodules, and is
+skipped with exit code 2 otherwise, so that a skipped check is not mistaken for a passed one.
+"""
+
+
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from hgc.events import JaggedArray, Events
+from hgc.hitlist import feature_branches, build_hitlist
+
+
+def object_array(arrays):
+    import numpy as np
+
+    arr = np.empty(len(arrays), dtype=object)
+    arr[:] = arrays
+    return arr
+
+
+def create_events(n_events, mean_hits, mean_simclusters, seed=123):
+    """
+    Creates synthetic events with rechits and simclusters that share some of their hits. Returns a
+    dictionary that maps branch names to object arrays of per-event arrays.
+    """
+    import numpy as np
+
+    rnd = np.random.RandomState(seed)
+    events = {name: [] for name in feature_branches}
+    events.update({"rechit_detid": [], "simcluster_energy": [], "simcluster_hits": [],
+        "simcluster_fractions": []})
+
+    for _ in range(n_events):
+        detids = np.unique(rnd.randint(0, 2**31, size=rnd.poisson(mean_hits))).astype(np.uint32)
+        rnd.shuffle(detids)
+        n_hits = len(detids)
+        for name in feature_branches:
+            if name == "rechit_layer":
+                events[name].append(rnd.randint(1, 53, size=n_hits).astype(np.int32))
+            else:
+                events[name].append(rnd.normal(size=n_hits).astype(np.float32))
+        events["rechit_detid"].append(detids)
+
+        # simclusters with hits that are mostly, but not always, among the rechits
+        n_simclusters = rnd.poisson(mean_simclusters)
+        events["simcluster_energy"].append(rnd.exponential(10., size=n_simclusters)
+            .astype(np.float32))
+        hits, fractions = [], []
+        for _ in range(n_simclusters):
+            n = rnd.randint(0, max(1, 2 * n_hits // max(1, n_simclusters)))
+            sc_detids = rnd.choice(detids, size=n) if n_hits else np.zeros(0, dtype=np.uint32)
+            sc_detids[rnd.uniform(size=n) < 0.05] = 2**31 + 1
+            hits.append(sc_detids.astype(np.uint32))
+            fractions.append(rnd.uniform(size=n).astype(np.float32))
+        events["simcluster_hits"].append(object_array(hits))
+        events["simcluster_fractions"].append(object_array(fractions))
+
+    return {name: object_array(values) for name, values in events.items()}
+
+
+def reference_hitlist(events, max_hits, n_showers):
+    """
+    Builds the hitlist arrays with loops over events and hits.
+    """
+    import numpy as np
+
+    n_events = len(events["rechit_detid"])
+    x = np.zeros((n_events, max_hits, len(feature_branches)), dtype=np.float32)
+    y = np.zeros((n_events, max_hits, n_showers), dtype=np.float32)
+
+    for i in range(n_events):
+        detids = events["rechit_detid"][i]
+        for j in range(min(len(detids), max_hits)):
+            for k, name in enumerate(feature_branches):
+                x[i, j, k] = events[name][i][j]
+
+        hit_index = {}
+        for j, detid in enumerate(detids):
+            hit_index[int(detid)] = j
+
+        energies = events["simcluster_energy"][i]
+        ranked = sorted(range(len(energies)), key=lambda c: -float(energies[c]))
+        for slot, c in enumerate(ranked[:n_showers]):
+            hits = events["simcluster_hits"][i][c]
+            fractions = events["simcluster_fractions"][i][c]
+            for detid, fraction in zip(hits, fractions):
+                j = hit_index.get(int(detid))
+                if j is not None and j < max_hits:
+                    y[i, j, slot] += fraction
+
+    return x, y
+
+
+def native_hitlist(events, max_hits, n_showers):
+    events = Events((name, JaggedArray.from_arrays(values)) for name, values in events.items())
+    return build_hitlist(events, max_hits, n_showers)
+
+
+def check_empty_events(max_hits, n_showers):
+    """
+    Compares the native and reference hitlists of chunks of two events without simclusters, and
+    without hits and simcluster hits, whose doubly nested branches are empty in all events. Returns
+    whether all results are identical.
+    """
+    import numpy as np
+
+    identical = True
+    for label, mean_hits, mean_simclusters in [("no simclusters", 50, 0), ("no hits", 0, 0),
+            ("no simcluster hits", 0, 3)]:
+        events = create_events(2, mean_hits, mean_simclusters)
+        results = [func(events, max_hits, n_showers) for func in [reference_hitlist,
+            native_hitlist]]
+        _identical = all(np.array_equal(a, b) for a, b in zip(*results))
+        print("empty events, {}: identical: {}".format(label, _identical))
+        identical &= _identical
+    return identical
+
+
+# C++ value types of the ntuple branches written by write_ntuple
+ntuple_branch_types = dict(
+    [(name, "float") for name in feature_branches if name != "rechit_layer"],
+    rechit_layer="unsigned int",
+    rechit_detid="unsigned int",
+    simcluster_energy="float",
+    simcluster_hits="vector<unsigned int>",
+    simcluster_fractions="vector<float>",
+)
+
+
+def fill_vector(vec, value_type, values):
+    import ROOT
+
+    vec.clear()
+    if value_type.startswith("vector<"):
+        inner_type = value_type[len("vector<"):-1]
+        for _values in values:
+            inner = ROOT.std.vector(inner_type)()
+            fill_vector(inner, inner_type, _values)
+            vec.push_back(inner)
+    else:
+        cast = float if value_type == "float" else int
+        for value in values:
+            vec.push_back(cast(value))
+
+
+def write_ntuple(path, events, treename="ana/hgc"):
+    """
+    Writes the synthetic *events* of :py:func:`create_events` to a ROOT file at *path* with
+    ``std::vector`` branches like those of the ntuples of :py:class:`hgc.tasks.simulation.NtupTask`.
+    Only the branches read by :py:mod:`hgc.hitlist` are written.
+    """
+    import ROOT
+
+    f = ROOT.TFile(path, "RECREATE")
+    dirname, name = os.path.split(treename)
+    if dirname:
+        f.mkdir(dirname).cd()
+    tree = ROOT.TTree(name, name)
+
+    vectors = {}
+    for branch, value_type in ntuple_branch_types.items():
+        vectors[branch] = ROOT.std.vector(value_type)()
+        tree.Branch(branch, vectors[branch])
+
+    for i in range(len(events["rechit_detid"])):
+        for branch, value_type in ntuple_branch_types.items():
+            fill_vector(vectors[branch], value_type, events[branch][i])
+        tree.Fill()
+
+    tree.Write()
+    f.Close()
+
+
+# dumps the first feature and truth arrays of a DeepJetCore shard to npy files
+dump_shard_script = """
+import sys
+import numpy as np
+from DeepJetCore.TrainData import TrainData
+
+meta_path, x_path, y_path = sys.argv[1:]
+td = TrainData()
+td.readIn(meta_path)
+np.save(x_path, td.x[0])
+np.save(y_path, td.y[0])
+"""
+
+
+def chain_hitlist(ntup_path, tmp_dir):
+    """
+    Converts the ntuple at *ntup_path* with the converter and ``TrainData_hitlist`` of the existing
+    chain in *tmp_dir* and returns the feature and truth arrays of the resulting shard.
+    """
+    import numpy as np
+    import law
+    from hgc.tasks.software import CompileConverter
+    from hgc.tasks.graphnn import run_converter, hgcalml_setup_cmd
+
+    conv_dir = os.path.join(tmp_dir, "converted")
+    os.makedirs(conv_dir)
+    run_converter(CompileConverter().output(), [ntup_path], [conv_dir])
+    conv_files = glob.glob(os.path.join(conv_dir, "*.root"))
+    if len(conv_files) != 1:
+        raise Exception("expected one converted file in {}, found {}".format(conv_dir,
+            len(conv_files)))
+
+    samples_file = os.path.join(tmp_dir, "samples.txt")
+    with open(samples_file, "w") as f:
+        f.write("{}\n".format(conv_files[0]))
+    script = os.path.join(tmp_dir, "dump_shard.py")
+    with open(script, "w") as f:
+        f.write(dump_shard_script)
+
+    dc_dir = os.path.join(tmp_dir, "dc")
+    x_path, y_path = os.path.join(tmp_dir, "chain.x.npy"), os.path.join(tmp_dir, "chain.y.npy")
+    basename = os.path.splitext(os.path.basename(conv_files[0]))[0]
+    meta_path = os.path.join(dc_dir, basename + ".meta")
+    cmd = "{}\nconvertFromRoot.py -n 0 --noRelativePaths -c TrainData_hitlist -o \"{}\" -i " \
+        "\"{}\" && python \"{}\" \"{}\" \"{}\" \"{}\"".format(hgcalml_setup_cmd(), dc_dir,
+        samples_file, script, meta_path, x_path, y_path)
+    env = os.environ.copy()
+    env["PYTHONPATH"] = env.get("HGC_PYTHONPATH_ORIG", "")
+    code = subprocess.call(cmd, env=env, shell=True, executable="/bin/bash")
+    if code != 0:
+        raise Exception("conversion with TrainData_hitlist failed with exit code {}".format(code))
+
+    return np.load(x_path), np.load(y_path)
+
+
+def compare_arrays(name, native, chain, columns=None):
+    """
+    Prints the differences between the *native* and *chain* arrays and returns whether they are
+    identical in shape, dtype and values. When the shapes match, mismatches are reported per entry
+    of the last axis, labeled with *columns*.
+    """
+    import numpy as np
+
+    print("{}: native {} {}, chain {} {}".format(name, native.shape, native.dtype, chain.shape,
+        chain.dtype))
+    if native.shape != chain.shape:
+        print("  shapes differ")
+        return False
+    identical = native.dtype == chain.dtype
+    if not identical:
+        print("  dtypes differ")
+    for i in range(native.shape[-1]):
+        a, b = native[..., i], chain[..., i].astype(native.dtype)
+        n_diff = int(np.sum(~np.isclose(a, b, rtol=1e-6, atol=0.)))
+        if n_diff:
+            label = columns[i] if columns else str(i)
+            print("  {:>16s}: {} mismatches, max abs diff {:.3g}".format(label, n_diff,
+                float(np.max(np.abs(a - b)))))
+            identical = False
+    return identical
+
+
+def parity(ntup_path, max_hits, n_showers, tmp_dir=None, events=None):
+    """
+    Compares the hitlist arrays of :py:func:`hgc.hitlist.create_hitlist` for the ntuple at
+    *ntup_path* to those of the existing chain. When *ntup_path* is *None*, the synthetic *events*
+    are written to an ntuple with :py:func:`write_ntuple` first. Returns *None* when the chain or
+    PyROOT is not available, and whether all arrays are identical otherwise.
+    """
+    import numpy as np
+    from hgc.hitlist import create_hitlist
+
+    base = os.path.expandvars("$HGC_BASE/modules")
+    required = [
+        os.path.join(base, "hgcal-rechit-input-dat-gen", "analyser"),
+        os.path.join(base, "DeepJetCore", "compiled", "classdict.so"),
+        os.path.join(base, "HGCalML", "modules", "datastructures"),
+    ]
+    missing = [path for path in required if not os.path.exists(path)]
+    if missing:
+        print("parity check skipped, missing {}".format(", ".join(missing)))
+        return None
+
+    if ntup_path is None:
+        try:
+            import ROOT  # noqa: F401
+        except ImportError:
+            print("parity check skipped, PyROOT is required to write the synthetic ntuple")
+            return None
+
+    tmp_dir = os.path.abspath(tempfile.mkdtemp(dir=tmp_dir))
+    try:
+        if ntup_path is None:
+            ntup_path = os.path.join(tmp_dir, "synthetic_ntup.root")
+            write_ntuple(ntup_path, events)
+            print("wrote synthetic ntuple with {} events".format(len(events["rechit_detid"])))
+
+        x_chain, y_chain = chain_hitlist(os.path.abspath(ntup_path), tmp_dir)
+
+        x_path, y_path = os.path.join(tmp_dir, "native.x.npy"), os.path.join(tmp_dir,
+            "native.y.npy")
+        create_hitlist(ntup_path, x_path, y_path, max_hits, n_showers)
+        x_native, y_native = np.load(x_path), np.load(y_path)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    identical = compare_arrays("features", x_native, x_chain, columns=feature_branches)
+    identical &= compare_arrays("truth", y_native, y_chain)
+    print("identical: {}".format(identical))
+
+    return identical
+
+
+def main(argv=None):
+    import numpy as np
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--events", "-e", type=int, default=200, help="number of events, "
+        "default: 200")
+    parser.add_argument("--hits", type=int, default=2000, help="mean number of hits per event, "
+        "default: 2000")
+    parser.add_argument("--simclusters", type=int, default=10, help="mean number of simclusters "
+        "per event, default: 10")
+    parser.add_argument("--max-hits", type=int, default=2500, help="maximum number of hits per "
+        "event, default: 2500")
+    parser.add_argument("--showers", type=int, default=5, help="number of showers in the truth, "
+        "default: 5")
+    parser.add_argument("--parity", metavar="NTUP_FILE", nargs="?", const="", help="compare to "
+        "the arrays of the existing chain for this ntuple, or for a synthetic ntuple with the "
+        "given number of events, hits and simclusters, instead")
+    parser.add_argument("--tmp-dir", default=None, help="directory in which temporary files of the "
+        "parity check are created")
+    args = parser.parse_args(argv)
+
+    if args.parity is not None:
+        if args.parity:
+            ntup_path, events = args.parity, None
+        else:
+            ntup_path, events = None, create_events(args.events, args.hits, args.simclusters)
+        identical = parity(ntup_path, args.max_hits, args.showers, tmp_dir=args.tmp_dir,
+            events=events)
+        if identical is None:
+            return 2
+        return 0 if identical else 1
+
+    identical = check_empty_events(args.max_hits, args.showers)
+
+    events = create_events(args.events, args.hits, args.simclusters)
+    n_hits = sum(len(detids) for detids in events["rechit_detid"])
+    print("{} events with {} hits".format(args.events, n_hits))
+
+    results = {}
+    for name, func in [("reference", reference_hitlist), ("native", native_hitlist)]:
+        t0 = time.time()
+        results[name] = func(events, args.max_hits, args.showers)
+        dt = time.time() - t0
+        results[name + "_time"] = dt
+        print("{:>10s}: {:8.3f} s, {:10.0f} hits/s".format(name, dt, n_hits / dt))
+
+    _identical = all(np.array_equal(a, b) for a, b in zip(results["reference"],
+        results["native"]))
+    identical &= _identical
+    print("identical: {}, speedup: {:.1f}x".format(_identical,
+        results["reference_time"] / results["native_time"]))
+
+    return 0 if identical else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
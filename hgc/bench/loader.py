@@ -0,0 +1,111 @@
+# coding: utf-8
+
+"""
+Throughput benchmark of the shard loader in :py:mod:`hgc.loader` on synthetic hitlist shards. A
+training step is simulated by sleeping for a fixed time per batch, so that the gain of prefetching
+in a background thread becomes visible. It is also checked that each sample is served exactly once
+per epoch, that the order only depends on the seed and the epoch, and that no shards are left
+open after an epoch.
+"""
+
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from hgc.loader import ShardLoader, open_npy_shard
+
+
+def create_shards(directory, n_shards, n_samples, max_hits, n_features=8, n_showers=5, seed=123):
+    """
+    Writes *n_shards* pairs of x and y npy files with *n_samples* each to *directory* and returns
+    their paths. The first truth value of the first hit of each sample is its global index.
+    """
+    import numpy as np
+
+    rnd = np.random.RandomState(seed)
+    shards = []
+    for i in range(n_shards):
+        x = rnd.normal(size=(n_samples, max_hits, n_features)).astype(np.float32)
+        y = np.zeros((n_samples, max_hits, n_showers), dtype=np.float32)
+        y[:, 0, 0] = np.arange(i * n_samples, (i + 1) * n_samples)
+        x_path = os.path.join(directory, "shard_{}.x.npy".format(i))
+        y_path = os.path.join(directory, "shard_{}.y.npy".format(i))
+        np.save(x_path, x)
+        np.save(y_path, y)
+        shards.append((x_path, y_path))
+    return shards
+
+
+def run_epoch(loader, step_time):
+    t0 = time.time()
+    ids = []
+    for x, y in loader:
+        ids.extend(y[:, 0, 0].astype(int).tolist())
+        if step_time > 0:
+            time.sleep(step_time)
+    return time.time() - t0, ids
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--shards", type=int, default=8, help="number of shards, default: 8")
+    parser.add_argument("--samples", type=int, default=500, help="number of samples per shard, "
+        "default: 500")
+    parser.add_argument("--max-hits", type=int, default=1000, help="number of hits per sample, "
+        "default: 1000")
+    parser.add_argument("--batch-size", "-b", type=int, default=64, help="batch size, "
+        "default: 64")
+    parser.add_argument("--shuffle-buffer", type=int, default=1024, help="size of the shuffle "
+        "buffer in samples, default: 1024")
+    parser.add_argument("--max-open-shards", type=int, default=2, help="maximum number of open "
+        "shards, default: 2")
+    parser.add_argument("--step-time", type=float, default=0.01, help="simulated time per "
+        "training step in seconds, default: 0.01")
+    args = parser.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp(prefix="hgc_bench_loader_")
+    try:
+        shards = create_shards(tmp_dir, args.shards, args.samples, args.max_hits)
+        n_samples = args.shards * args.samples
+        print("{} shards with {} samples".format(args.shards, n_samples))
+
+        n_opened = [0]
+
+        def open_shard(paths):
+            n_opened[0] += 1
+            return open_npy_shard(paths)
+
+        ok = True
+        order = None
+        for name, prefetch, step_time in [
+            ("sync, no step", 0, 0.), ("prefetch, no step", 4, 0.),
+            ("sync", 0, args.step_time), ("prefetch", 4, args.step_time),
+        ]:
+            n_opened[0] = 0
+            loader = ShardLoader(shards, batch_size=args.batch_size,
+                shuffle_buffer=args.shuffle_buffer, seed=1, prefetch=prefetch,
+                max_open_shards=args.max_open_shards, open_shard=open_shard)
+            dt, ids = run_epoch(loader, step_time)
+            print("{:>18s}: {:8.3f} s, {:10.0f} samples/s, {} shard openings".format(name, dt,
+                n_samples / dt, n_opened[0]))
+
+            ok &= sorted(ids) == list(range(n_samples))
+            ok &= order is None or ids == order
+            ok &= not loader._arrays
+            order = ids
+
+        loader.set_epoch(1)
+        ok &= run_epoch(loader, 0.)[1] != order
+        print("each sample once, deterministic order, shards closed: {}".format(ok))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# coding: utf-8
+
+"""
+Benchmark of the merge backends in :py:attr:`hgc.util.merge_backends` on synthetic files with
+flat trees. For each total size, a number of input files with random float and int branches is
+created with uproot and merged with each backend. hadd is skipped when it is not available.
+"""
+
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from hgc.util import merge_backends
+
+
+def create_inputs(directory, total_size, n_files, n_branches=20, treename="tree", seed=123):
+    import numpy as np
+    import uproot
+
+    # random numbers barely compress, so the size is approximately n_entries * n_branches * 4
+    n_entries = max(1, int(total_size / (4. * n_branches * n_files)))
+    rnd = np.random.RandomState(seed)
+
+    paths = []
+    for i in range(n_files):
+        path = os.path.join(directory, "input_{}.root".format(i))
+        with uproot.recreate(path) as f:
+            step = 500000
+            for start in range(0, n_entries, step):
+                n = min(step, n_entries - start)
+                chunk = {
+                    "b{}".format(j): (rnd.normal(size=n).astype(np.float32) if j % 2 else
+                        rnd.randint(0, 1000, size=n).astype(np.int32))
+                    for j in range(n_branches)
+                }
+                if start == 0:
+                    f.mktree(treename, {name: arr.dtype for name, arr in chunk.items()})
+                f[treename].extend(chunk)
+        paths.append(path)
+
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--sizes", "-s", default="10,100,1000", help="comma-separated total "
+        "input sizes in MB, default: 10,100,1000")
+    parser.add_argument("--files", "-f", type=int, default=10, help="number of input files per "
+        "size, default: 10")
+    parser.add_argument("--workers", "-w", type=int, default=4, help="number of reading "
+        "processes for the parallel uproot measurement, default: 4")
+    parser.add_argument("--tmp-dir", default=None, help="directory for temporary files")
+    args = parser.parse_args(argv)
+
+    configs = [("hadd", {})]
+    configs.append(("uproot", {"n_workers": 0}))
+    if args.workers > 1:
+        configs.append(("uproot", {"n_workers": args.workers}))
+
+    has_hadd = any(
+        os.access(os.path.join(d, "hadd"), os.X_OK)
+        for d in os.getenv("PATH", "").split(os.pathsep)
+    )
+
+    for size in [float(s) for s in args.sizes.split(",")]:
+        tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+        try:
+            paths = create_inputs(tmp_dir, size * 1024.**2, args.files)
+            input_size = sum(os.stat(path).st_size for path in paths) / 1024.**2
+            print("{:.1f} MB in {} files".format(input_size, len(paths)))
+
+            for backend, kwargs in configs:
+                name = backend + ("" if not kwargs.get("n_workers") else
+                    " ({} workers)".format(kwargs["n_workers"]))
+                if backend == "hadd" and not has_hadd:
+                    print("{:>22s}: skipped".format(name))
+                    continue
+
+                output_path = os.path.join(tmp_dir, "merged.root")
+                t0 = time.time()
+                merge_backends[backend](output_path, paths, cwd=tmp_dir, **kwargs)
+                dt = time.time() - t0
+                print("{:>22s}: {:8.2f} s, {:8.1f} MB/s, output {:.1f} MB".format(name, dt,
+                    input_size / dt, os.stat(output_path).st_size / 1024.**2))
+                os.remove(output_path)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
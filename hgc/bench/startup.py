@@ -0,0 +1,114 @@
+# coding: utf-8
+
+"""
+Startup latency check of the task modules. In fresh interpreters, the import of all modules listed
+in law.cfg, "law index" and "law run <task> --help" are timed in a sandbox with its own law home
+(see :py:func:`hgc.bench.chain.create_sandbox`). It is also verified that importing the task
+modules does not import heavy dependencies such as ROOT, plotlib or telegram, which should only be
+imported by the tasks that use them. The exit code is 1 when one of the budgets is exceeded.
+"""
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from six.moves import configparser
+
+import hgc
+from hgc.bench.chain import create_sandbox
+
+
+# modules that must not be imported when loading the task modules
+heavy_modules = [
+    "ROOT", "root_numpy", "uproot", "numpy", "plotlib", "telegram", "DeepJetCore", "matplotlib",
+    "gfal2",
+]
+
+import_script = """
+import sys, json, time
+t0 = time.time()
+for name in {modules!r}:
+    __import__(name)
+print(json.dumps({{"time": time.time() - t0, "modules": sorted(sys.modules)}}))
+"""
+
+
+def task_modules():
+    """
+    Returns the names of the modules listed in the law.cfg file of this repository.
+    """
+    repo_base = os.path.dirname(os.path.dirname(os.path.abspath(hgc.__file__)))
+    parser = configparser.ConfigParser(allow_no_value=True)
+    parser.optionxform = str
+    parser.read(os.path.join(repo_base, "law.cfg"))
+    return parser.options("modules")
+
+
+def time_command(cmd, env, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.time()
+        code = subprocess.call(cmd, env=env, stdout=open(os.devnull, "w"),
+            stderr=subprocess.STDOUT)
+        if code != 0:
+            raise Exception("{} failed with exit code {}".format(" ".join(cmd), code))
+        times.append(time.time() - t0)
+    return times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--task", default="sim.GSDTask", help="task whose --help is timed, "
+        "default: sim.GSDTask")
+    parser.add_argument("--repeat", "-n", type=int, default=3, help="number of measurements, the "
+        "fastest one is compared to the budget, default: 3")
+    parser.add_argument("--import-budget", type=float, default=1.5, help="budget in seconds for "
+        "importing all task modules, default: 1.5")
+    parser.add_argument("--index-budget", type=float, default=3.0, help="budget in seconds for "
+        "'law index', default: 3.0")
+    parser.add_argument("--run-budget", type=float, default=3.0, help="budget in seconds for "
+        "'law run <task> --help', default: 3.0")
+    args = parser.parse_args(argv)
+
+    base = tempfile.mkdtemp(prefix="hgc_bench_startup_")
+    try:
+        env = create_sandbox(base)
+        modules = task_modules()
+        ok = True
+
+        # imports, including the time to start the interpreter
+        import_cmd = [sys.executable, "-c", import_script.format(modules=modules)]
+        times = time_command(import_cmd, env, args.repeat)
+        out = subprocess.check_output(import_cmd, env=env).decode("utf-8")
+        imported = json.loads(out.strip().splitlines()[-1])["modules"]
+        heavy = sorted(name for name in imported if name.split(".")[0] in heavy_modules)
+
+        results = [
+            ("import " + ", ".join(modules), times, args.import_budget),
+            ("law index", time_command(["law", "index"], env, args.repeat), args.index_budget),
+            ("law run {} --help".format(args.task),
+                time_command(["law", "run", args.task, "--help"], env, args.repeat),
+                args.run_budget),
+        ]
+        for name, times, budget in results:
+            within = min(times) <= budget
+            ok &= within
+            print("{}:\n    min {:.3f} s, max {:.3f} s, budget {:.1f} s{}".format(name,
+                min(times), max(times), budget, "" if within else "  EXCEEDED"))
+
+        print("heavy modules imported by task modules: {}".format(", ".join(heavy) or "none"))
+        ok &= not heavy
+    finally:
+        shutil.rmtree(base)
+
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
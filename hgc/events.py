@@ -0,0 +1,349 @@
+# coding: utf-8
+
+"""
+Compact in-memory containers for event data with variable-length collections.
+"""
+
+
+__all__ = ["JaggedArray", "Events", "local_index", "pad_events"]
+
+
+import numbers
+import collections
+
+import six
+
+
+def local_index(offsets):
+    """
+    Returns the index of each element within its event for events defined by *offsets*.
+    """
+    import numpy as np
+
+    offsets = np.asarray(offsets, dtype=np.int64)
+    return np.arange(offsets[0], offsets[-1]) - np.repeat(offsets[:-1], np.diff(offsets))
+
+
+def pad_events(flat, offsets, max_length, fill=0):
+    """
+    Converts the array *flat* whose first axis is split into events by *offsets* (starting at 0)
+    into an array with shape ``(n_events, max_length) + flat.shape[1:]``. Events with more than
+    *max_length* elements are truncated, missing elements are set to *fill*.
+    """
+    import numpy as np
+
+    n_events = len(offsets) - 1
+    counts = np.diff(offsets)
+    padded = np.full((n_events, max_length) + flat.shape[1:], fill, dtype=flat.dtype)
+
+    # position of each element in the flattened first two axes of the padded array
+    idx = local_index(offsets)
+    pos = idx + np.repeat(np.arange(n_events, dtype=np.int64) * max_length, counts)
+    if (counts > max_length).any():
+        keep = idx < max_length
+        pos, flat = pos[keep], flat[keep]
+    padded.reshape((-1,) + flat.shape[1:])[pos] = flat
+
+    return padded
+
+
+class JaggedArray(object):
+    """
+    Array of variable-length events whose elements are stored in one contiguous, typed *content*
+    array that is split into events by an int64 *offsets* array with ``n_events + 1`` entries.
+    *content* can be a :py:class:`JaggedArray` itself for doubly nested collections. Single events
+    and ranges of events are views that do not copy data. Example:
+
+    .. code-block:: python
+
+        energy = JaggedArray.from_arrays([[1., 2.], [], [3.]])
+
+        energy[0]          # -> array([1., 2.])
+        energy[1:]         # -> JaggedArray with 2 events, sharing the content
+        energy.sum()       # -> array([3., 0., 3.])
+        energy.counts      # -> array([2, 0, 1])
+
+        # hits per layer and event
+        layer.bincount(53)
+    """
+
+    def __init__(self, content, offsets):
+        import numpy as np
+
+        super(JaggedArray, self).__init__()
+
+        self.content = content
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_counts(cls, content, counts):
+        import numpy as np
+
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(content, offsets)
+
+    @classmethod
+    def from_arrays(cls, arrays, dtype=None):
+        """
+        Creates a jagged array from a sequence of per-event *arrays*, e.g. an object array of a
+        jagged branch as returned by root_numpy. Per-event sequences of arrays result in a nested
+        jagged array, also when all events are empty, as long as the per-event arrays are object
+        arrays.
+        """
+        import numpy as np
+
+        counts = np.fromiter((len(a) for a in arrays), dtype=np.int64, count=len(arrays))
+        if counts.sum():
+            content = np.concatenate([np.asarray(a) for a in arrays])
+        elif len(arrays):
+            # all events are empty, keep the type of their arrays to preserve the nesting
+            content = np.asarray(arrays[0])[:0]
+        else:
+            content = np.array([], dtype=dtype or np.float64)
+        if content.dtype.kind == "O":
+            content = cls.from_arrays(content, dtype=dtype)
+        elif dtype is not None:
+            content = content.astype(dtype, copy=False)
+
+        return cls.from_counts(content, counts)
+
+    @classmethod
+    def concatenate(cls, arrays):
+        """
+        Concatenates the events of several jagged *arrays* into a new one.
+        """
+        import numpy as np
+
+        arrays = list(arrays)
+        if isinstance(arrays[0].content, JaggedArray):
+            content = cls.concatenate([a.flat for a in arrays])
+        else:
+            content = np.concatenate([a.flat for a in arrays])
+
+        return cls.from_counts(content, np.concatenate([a.counts for a in arrays]))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __repr__(self):
+        return "<{} with {} events and {} elements at {}>".format(self.__class__.__name__,
+            len(self), self.offsets[-1] - self.offsets[0], hex(id(self)))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, idx):
+        import numpy as np
+
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step == 1:
+                return self.__class__(self.content, self.offsets[start:max(start, stop) + 1])
+            idx = np.arange(start, stop, step)
+
+        if np.ndim(idx) == 0:
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError("event index {} out of range".format(idx))
+            return self.content[self.offsets[idx]:self.offsets[idx + 1]]
+
+        # selection of events by indices or mask, copies the selected elements
+        idx = np.arange(len(self))[idx]
+        counts = self.counts[idx]
+        starts = np.repeat(self.offsets[idx], counts)
+        elements = starts + (np.arange(len(starts)) - np.repeat(np.cumsum(counts) - counts, counts))
+
+        return self.from_counts(self.content[elements], counts)
+
+    @property
+    def counts(self):
+        import numpy as np
+
+        return np.diff(self.offsets)
+
+    @property
+    def flat(self):
+        """
+        Contiguous elements of all events, a view on :py:attr:`content`.
+        """
+        return self.content[self.offsets[0]:self.offsets[-1]]
+
+    @property
+    def event_index(self):
+        """
+        Index of the event of each element in :py:attr:`flat`.
+        """
+        import numpy as np
+
+        return np.repeat(np.arange(len(self)), self.counts)
+
+    @property
+    def local_index(self):
+        """
+        Index of each element in :py:attr:`flat` within its event.
+        """
+        return local_index(self.offsets)
+
+    def with_content(self, content):
+        """
+        Returns a jagged array with the same event structure and elements *content*, which must
+        have the same length as :py:attr:`flat`, e.g. to apply elementwise operations.
+        """
+        return self.from_counts(content, self.counts)
+
+    def reduce(self, ufunc, initial=0):
+        """
+        Reduces the elements of each event with the numpy *ufunc*, empty events are set to
+        *initial*.
+        """
+        import numpy as np
+
+        flat = self.flat
+        counts = self.counts
+        result = np.full(len(self), initial, dtype=np.result_type(flat, initial))
+        nonempty = counts > 0
+        if nonempty.any():
+            starts = (self.offsets[:-1] - self.offsets[0])[nonempty]
+            result[nonempty] = ufunc.reduceat(flat, starts)
+        return result
+
+    def sum(self):
+        import numpy as np
+
+        return self.reduce(np.add, 0)
+
+    def max(self, initial=None):
+        import numpy as np
+
+        return self.reduce(np.maximum, -np.inf if initial is None else initial)
+
+    def min(self, initial=None):
+        import numpy as np
+
+        return self.reduce(np.minimum, np.inf if initial is None else initial)
+
+    def mean(self):
+        import numpy as np
+
+        counts = self.counts
+        return np.where(counts > 0, self.sum() / np.maximum(counts, 1), np.nan)
+
+    def bincount(self, minlength, weights=None):
+        """
+        Counts the occurrences of each non-negative integer element per event, e.g. hits per layer,
+        and returns an array with shape ``(n_events, minlength)``. *weights* can be a jagged array
+        or flat array with the same structure, e.g. to sum energies per layer.
+        """
+        import numpy as np
+
+        if isinstance(weights, JaggedArray):
+            weights = weights.flat
+        idx = self.event_index * minlength + np.asarray(self.flat, dtype=np.int64)
+        counts = np.bincount(idx, weights=weights, minlength=len(self) * minlength)
+        return counts.reshape(len(self), minlength)
+
+    def pad(self, max_length, fill=0):
+        """
+        Returns a regular array with shape ``(n_events, max_length)``, see :py:func:`pad_events`.
+        """
+        return pad_events(self.flat, self.offsets - self.offsets[0], max_length, fill=fill)
+
+
+class Events(object):
+    """
+    Container of event data that maps branch names to numpy arrays with one value per event or to
+    :py:class:`JaggedArray`'s for variable-length collections. Indexing with a name returns a
+    column, indexing with an integer returns a dictionary with the values of a single event as
+    views, and slices return an :py:class:`Events` object with views on all columns. Example:
+
+    .. code-block:: python
+
+        events = NtupleReader("ntup.root", branches=["rechit_energy", "rechit_layer"]).read_events()
+
+        events["rechit_energy"].sum()                    # energy sum per event
+        events["rechit_layer"].bincount(53)              # hits per layer and event
+        events[3]["rechit_energy"]                       # rechit energies of event 3
+
+        events = Events.concatenate([events[:10], events[20:]])
+    """
+
+    def __init__(self, columns=None):
+        super(Events, self).__init__()
+
+        self.columns = collections.OrderedDict(columns or [])
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Creates events from a structured array *records* as returned by root_numpy.
+        """
+        import numpy as np
+
+        columns = collections.OrderedDict()
+        for name in records.dtype.names:
+            col = records[name]
+            if col.dtype.kind == "O":
+                columns[name] = JaggedArray.from_arrays(col)
+            else:
+                columns[name] = np.ascontiguousarray(col)
+        return cls(columns)
+
+    @classmethod
+    def from_cache(cls, cache, branches=None):
+        """
+        Creates events from the memory-mapped arrays of a :py:class:`hgc.ntuple.NtupleCache`
+        without reading or copying data.
+        """
+        columns = collections.OrderedDict()
+        for name in (branches or cache.branches):
+            offsets = cache.offsets(name)
+            arr = cache.array(name)
+            columns[name] = arr if offsets is None else JaggedArray(arr, offsets)
+        return cls(columns)
+
+    @classmethod
+    def concatenate(cls, events):
+        import numpy as np
+
+        events = list(events)
+        columns = collections.OrderedDict()
+        for name, col in events[0].columns.items():
+            cols = [e.columns[name] for e in events]
+            if isinstance(col, JaggedArray):
+                columns[name] = JaggedArray.concatenate(cols)
+            else:
+                columns[name] = np.concatenate(cols)
+        return cls(columns)
+
+    def __len__(self):
+        for col in self.columns.values():
+            return len(col)
+        return 0
+
+    def __repr__(self):
+        return "<{} with {} events and {} branches at {}>".format(self.__class__.__name__,
+            len(self), len(self.columns), hex(id(self)))
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, six.string_types):
+            return self.columns[idx]
+        if isinstance(idx, numbers.Integral):
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError("event index {} out of range".format(idx))
+            return {name: col[idx] for name, col in self.columns.items()}
+        return self.__class__((name, col[idx]) for name, col in self.columns.items())
+
+    def keys(self):
+        return list(self.columns.keys())
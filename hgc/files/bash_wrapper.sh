@@ -6,4 +6,42 @@
 # ensure that PATH is really what we expect
 export PATH="{{env_path}}"
 
-bash "{{job_file}}" $@
+# runs the job script once per branch in parallel processes, at most hgc_parallel_branches at a
+# time, and returns the first non-zero exit code once all branches finished, so that one failed
+# branch does not stop the others, arguments are those of the job script with the branches (4.)
+# as base64 encoded list
+action() {
+    local n_parallel="{{hgc_parallel_branches}}"
+    local branches=( $( echo "$4" | base64 --decode ) )
+
+    # without parallelism, the job script runs all branches sequentially
+    if [ -z "$n_parallel" ] || [ "$n_parallel" -le "1" ] || [ "${#branches[@]}" -le "1" ]; then
+        bash "{{job_file}}" "$@"
+        return "$?"
+    fi
+
+    local pids=()
+    local branch
+    for branch in "${branches[@]}"; do
+        # wait for a free slot, "wait -n" is not available in the bash of CC7
+        while [ "$( jobs -pr | wc -l )" -ge "$n_parallel" ]; do
+            sleep 1
+        done
+        echo "start branch $branch"
+        bash "{{job_file}}" "$1" "$2" "$3" "$( echo -n "$branch" | base64 )" "${@:5}" &
+        pids+=( "$!" )
+    done
+
+    local ret="0"
+    local code
+    local i
+    for i in "${!pids[@]}"; do
+        wait "${pids[$i]}"
+        code="$?"
+        echo "branch ${branches[$i]} finished with exit code $code"
+        [ "$code" != "0" ] && [ "$ret" = "0" ] && ret="$code"
+    done
+
+    return "$ret"
+}
+action "$@"
@@ -0,0 +1,85 @@
+# coding: utf-8
+
+"""
+Writes the environment changes of the setup into a snapshot that setup.sh sources instead of
+running the full setup again. Usage:
+
+    python env_snapshot.py ENV_BEFORE ENV_AFTER SNAPSHOT [PATH ...]
+
+ENV_BEFORE and ENV_AFTER contain the output of "env -0" before and after the setup. Variables that
+were added or changed are exported by the snapshot and removed ones are unset. The modification
+times of all PATHs are stored as checks in the header, so that setup.sh can reject the snapshot
+when one of them changed. The snapshot is written atomically. Only the standard library is used,
+so that this script works with any python in the environment.
+"""
+
+
+import os
+import re
+import sys
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+
+# variables that change with every shell, regardless of the setup
+skip_variables = {"PWD", "OLDPWD", "SHLVL", "_"}
+
+# valid names of shell variables, exported functions are skipped
+variable_cre = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+
+
+def read_env(path):
+    with open(path, "rb") as f:
+        content = f.read()
+    if sys.version_info[0] >= 3:
+        content = content.decode("utf-8", "surrogateescape")
+
+    env = {}
+    for entry in content.split("\0"):
+        name, sep, value = entry.partition("=")
+        if sep and variable_cre.match(name) and name not in skip_variables:
+            env[name] = value
+    return env
+
+
+def main(env_before, env_after, snapshot, *paths):
+    before = read_env(env_before)
+    after = read_env(env_after)
+
+    lines = ["# environment snapshot written by hgc/files/env_snapshot.py"]
+    for path in paths:
+        mtime = str(int(os.stat(path).st_mtime)) if os.path.exists(path) else "-"
+        lines.append("# check {} {}".format(mtime, path))
+    for name in sorted(set(before) - set(after)):
+        lines.append("unset {}".format(name))
+    for name, value in sorted(after.items()):
+        if before.get(name) != value:
+            lines.append("export {}={}".format(name, quote(value)))
+
+    snapshot_dir = os.path.dirname(os.path.abspath(snapshot))
+    if not os.path.exists(snapshot_dir):
+        try:
+            os.makedirs(snapshot_dir)
+        except OSError:
+            # created concurrently by another job
+            if not os.path.isdir(snapshot_dir):
+                raise
+
+    content = "\n".join(lines) + "\n"
+    if sys.version_info[0] >= 3:
+        content = content.encode("utf-8", "surrogateescape")
+
+    tmp_path = "{}.{}.tmp".format(snapshot, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.rename(tmp_path, snapshot)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+    main(*sys.argv[1:])
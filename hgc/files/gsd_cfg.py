@@ -50,6 +50,10 @@ options.register("randomShoot", False, VarParsing.multiplicity.singleton, VarPar
     "shoot a random number of particles between [1, nParticles], 'closeby' gun only")
 options.register("seed", 1, VarParsing.multiplicity.singleton, VarParsing.varType.int,
     "random seed")
+options.register("nThreads", 1, VarParsing.multiplicity.singleton, VarParsing.varType.int,
+    "number of threads")
+options.register("nStreams", 0, VarParsing.multiplicity.singleton, VarParsing.varType.int,
+    "number of streams, 0 means nThreads")
 
 options.parseArguments()
 
@@ -60,11 +64,18 @@ process.FEVTDEBUGHLToutput.fileName = cms.untracked.string(
     "file:{}".format(options.__getattr__("outputFile", noTags=True)))
 process.source.firstLuminosityBlock = cms.untracked.uint32(1)
 
-# random seeds
+# random seeds, note that engines are reseeded per event in multi-threaded mode, so the generated
+# events only depend on the seed, while their order in the output file might vary
 process.RandomNumberGeneratorService.generator.initialSeed = cms.untracked.uint32(options.seed)
 process.RandomNumberGeneratorService.VtxSmeared.initialSeed = cms.untracked.uint32(options.seed)
 process.RandomNumberGeneratorService.mix.initialSeed = cms.untracked.uint32(options.seed)
 
+# multi-threading
+if not hasattr(process, "options"):
+    process.options = cms.untracked.PSet()
+process.options.numberOfThreads = cms.untracked.uint32(options.nThreads)
+process.options.numberOfStreams = cms.untracked.uint32(options.nStreams)
+
 # build the particle id list
 if options.particleIds == "mix":
     if options.exactShoot:
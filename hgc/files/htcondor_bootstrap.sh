@@ -8,6 +8,9 @@
 action() {
     export HGC_ON_HTCONDOR="1"
 
+    # restore the environment from a snapshot of a previous job with the same setup when valid
+    export HGC_ENV_SNAPSHOT="{{hgc_env_snapshot}}"
+
     source "{{hgc_base}}/setup.sh"
 }
 action
@@ -18,6 +18,12 @@ options = VarParsing("python")
 options.setDefault("outputFile", "ntup.root")
 options.setDefault("maxEvents", -1)
 
+# register custom options
+options.register("nThreads", 1, VarParsing.multiplicity.singleton, VarParsing.varType.int,
+    "number of threads")
+options.register("nStreams", 0, VarParsing.multiplicity.singleton, VarParsing.varType.int,
+    "number of streams, 0 means nThreads")
+
 options.parseArguments()
 
 
@@ -29,6 +35,12 @@ process.TFileService = cms.Service("TFileService",
     fileName=cms.string("file:{}".format(options.__getattr__("outputFile", noTags=True))))
 
 
+# multi-threading
+if not hasattr(process, "options"):
+    process.options = cms.untracked.PSet()
+process.options.numberOfThreads = cms.untracked.uint32(options.nThreads)
+process.options.numberOfStreams = cms.untracked.uint32(options.nStreams)
+
 # setup the HGCAL tuple writer
 from FastSimulation.Event.ParticleFilter_cfi import *
 from RecoLocalCalo.HGCalRecProducers.HGCalRecHit_cfi import dEdX
@@ -22,6 +22,11 @@ options.setDefault("maxEvents", -1)
 options.register("outputFileDQM", "dqm.root", VarParsing.multiplicity.singleton,
     VarParsing.varType.string, "path to the DQM output file")
 
+options.register("nThreads", 1, VarParsing.multiplicity.singleton, VarParsing.varType.int,
+    "number of threads")
+options.register("nStreams", 0, VarParsing.multiplicity.singleton, VarParsing.varType.int,
+    "number of streams, 0 means nThreads")
+
 options.parseArguments()
 
 
@@ -33,3 +38,9 @@ process.FEVTDEBUGHLToutput.fileName = cms.untracked.string(
     "file:{}".format(options.__getattr__("outputFile", noTags=True)))
 process.DQMoutput.fileName = cms.untracked.string(
     "file:{}".format(options.outputFileDQM))
+
+# multi-threading
+if not hasattr(process, "options"):
+    process.options = cms.untracked.PSet()
+process.options.numberOfThreads = cms.untracked.uint32(options.nThreads)
+process.options.numberOfStreams = cms.untracked.uint32(options.nStreams)
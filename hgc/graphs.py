@@ -0,0 +1,297 @@
+# coding: utf-8
+
+"""
+Construction of per-event neighbour graphs between rechits using a uniform grid as spatial index.
+Graphs are stored in CSR format, i.e., an ``indptr`` array with ``n_hits + 1`` entries and an
+``indices`` array with the neighbours of hit ``i`` at ``indices[indptr[i]:indptr[i + 1]]``.
+"""
+
+
+__all__ = [
+    "knn_graph", "radius_graph", "knn_graph_brute", "radius_graph_brute", "graph_coordinates",
+    "build_graphs",
+]
+
+
+import os
+import itertools
+import multiprocessing
+
+from hgc.events import local_index
+from hgc.hitlist import feature_branches
+
+
+# names of feature columns of hitlist arrays that are used as coordinates
+graph_coordinates = {
+    "xyz": ["rechit_x", "rechit_y", "rechit_z"],
+    "etaphilayer": ["rechit_eta", "rechit_phi", "rechit_layer"],
+}
+
+
+def _to_csr(n, rows, cols):
+    # rows must be sorted
+    import numpy as np
+
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, cols.astype(np.int32)
+
+
+def _grid_pairs(points, cell_size, queries=None):
+    """
+    Returns all pairs ``(i, j)`` with ``i != j`` of *points* in the same or adjacent cells of a
+    uniform grid with *cell_size*, ordered by ``i`` and then by ``j``. When *queries* is set, only
+    pairs whose first point is among these indices are returned.
+    """
+    import numpy as np
+
+    n, n_dims = points.shape
+    if queries is None:
+        queries = np.arange(n)
+    cells = np.floor((points - points.min(axis=0)) / cell_size).astype(np.int64) + 1
+    dims = cells.max(axis=0) + 2
+
+    def cell_keys(c):
+        key = np.zeros(len(c), dtype=np.int64)
+        for d in range(n_dims):
+            key = key * dims[d] + c[:, d]
+        return key
+
+    keys = cell_keys(cells)
+    order = np.argsort(keys, kind="mergesort")
+    sorted_keys = keys[order]
+
+    rows, cols = [], []
+    for shift in itertools.product((-1, 0, 1), repeat=n_dims):
+        shifted_keys = cell_keys(cells[queries] + np.array(shift, dtype=np.int64))
+        lo = np.searchsorted(sorted_keys, shifted_keys, side="left")
+        hi = np.searchsorted(sorted_keys, shifted_keys, side="right")
+        counts = hi - lo
+        offsets = np.zeros(len(queries) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        rows.append(np.repeat(queries, counts))
+        cols.append(order[np.repeat(lo, counts) + local_index(offsets)])
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    keep = rows != cols
+    rows, cols = rows[keep], cols[keep]
+    pair_order = np.lexsort((cols, rows))
+
+    return rows[pair_order], cols[pair_order]
+
+
+def _distances2(points, rows, cols):
+    import numpy as np
+
+    return ((points[rows] - points[cols])**2).sum(axis=1)
+
+
+def radius_graph(points, radius):
+    """
+    Returns the CSR graph that connects each of the *points* to all other points within *radius*,
+    with neighbours in increasing order of their index.
+    """
+    import numpy as np
+
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    if n < 2:
+        return _to_csr(n, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    # slightly larger cells so that rounding cannot move pairs at the radius apart
+    rows, cols = _grid_pairs(points, radius * (1. + 1e-6))
+    keep = _distances2(points, rows, cols) <= radius**2
+
+    return _to_csr(n, rows[keep], cols[keep])
+
+
+def radius_graph_brute(points, radius):
+    """
+    Same as :py:func:`radius_graph` but compares all pairs of points.
+    """
+    import numpy as np
+
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    rows, cols = np.nonzero(np.ones((n, n), dtype=bool))
+    keep = (rows != cols)
+    rows, cols = rows[keep], cols[keep]
+    keep = _distances2(points, rows, cols) <= radius**2
+
+    return _to_csr(n, rows[keep], cols[keep])
+
+
+def _knn_brute(points, idx, k):
+    # k nearest neighbours of points idx among all points, in increasing order of distance and
+    # index, returned as rows and cols
+    import numpy as np
+
+    n = len(points)
+    rows = np.repeat(idx, n)
+    cols = np.tile(np.arange(n), len(idx))
+    keep = rows != cols
+    rows, cols = rows[keep], cols[keep]
+    d2 = _distances2(points, rows, cols)
+    order = np.lexsort((cols, d2, rows))
+    rows, cols = rows[order], cols[order]
+    offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+    offsets[1:] = np.arange(1, len(idx) + 1) * (n - 1)
+    keep = local_index(offsets) < k
+
+    return rows[keep], cols[keep]
+
+
+def knn_graph(points, k):
+    """
+    Returns the CSR graph that connects each of the *points* to its *k* nearest neighbours, in
+    increasing order of their distance and, for equal distances, their index. Candidates are taken
+    from adjacent cells of a uniform grid. Points whose nearest candidates are not guaranteed to be
+    their nearest neighbours, i.e., in sparse regions, are repeated with twice the cell size until
+    the cells span all points, in which case remaining points are compared to all points.
+    """
+    import numpy as np
+
+    points = np.asarray(points, dtype=np.float64)
+    n, n_dims = points.shape
+    k = min(k, n - 1)
+    if k <= 0:
+        return _to_csr(n, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    # start with cells that are smaller than needed on average to resolve dense regions quickly
+    extent = np.maximum(points.max(axis=0) - points.min(axis=0), 1e-9)
+    cell_size = 0.25 * (np.prod(extent) * k / n)**(1. / n_dims)
+    cell_size = max(cell_size, extent.max() / 1000.)
+
+    all_rows, all_cols = [], []
+    queries = np.arange(n)
+    while len(queries):
+        if cell_size >= extent.max():
+            rows, cols = _knn_brute(points, queries, k)
+            all_rows.append(rows)
+            all_cols.append(cols)
+            break
+
+        # k nearest candidates per point
+        rows, cols = _grid_pairs(points, cell_size, queries)
+        d2 = _distances2(points, rows, cols)
+        order = np.lexsort((cols, d2, rows))
+        rows, cols, d2 = rows[order], cols[order], d2[order]
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=offsets[1:])
+        keep = local_index(offsets) < k
+        rows, cols, d2 = rows[keep], cols[keep], d2[keep]
+
+        # candidates are complete within the distance to the boundary of the adjacent cells,
+        # reduced slightly to account for rounding
+        frac = (points[queries] - points.min(axis=0)) / cell_size
+        frac -= np.floor(frac)
+        safe = cell_size * (1. + np.minimum(frac, 1. - frac).min(axis=1)) * (1. - 1e-6)
+        counts = np.bincount(rows, minlength=n)
+        kth_d2 = np.full(n, np.inf)
+        has_k = counts == k
+        kth_d2[has_k] = d2[np.cumsum(counts)[has_k] - 1]
+        resolved = np.zeros(n, dtype=bool)
+        resolved[queries] = kth_d2[queries] < safe**2
+
+        keep = resolved[rows]
+        all_rows.append(rows[keep])
+        all_cols.append(cols[keep])
+        queries = queries[~resolved[queries]]
+        cell_size *= 2.
+
+    rows = np.concatenate(all_rows)
+    order = np.argsort(rows, kind="mergesort")
+
+    return _to_csr(n, rows[order], np.concatenate(all_cols)[order])
+
+
+def knn_graph_brute(points, k):
+    """
+    Same as :py:func:`knn_graph` but compares all pairs of points.
+    """
+    import numpy as np
+
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    rows, cols = _knn_brute(points, np.arange(n), min(k, max(n - 1, 0)))
+
+    return _to_csr(n, rows, cols)
+
+
+def _build_graph_range(args):
+    import numpy as np
+
+    x_path, n_hits_path, start, stop, columns, mode, value = args
+    x = np.load(x_path, mmap_mode="r")
+    n_hits = np.load(n_hits_path, mmap_mode="r")[start:stop]
+
+    func = knn_graph if mode == "knn" else radius_graph
+    indptrs, indices = [], []
+    for event, n in zip(x[start:stop], n_hits):
+        n = int(n)
+        indptr, idx = func(event[:n, columns], value)
+        padded = np.full(len(event) + 1, indptr[-1], dtype=np.int32)
+        padded[:n + 1] = indptr
+        indptrs.append(padded)
+        indices.append(idx)
+
+    return np.stack(indptrs), indices
+
+
+def build_graphs(x_path, n_hits_path, indptr_path, indices_path, offsets_path, mode="knn", k=8,
+        radius=1., coordinates="xyz", n_workers=1, chunk_size=100):
+    """
+    Builds a graph for each event of the hitlist feature array at *x_path* (see
+    :py:func:`hgc.hitlist.create_hitlist`) with :py:func:`knn_graph` when *mode* is ``"knn"``, or
+    with :py:func:`radius_graph` when it is ``"radius"``, using the feature columns of
+    *coordinates* defined in :py:attr:`graph_coordinates`. Only the first hits of each event are
+    considered as given by the hit counts at *n_hits_path*, i.e., padded hits are skipped, while
+    real hits are kept regardless of their values.
+
+    Three npy files are written. *indptr_path* contains the int32 CSR ``indptr`` arrays of all
+    events with shape ``(n_events, max_hits + 1)``. *indices_path* contains the int32 neighbour
+    indices of all events, and *offsets_path* the int64 offsets of events in the indices array.
+    Events are processed in chunks of *chunk_size* in *n_workers* processes. Returns the number
+    of edges.
+    """
+    import numpy as np
+
+    x_path = os.path.expandvars(os.path.expanduser(x_path))
+    n_hits_path = os.path.expandvars(os.path.expanduser(n_hits_path))
+    x = np.load(x_path, mmap_mode="r")
+    n_events, max_hits = x.shape[:2]
+
+    columns = [feature_branches.index(name) for name in graph_coordinates[coordinates]]
+    value = k if mode == "knn" else radius
+
+    jobs = [
+        (x_path, n_hits_path, start, min(start + chunk_size, n_events), columns, mode, value)
+        for start in range(0, n_events, chunk_size)
+    ]
+
+    indptr_out = np.lib.format.open_memmap(os.path.expandvars(os.path.expanduser(indptr_path)),
+        mode="w+", dtype=np.int32, shape=(n_events, max_hits + 1))
+    offsets = np.zeros(n_events + 1, dtype=np.int64)
+    indices = []
+
+    n_workers = max(1, min(n_workers, len(jobs)))
+    pool = multiprocessing.Pool(n_workers) if n_workers > 1 else None
+    try:
+        results = (pool.imap if pool else map)(_build_graph_range, jobs)
+        for (_, _, start, stop, _, _, _), (indptr, idx) in zip(jobs, results):
+            indptr_out[start:stop] = indptr
+            offsets[start + 1:stop + 1] = [len(i) for i in idx]
+            indices.extend(idx)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    np.cumsum(offsets, out=offsets)
+    indptr_out.flush()
+    np.save(os.path.expandvars(os.path.expanduser(indices_path)),
+        np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32))
+    np.save(os.path.expandvars(os.path.expanduser(offsets_path)), offsets)
+
+    return int(offsets[-1])
@@ -0,0 +1,129 @@
+# coding: utf-8
+
+"""
+Vectorized construction of hitlist training arrays directly from ntuples. The feature order, truth
+definition and padding are defined here and compared to ``TrainData_hitlist`` of HGCalML with
+``python -m hgc.bench.hitlist --parity``.
+"""
+
+
+__all__ = ["feature_branches", "truth_branches", "build_hitlist", "create_hitlist"]
+
+
+import os
+
+from hgc.events import Events, local_index, pad_events
+
+
+# rechit branches that form the features of each hit, in this order
+feature_branches = [
+    "rechit_energy", "rechit_eta", "rechit_phi", "rechit_x", "rechit_y", "rechit_z",
+    "rechit_time", "rechit_layer",
+]
+
+# branches required for the truth, i.e., the energy fractions of hits per simcluster
+truth_branches = ["rechit_detid", "simcluster_energy", "simcluster_hits", "simcluster_fractions"]
+
+
+def build_hitlist(events, max_hits, n_showers):
+    """
+    Builds the hitlist feature and truth arrays for :py:class:`hgc.events.Events` *events* without
+    loops over hits. The features are the values of :py:attr:`feature_branches` of each hit. The
+    truth contains the summed energy fractions of each hit in the *n_showers* most energetic
+    simclusters of the event, in decreasing order of energy, based on the detector ids in
+    ``rechit_detid`` and the doubly nested ``simcluster_hits`` and ``simcluster_fractions``.
+
+    The feature array has the shape ``(n_events, max_hits, n_features)`` and the truth array has
+    the shape ``(n_events, max_hits, n_showers)``. Events with more than *max_hits* hits are
+    truncated. Both arrays are float32.
+    """
+    import numpy as np
+
+    hit_detids = events["rechit_detid"]
+    hit_offsets = hit_detids.offsets - hit_detids.offsets[0]
+    n_hits = int(hit_offsets[-1])
+
+    # features
+    x = np.stack([np.asarray(events[name].flat, dtype=np.float32) for name in feature_branches],
+        axis=-1)
+
+    # simclusters per event and hits per simcluster
+    simcluster_energy = events["simcluster_energy"]
+    simcluster_offsets = simcluster_energy.offsets - simcluster_energy.offsets[0]
+    simcluster_hits = events["simcluster_hits"].flat
+    simcluster_fractions = events["simcluster_fractions"].flat
+
+    # rank simclusters within their event by decreasing energy, ties keep the original order
+    simcluster_event = simcluster_energy.event_index
+    order = np.lexsort((-np.asarray(simcluster_energy.flat, dtype=np.float64), simcluster_event))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = local_index(simcluster_offsets)
+
+    # event and shower slot of all simcluster hits
+    counts = simcluster_hits.counts
+    entry_cluster = np.repeat(np.arange(len(counts)), counts)
+    entry_slot = rank[entry_cluster]
+    entry_event = simcluster_event[entry_cluster]
+
+    # match simcluster hits to rechits by event and detector id
+    hit_event = hit_detids.event_index
+    hit_keys = (hit_event.astype(np.uint64) << np.uint64(32)) | \
+        np.asarray(hit_detids.flat, dtype=np.uint64)
+    entry_keys = (entry_event.astype(np.uint64) << np.uint64(32)) | \
+        np.asarray(simcluster_hits.flat, dtype=np.uint64)
+    hit_order = np.argsort(hit_keys)
+    sorted_keys = hit_keys[hit_order]
+    pos = np.empty(len(entry_keys), dtype=np.int64)
+    entry_order = np.argsort(entry_keys)
+    pos[entry_order] = np.searchsorted(sorted_keys, entry_keys[entry_order])
+    if n_hits:
+        pos[pos >= n_hits] = 0
+        matched = (entry_slot < n_showers) & (sorted_keys[pos] == entry_keys)
+    else:
+        matched = np.zeros(len(entry_keys), dtype=bool)
+
+    # sum fractions per hit and slot, np.add.at adds in order so that duplicates are handled
+    y = np.zeros((n_hits, n_showers), dtype=np.float32)
+    np.add.at(y, (hit_order[pos[matched]], entry_slot[matched]),
+        np.asarray(simcluster_fractions.flat, dtype=np.float32)[matched])
+
+    return pad_events(x, hit_offsets, max_hits), pad_events(y, hit_offsets, max_hits)
+
+
+def create_hitlist(path, x_path, y_path, max_hits, n_showers, treename="ana/hgc",
+        chunk_size=100, n_hits_path=None):
+    """
+    Reads the ntuple at *path* in chunks of *chunk_size* events, builds the hitlist arrays with
+    :py:func:`build_hitlist` and writes them as npy files to *x_path* and *y_path*, which can be
+    memory-mapped with ``numpy.load(path, mmap_mode="r")``. When *n_hits_path* is set, the number
+    of hits of each event, i.e., of entries before the padding, is written to it as an int32 array.
+    Returns the number of events.
+    """
+    import numpy as np
+    from hgc.ntuple import NtupleReader
+
+    reader = NtupleReader(path, treename=treename, branches=feature_branches + truth_branches,
+        chunk_size=chunk_size)
+    n_events = len(reader)
+
+    x_out = np.lib.format.open_memmap(os.path.expandvars(os.path.expanduser(x_path)), mode="w+",
+        dtype=np.float32, shape=(n_events, max_hits, len(feature_branches)))
+    y_out = np.lib.format.open_memmap(os.path.expandvars(os.path.expanduser(y_path)), mode="w+",
+        dtype=np.float32, shape=(n_events, max_hits, n_showers))
+    n_hits = np.zeros(n_events, dtype=np.int32)
+
+    start = 0
+    for chunk in reader.iter_chunks():
+        events = Events.from_records(chunk)
+        x, y = build_hitlist(events, max_hits, n_showers)
+        x_out[start:start + len(chunk)] = x
+        y_out[start:start + len(chunk)] = y
+        n_hits[start:start + len(chunk)] = np.minimum(events["rechit_detid"].counts, max_hits)
+        start += len(chunk)
+
+    x_out.flush()
+    y_out.flush()
+    if n_hits_path:
+        np.save(os.path.expandvars(os.path.expanduser(n_hits_path)), n_hits)
+
+    return n_events
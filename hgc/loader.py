@@ -0,0 +1,321 @@
+# coding: utf-8
+
+"""
+Streaming of shuffled mini-batches from memory-mapped training data shards.
+"""
+
+
+__all__ = [
+    "ShardLoader", "open_shard", "open_npy_shard", "open_deepjetcore_shard", "shards_from_outputs",
+]
+
+
+import os
+import re
+import sys
+import math
+import threading
+import collections
+
+import six
+from six.moves import queue
+
+
+# DeepJetCore files, e.g. the features "<prefix>.x.0" of the "<prefix>.meta" file
+deepjetcore_file_cre = re.compile(r"^(.+)\.(x|y|w)\.(\d+)$")
+
+
+def open_npy_shard(paths):
+    """
+    Memory-maps the npy files at *paths* and returns the arrays as a tuple.
+    """
+    import numpy as np
+
+    return tuple(
+        np.load(os.path.expandvars(os.path.expanduser(path)), mmap_mode="r")
+        for path in paths
+    )
+
+
+def open_deepjetcore_shard(paths):
+    """
+    Reads the DeepJetCore files at *paths*, e.g. the ``.x.0`` and ``.y.0`` files of
+    :py:class:`hgc.tasks.graphnn.CreateMLDataset`, with the ``TrainData`` class of DeepJetCore and
+    returns the arrays as a tuple. Each file ``<prefix>.<kind>.<i>`` refers to the array *i* of the
+    kind (``x``, ``y`` or ``w``) of the ``<prefix>.meta`` file, which is read once. The files are
+    compressed, so the arrays are read into memory instead of being memory-mapped. Requires the
+    DeepJetCore environment.
+    """
+    from DeepJetCore.TrainData import TrainData
+
+    train_data = {}
+    arrays = []
+    for path in paths:
+        m = deepjetcore_file_cre.match(os.path.expandvars(os.path.expanduser(path)))
+        if not m:
+            raise ValueError("{} is not a DeepJetCore file".format(path))
+        prefix, kind, i = m.groups()
+        if prefix not in train_data:
+            train_data[prefix] = TrainData()
+            train_data[prefix].readIn(prefix + ".meta")
+        arrays.append(getattr(train_data[prefix], kind)[int(i)])
+    return tuple(arrays)
+
+
+def open_shard(paths):
+    """
+    Opens the shard at *paths* with :py:func:`open_deepjetcore_shard` when all paths are
+    DeepJetCore files such as ``.x.0``, and with :py:func:`open_npy_shard` otherwise.
+    """
+    if all(deepjetcore_file_cre.match(path) for path in paths):
+        return open_deepjetcore_shard(paths)
+    return open_npy_shard(paths)
+
+
+def shards_from_outputs(outputs, keys=("x", "y")):
+    """
+    Returns a list of shards, i.e., tuples with the paths of the targets *keys*, that are contained
+    in the nested task *outputs*, e.g. of :py:class:`hgc.tasks.hitlist.CreateHitlistDataset`
+    workflows or the chunks of :py:class:`hgc.tasks.graphnn.CreateMLDataset`. Dictionaries are
+    traversed in the order of their keys. The format of the shards is selected by
+    :py:func:`open_shard` from the file names, i.e., npy files are memory-mapped and DeepJetCore
+    files are read with :py:func:`open_deepjetcore_shard`.
+    """
+    outputs = getattr(outputs, "targets", outputs)
+
+    if isinstance(outputs, dict):
+        if all(key in outputs for key in keys):
+            return [tuple(outputs[key].path for key in keys)]
+        outputs = [outputs[key] for key in sorted(outputs)]
+
+    shards = []
+    if isinstance(outputs, (list, tuple)):
+        for output in outputs:
+            shards.extend(shards_from_outputs(output, keys=keys))
+    return shards
+
+
+class ShardLoader(object):
+    """
+    Iterable over mini-batches of *batch_size* samples from *shards*, which are tuples of paths
+    that are opened with *open_shard* and result in arrays with one sample per entry along the first
+    axis, e.g. features and truth. By default, shards are opened with :py:func:`open_shard`, which
+    memory-maps npy files and reads DeepJetCore files into memory. Each batch is a tuple of arrays
+    in the same order. Example:
+
+    .. code-block:: python
+
+        task = CreateHitlistDataset(version="dev", n_events=100, n_tasks=10)
+        loader = ShardLoader(shards_from_outputs(task.output()), batch_size=64, seed=1)
+
+        for epoch in range(10):
+            loader.set_epoch(epoch)
+            for x, y in loader:
+                ...
+
+    Shards are read in contiguous blocks of *block_size* samples. When *shuffle* is *True*, the
+    order of blocks of all shards is shuffled and up to *shuffle_buffer* samples of several blocks
+    are mixed before batches are drawn from them, so that batches contain samples from different
+    shards while the reading stays sequential within blocks. The order is determined by *seed* and
+    the current epoch only.
+
+    When *prefetch* is positive, batches are prepared by a background thread and up to *prefetch*
+    batches are buffered in a bounded queue, so that reading and shuffling overlaps with the
+    consumption of batches. The last incomplete batch is skipped when *drop_last* is *True*.
+
+    At most *max_open_shards* shards are kept open at a time, the least recently used one is closed
+    when another one is opened. During an epoch, shards are also closed once their last block was
+    read.
+    """
+
+    def __init__(self, shards, batch_size=32, shuffle=True, shuffle_buffer=1024, block_size=64,
+            seed=0, prefetch=4, drop_last=False, max_open_shards=4, open_shard=open_shard):
+        super(ShardLoader, self).__init__()
+
+        self.shards = [tuple(shard) for shard in shards]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.block_size = block_size
+        self.seed = seed
+        self.prefetch = prefetch
+        self.drop_last = drop_last
+        self.max_open_shards = max_open_shards
+        self.open_shard = open_shard
+
+        self.epoch = 0
+        self._arrays = collections.OrderedDict()
+        self._lengths = {}
+        # shards are opened and closed by the prefetching thread as well
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        n = self.n_samples
+        if self.drop_last:
+            return n // self.batch_size
+        return int(math.ceil(float(n) / self.batch_size))
+
+    def __iter__(self):
+        if self.prefetch > 0:
+            return self.iter_prefetched()
+        return self.iter_batches()
+
+    def set_epoch(self, epoch):
+        """
+        Sets the *epoch* that determines the shuffling together with :py:attr:`seed`.
+        """
+        self.epoch = epoch
+
+    def shard_arrays(self, i):
+        """
+        Returns the arrays of shard *i*, which are kept open until more than
+        :py:attr:`max_open_shards` shards are open and shard *i* is the least recently used one.
+        """
+        with self._lock:
+            arrays = self._arrays.pop(i, None)
+            if arrays is None:
+                arrays = tuple(self.open_shard(self.shards[i]))
+                if len(set(len(arr) for arr in arrays)) > 1:
+                    raise Exception("arrays of shard {} have different lengths".format(
+                        self.shards[i]))
+                self._lengths[i] = len(arrays[0])
+            self._arrays[i] = arrays
+
+            while len(self._arrays) > max(self.max_open_shards, 1):
+                self._arrays.popitem(last=False)
+
+        return arrays
+
+    def close_shard(self, i):
+        """
+        Closes shard *i* when it is open, its arrays are freed once they are no longer referenced.
+        """
+        with self._lock:
+            self._arrays.pop(i, None)
+
+    def shard_length(self, i):
+        """
+        Returns the number of samples of shard *i*, which opens the shard only once.
+        """
+        if i not in self._lengths:
+            self.shard_arrays(i)
+        return self._lengths[i]
+
+    @property
+    def n_samples(self):
+        return sum(self.shard_length(i) for i in range(len(self.shards)))
+
+    def blocks(self, rnd=None):
+        """
+        Returns a list of ``(shard, start, stop)`` tuples that cover all samples in blocks of
+        :py:attr:`block_size`, in random order when a random state *rnd* is given.
+        """
+        blocks = []
+        for i in range(len(self.shards)):
+            n = self.shard_length(i)
+            blocks.extend((i, start, min(start + self.block_size, n))
+                for start in range(0, n, self.block_size))
+
+        if rnd is not None:
+            blocks = [blocks[j] for j in rnd.permutation(len(blocks))]
+
+        return blocks
+
+    def _drain(self, buf, rnd, keep):
+        # shuffles the buffered blocks and splits them into full batches, keeping at least keep
+        # samples (or, when keep is None, all samples in possibly incomplete last batch)
+        import numpy as np
+
+        samples = [np.concatenate(column) for column in zip(*buf)]
+        n = len(samples[0])
+        if rnd is not None:
+            perm = rnd.permutation(n)
+            samples = [arr[perm] for arr in samples]
+
+        if keep is None:
+            n_batches = n // self.batch_size if self.drop_last else \
+                int(math.ceil(float(n) / self.batch_size))
+            n_drained = n
+        else:
+            n_batches = max(n - keep, 0) // self.batch_size
+            n_drained = n_batches * self.batch_size
+
+        batches = [
+            tuple(arr[j * self.batch_size:(j + 1) * self.batch_size] for arr in samples)
+            for j in range(n_batches)
+        ]
+        rest = [tuple(arr[n_drained:] for arr in samples)] if n_drained < n else []
+
+        return batches, rest
+
+    def iter_batches(self):
+        """
+        Yields all batches of the current epoch in the calling thread.
+        """
+        import numpy as np
+
+        rnd = np.random.RandomState([self.seed, self.epoch]) if self.shuffle else None
+        capacity = max(self.shuffle_buffer, self.batch_size) if self.shuffle else self.batch_size
+        keep = capacity // 2 if self.shuffle else 0
+
+        blocks = self.blocks(rnd)
+        last_block = {i: j for j, (i, _, _) in enumerate(blocks)}
+
+        buf, n_buf = [], 0
+        for j, (i, start, stop) in enumerate(blocks):
+            buf.append(tuple(np.array(arr[start:stop]) for arr in self.shard_arrays(i)))
+            n_buf += stop - start
+            if last_block[i] == j:
+                self.close_shard(i)
+            if n_buf >= capacity:
+                batches, buf = self._drain(buf, rnd, keep)
+                n_buf = sum(len(block[0]) for block in buf)
+                for batch in batches:
+                    yield batch
+
+        if buf:
+            batches, _ = self._drain(buf, rnd, None)
+            for batch in batches:
+                yield batch
+
+    def iter_prefetched(self):
+        """
+        Yields all batches of the current epoch, prepared in a background thread.
+        """
+        end = object()
+        q = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.iter_batches():
+                    if not put((batch, None)):
+                        return
+                put((end, None))
+            except Exception:
+                put((None, sys.exc_info()))
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                batch, exc_info = q.get()
+                if exc_info:
+                    six.reraise(*exc_info)
+                if batch is end:
+                    break
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
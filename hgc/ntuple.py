@@ -0,0 +1,290 @@
+# coding: utf-8
+
+"""
+Chunked and branch-selective reading of ntuples.
+"""
+
+
+__all__ = ["NtupleReader", "create_ntuple_cache", "NtupleCache"]
+
+
+import os
+import json
+import collections
+
+
+class NtupleReader(object):
+    """
+    Reader for the tree *treename* in the file at *path* that only loads the given *branches* and
+    reads events in chunks of *chunk_size*, so that the memory consumption does not depend on the
+    size of the file. Chunks are structured numpy arrays as returned by root_numpy. Example:
+
+    .. code-block:: python
+
+        reader = NtupleReader("ntup.root", branches=["rechit_eta", "rechit_phi"])
+
+        # iterate lazily over events
+        for event in reader:
+            print(event["rechit_eta"].shape)
+
+        # iterate over chunks of events 100 to 200
+        for chunk in reader.iter_chunks(100, 200):
+            ...
+    """
+
+    def __init__(self, path, treename="ana/hgc", branches=None, chunk_size=100):
+        super(NtupleReader, self).__init__()
+
+        self.path = os.path.expandvars(os.path.expanduser(path))
+        self.treename = treename
+        self.branches = list(branches) if branches else None
+        self.chunk_size = chunk_size
+
+        self._n_entries = None
+
+    def __len__(self):
+        if self._n_entries is None:
+            import ROOT
+
+            f = ROOT.TFile.Open(self.path)
+            try:
+                tree = f.Get(self.treename)
+                if not tree:
+                    raise Exception("tree {} not found in {}".format(self.treename, self.path))
+                self._n_entries = int(tree.GetEntries())
+            finally:
+                f.Close()
+
+        return self._n_entries
+
+    def __iter__(self):
+        return self.iter_events()
+
+    def read(self, start=0, stop=None):
+        """
+        Reads and returns the events from *start* to *stop* at once.
+        """
+        import root_numpy
+
+        stop = len(self) if stop is None else min(stop, len(self))
+        return root_numpy.root2array(self.path, treename=self.treename, branches=self.branches,
+            start=start, stop=stop)
+
+    def read_events(self, start=0, stop=None):
+        """
+        Reads the events from *start* to *stop* at once and returns them as
+        :py:class:`hgc.events.Events`.
+        """
+        from hgc.events import Events
+
+        return Events.from_records(self.read(start, stop))
+
+    def iter_chunks(self, start=0, stop=None):
+        """
+        Yields chunks of at most :py:attr:`chunk_size` events from *start* to *stop*.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        for chunk_start in range(start, stop, self.chunk_size):
+            yield self.read(chunk_start, min(chunk_start + self.chunk_size, stop))
+
+    def iter_events(self, start=0, stop=None):
+        """
+        Yields single events from *start* to *stop*, reading them in chunks.
+        """
+        for chunk in self.iter_chunks(start, stop):
+            for event in chunk:
+                yield event
+
+
+def create_ntuple_cache(path, cache_dir, treename="ana/hgc", branches=None, chunk_size=1000):
+    """
+    Converts the tree *treename* in the file at *path* into a columnar cache in the directory
+    *cache_dir* that can be memory-mapped by :py:class:`NtupleCache`. Each branch is stored as a
+    flat binary array. Jagged branches additionally refer to an int64 offsets array that is shared
+    by all branches of the same collection (i.e., the same prefix such as ``rechit``) with equal
+    per-event lengths. Branches with more than one level of nesting are skipped. When *branches*
+    is not set, all branches are converted. The tree is read in chunks of *chunk_size* events.
+    """
+    import numpy as np
+    import root_numpy
+
+    path = os.path.expandvars(os.path.expanduser(path))
+    cache_dir = os.path.expandvars(os.path.expanduser(cache_dir))
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    if branches is None:
+        branches = root_numpy.list_branches(path, treename)
+    reader = NtupleReader(path, treename=treename, branches=branches, chunk_size=chunk_size)
+
+    dtypes = {}
+    sizes = collections.defaultdict(int)
+    counts = collections.defaultdict(list)
+    skipped = set()
+    files = {}
+
+    def skip(name):
+        skipped.add(name)
+        dtypes.pop(name, None)
+        counts.pop(name, None)
+        if name in files:
+            files.pop(name).close()
+            os.remove(os.path.join(cache_dir, name + ".bin"))
+
+    try:
+        for chunk in reader.iter_chunks():
+            for name in branches:
+                if name in skipped:
+                    continue
+
+                col = chunk[name]
+                if col.dtype.kind == "O":
+                    # jagged branch
+                    values = np.concatenate(list(col)) if len(col) else np.array([])
+                    if values.dtype.kind == "O":
+                        skip(name)
+                        continue
+                    counts[name].append(np.array([len(v) for v in col], dtype=np.int64))
+                else:
+                    values = col
+
+                if name not in dtypes:
+                    dtypes[name] = values.dtype
+                    files[name] = open(os.path.join(cache_dir, name + ".bin"), "wb")
+                files[name].write(np.ascontiguousarray(values, dtype=dtypes[name]).tobytes())
+                sizes[name] += len(values)
+    finally:
+        for f in files.values():
+            f.close()
+
+    # build offsets, shared between branches of the same collection when possible
+    offsets = {}
+    branch_offsets = {}
+    for name in branches:
+        if name not in counts:
+            continue
+        arr = np.zeros(len(reader) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(counts[name]), out=arr[1:])
+
+        key = name.split("_", 1)[0]
+        if key in offsets and not np.array_equal(offsets[key], arr):
+            key = name
+        if key not in offsets:
+            offsets[key] = arr
+            arr.tofile(os.path.join(cache_dir, key + ".offsets.bin"))
+        branch_offsets[name] = key
+
+    # write the meta data last so that it marks a complete cache
+    meta = {
+        "treename": treename,
+        "n_events": len(reader),
+        "branches": collections.OrderedDict(
+            (name, {
+                "dtype": dtypes[name].str,
+                "size": sizes[name],
+                "offsets": branch_offsets.get(name),
+            })
+            for name in branches if name in dtypes
+        ),
+        "skipped": sorted(skipped),
+    }
+    with open(os.path.join(cache_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+
+    return meta
+
+
+class NtupleCache(object):
+    """
+    Loader of a columnar cache created by :py:func:`create_ntuple_cache` that memory-maps flat
+    branch arrays on first access and provides random access to single events through views on
+    these arrays, i.e., without copying data. Example:
+
+    .. code-block:: python
+
+        cache = NtupleCache("ntup_0_n10")
+
+        event = cache[3]
+        event["rechit_energy"].sum()
+
+        # flat array of all rechit energies and the offsets to split them into events
+        energy = cache.array("rechit_energy")
+        offsets = cache.offsets("rechit_energy")
+    """
+
+    def __init__(self, path):
+        super(NtupleCache, self).__init__()
+
+        self.path = os.path.expandvars(os.path.expanduser(path))
+        with open(os.path.join(self.path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+
+        self._arrays = {}
+
+    def __len__(self):
+        return self.meta["n_events"]
+
+    def __getitem__(self, idx):
+        return self.event(idx)
+
+    @property
+    def branches(self):
+        return list(self.meta["branches"])
+
+    def _map(self, basename, dtype, size):
+        import numpy as np
+
+        if basename not in self._arrays:
+            if size == 0:
+                arr = np.empty(0, dtype=dtype)
+            else:
+                arr = np.memmap(os.path.join(self.path, basename), dtype=dtype, mode="r",
+                    shape=(size,))
+            self._arrays[basename] = arr
+        return self._arrays[basename]
+
+    def array(self, name):
+        """
+        Returns the flat array of branch *name*.
+        """
+        info = self.meta["branches"][name]
+        return self._map(name + ".bin", info["dtype"], info["size"])
+
+    def offsets(self, name):
+        """
+        Returns the int64 offsets array with ``n_events + 1`` entries of the jagged branch *name*
+        or *None* when the branch is not jagged.
+        """
+        key = self.meta["branches"][name]["offsets"]
+        if key is None:
+            return None
+        return self._map(key + ".offsets.bin", "<i8", len(self) + 1)
+
+    def events(self, branches=None):
+        """
+        Returns all events as :py:class:`hgc.events.Events` with columns that are memory-mapped.
+        """
+        from hgc.events import Events
+
+        return Events.from_cache(self, branches=branches)
+
+    def event(self, idx, branches=None):
+        """
+        Returns a dictionary that maps names of *branches* (all by default) to the values of event
+        *idx*. Values of jagged branches are views on the flat arrays.
+        """
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("event index {} out of range".format(idx))
+
+        event = {}
+        for name in (branches or self.branches):
+            arr = self.array(name)
+            offsets = self.offsets(name)
+            if offsets is None:
+                event[name] = arr[idx]
+            else:
+                event[name] = arr[offsets[idx]:offsets[idx + 1]]
+
+        return event
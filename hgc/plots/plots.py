@@ -4,41 +4,57 @@
 Collection of plot functions.
 """
 
-__all__ = ["particle_rechit_eta_phi_plot"]
+__all__ = ["particle_rechit_eta_phi_plot", "particle_rechit_eta_phi_plots"]
 
 
+import numpy as np
 import plotlib.root as r
 import ROOT
 
 
-def particle_rechit_eta_phi_plot(event, particle_name, plot_path):
-    r.setup_style()
-    canvas, (pad,) = r.routines.create_canvas()
-    pad.cd()
+# canvas, pad and histogram objects that are reused across plots
+_eta_phi_objects = None
+
+
+def _get_eta_phi_objects():
+    global _eta_phi_objects
 
-    n_particles = event[particle_name + "_energy"].shape[0]
-    n_rechits = event["rechit_z"].shape[0]
+    if _eta_phi_objects is None:
+        ROOT.gROOT.SetBatch(True)
+        r.setup_style()
+        canvas, (pad,) = r.routines.create_canvas()
 
-    binning = (1, 0., 4.0, 1, -3.2, 3.2)
-    dummy_hist = ROOT.TH2F("h", ";#eta;#phi;Entries", *binning)
-    particle0_graph = ROOT.TGraph(1)
-    particle_graph = ROOT.TGraph(n_particles)
-    rechit_graph = ROOT.TGraph(n_rechits)
+        binning = (1, 0., 4.0, 1, -3.2, 3.2)
+        dummy_hist = ROOT.TH2F("h", ";#eta;#phi;Entries", *binning)
+        dummy_hist.SetDirectory(0)
+        r.setup_hist(dummy_hist, pad=pad)
 
-    for j in range(n_particles):
-        eta, phi = event[particle_name + "_eta"][j], event[particle_name + "_phi"][j]
-        if j == 0:
-            particle0_graph.SetPoint(j, eta, phi)
-        particle_graph.SetPoint(j, eta, phi)
+        _eta_phi_objects = (canvas, pad, dummy_hist)
 
-    for j in range(n_rechits):
-        eta, phi = event["rechit_eta"][j], event["rechit_phi"][j]
-        rechit_graph.SetPoint(j, eta, phi)
+    return _eta_phi_objects
 
-    r.setup_hist(dummy_hist, pad=pad)
-    r.setup_graph(particle0_graph, {"MarkerSize": 1.5, "MarkerColor": 3})
-    r.setup_graph(particle_graph, {"MarkerSize": 1.5})
-    r.setup_graph(rechit_graph, {"MarkerSize": 0.25, "MarkerColor": 2})
+
+def _create_graph(x, y, props):
+    # build the graph from contiguous arrays in one call instead of one SetPoint per point
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    graph = ROOT.TGraph(len(x), x, y) if len(x) else ROOT.TGraph()
+    r.setup_graph(graph, props)
+    return graph
+
+
+def particle_rechit_eta_phi_plot(event, particle_name, plot_path):
+    canvas, pad, dummy_hist = _get_eta_phi_objects()
+    pad.cd()
+
+    particle_eta = event[particle_name + "_eta"]
+    particle_phi = event[particle_name + "_phi"]
+
+    particle0_graph = _create_graph(particle_eta[:1], particle_phi[:1],
+        {"MarkerSize": 1.5, "MarkerColor": 3})
+    particle_graph = _create_graph(particle_eta, particle_phi, {"MarkerSize": 1.5})
+    rechit_graph = _create_graph(event["rechit_eta"], event["rechit_phi"],
+        {"MarkerSize": 0.25, "MarkerColor": 2})
 
     dummy_hist.Draw()
     rechit_graph.Draw("P")
@@ -47,3 +63,13 @@ def particle_rechit_eta_phi_plot(event, particle_name, plot_path):
 
     r.update_canvas(canvas)
     canvas.SaveAs(plot_path)
+
+
+def particle_rechit_eta_phi_plots(events, particle_name, plot_paths):
+    """
+    Creates the plots of :py:func:`particle_rechit_eta_phi_plot` for all *events*, e.g.
+    :py:class:`hgc.events.Events`, and saves them at the corresponding *plot_paths*. Can be used as
+    a process pool target.
+    """
+    for event, plot_path in zip(events, plot_paths):
+        particle_rechit_eta_phi_plot(event, particle_name, plot_path)
@@ -0,0 +1,254 @@
+# coding: utf-8
+
+"""
+Measurement and bookkeeping of resources used by tasks. This file only depends on the standard
+library as it is also executed as a script that runs a command and measures its resources, see
+:py:func:`main`.
+"""
+
+
+__all__ = ["resource_usage", "ResourceHistory", "apply_margin", "wrap_cmd", "main"]
+
+
+import os
+import sys
+import json
+import math
+import time
+import signal
+import resource
+import argparse
+import subprocess
+
+
+def resource_usage():
+    """
+    Returns a dictionary with the cpu time in seconds used by this process and all its waited-for
+    children (``cpu_time``). The peak resident memory is not included as ``ru_maxrss`` refers to
+    the whole lifetime of the process, so it is measured per command by :py:func:`main` instead.
+    """
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu_time = usage_self.ru_utime + usage_self.ru_stime
+    cpu_time += usage_children.ru_utime + usage_children.ru_stime
+
+    return {"cpu_time": cpu_time}
+
+
+class ResourceHistory(object):
+    """
+    History of resources used by branches of a task family, stored as json lines in the file
+    ``$HGC_DATA/resource_history/<task_family>.jsonl``. Each record contains a *key* dictionary of
+    parameters that are significant for the resource usage and the measured values. Example:
+
+    .. code-block:: python
+
+        history = ResourceHistory("sim.GSDTask")
+        history.record({"n_events": 10}, wall_time=120., cpu_time=110., max_rss=1500.)
+
+        history.estimate({"n_events": 10})
+        # -> {"wall_time": 120., "cpu_time": 110., "max_rss": 1500., "n_records": 1}
+
+    The parsed records are cached per process and only read again when the file changed. Once the
+    file is larger than *max_size* bytes, it is compacted to the last *keep* records per key when
+    recording.
+    """
+
+    # parsed records per path, mapping to a tuple (mtime, size, records)
+    _cache = {}
+
+    def __init__(self, task_family, directory="$HGC_DATA/resource_history", max_size=2 * 1024**2,
+            keep=50):
+        super(ResourceHistory, self).__init__()
+
+        directory = os.path.expandvars(os.path.expanduser(directory))
+        self.path = os.path.join(directory, task_family + ".jsonl")
+        self.max_size = max_size
+        self.keep = keep
+
+    @classmethod
+    def _key_str(cls, key):
+        return json.dumps(key, sort_keys=True)
+
+    def record(self, key, **values):
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # might have been created concurrently
+                pass
+
+        line = json.dumps({"key": self._key_str(key), "values": values}) + "\n"
+        # a single small write in append mode does not interleave with concurrent writers
+        with open(self.path, "a") as f:
+            f.write(line)
+            size = f.tell()
+
+        if self.max_size and size > self.max_size:
+            self.compact()
+
+    def read(self):
+        """
+        Returns a list of all records as dictionaries with the fields ``key`` (the json encoded
+        key) and ``values``, read from the file only when it changed since the last call.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return []
+
+        cached = self._cache.get(self.path)
+        if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+
+        records = []
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    continue
+                if "key" in data and "values" in data:
+                    records.append(data)
+        self._cache[self.path] = (stat.st_mtime, stat.st_size, records)
+
+        return records
+
+    def compact(self):
+        """
+        Rewrites the file with only the last :py:attr:`keep` records per key. Records that are
+        appended concurrently by other processes during the rewrite might be lost, which only
+        slightly affects the estimates.
+        """
+        records = self.read()
+        counts = {}
+        kept = []
+        for data in reversed(records):
+            counts[data["key"]] = counts.get(data["key"], 0) + 1
+            if counts[data["key"]] <= self.keep:
+                kept.append(data)
+
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "w") as f:
+            for data in reversed(kept):
+                f.write(json.dumps(data) + "\n")
+        os.rename(tmp_path, self.path)
+
+    def lookup(self, key, n=20, partial=False):
+        """
+        Returns the values of the last *n* records with a matching *key*. When *partial* is
+        *True*, records match when their keys contain all items of *key*.
+        """
+        key_str = self._key_str(key)
+        records = []
+        for data in self.read():
+            if partial:
+                record_key = json.loads(data["key"])
+                if any(k not in record_key or record_key[k] != v for k, v in key.items()):
+                    continue
+            elif data["key"] != key_str:
+                continue
+            records.append(data["values"])
+
+        return records[-n:]
+
+    def estimate(self, key, n=20):
+        """
+        Returns the maximum of each value over the last *n* records with a matching *key*, plus the
+        number of considered records as ``n_records``, or *None* when there are no records.
+        """
+        records = self.lookup(key, n=n)
+        if not records:
+            return None
+
+        estimate = {"n_records": len(records)}
+        for name in set(name for values in records for name in values):
+            values = [values[name] for values in records if values.get(name) is not None]
+            if values:
+                estimate[name] = max(values)
+
+        return estimate
+
+
+def apply_margin(value, margin):
+    return int(math.ceil(value * (1. + margin)))
+
+
+def wrap_cmd(cmd, stats_path, label=None):
+    """
+    Returns a command that runs the shell command *cmd* through this file as a script, which
+    writes the resources used by the command to *stats_path* in json format.
+    """
+    try:
+        from shlex import quote
+    except ImportError:
+        from pipes import quote
+
+    script = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+    args = [sys.executable, script, "--output", stats_path]
+    if label:
+        args.extend(["--label", label])
+    args.extend(["--", cmd])
+
+    return " ".join(quote(arg) for arg in args)
+
+
+def main(argv=None):
+    """
+    Runs a shell command, waits for it with ``os.wait4`` to obtain the resources used by the
+    command and all its waited-for descendants, writes them in json format to a file and exits
+    with the exit code of the command. Signals are forwarded to the command.
+    """
+    parser = argparse.ArgumentParser(description="run a command and measure its resources")
+    parser.add_argument("--output", "-o", required=True, help="the json file to write")
+    parser.add_argument("--label", "-l", default=None, help="a label to store")
+    parser.add_argument("cmd", help="the command to run in bash")
+    args = parser.parse_args(argv)
+
+    t0 = time.time()
+    p = subprocess.Popen(args.cmd, shell=True, executable="/bin/bash")
+
+    def forward(signum, frame):
+        p.send_signal(signum)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, forward)
+
+    while True:
+        try:
+            _, status, usage = os.wait4(p.pid, 0)
+            break
+        except OSError as e:
+            # interrupted system call in python 2
+            if e.errno != 4:
+                raise
+    wall_time = time.time() - t0
+
+    if os.WIFSIGNALED(status):
+        code = 128 + os.WTERMSIG(status)
+    else:
+        code = os.WEXITSTATUS(status)
+
+    stats = {
+        "label": args.label,
+        "cmd": args.cmd.strip()[:1000],
+        "exit_code": code,
+        "start_time": t0,
+        "wall_time": wall_time,
+        "user_time": usage.ru_utime,
+        "sys_time": usage.ru_stime,
+        # ru_maxrss is given in kB on linux
+        "max_rss": usage.ru_maxrss / 1024.,
+        # block counts are given in units of 512 bytes
+        "read_bytes": usage.ru_inblock * 512,
+        "write_bytes": usage.ru_oublock * 512,
+    }
+    with open(args.output, "w") as f:
+        json.dump(stats, f, indent=4)
+
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,11 +10,18 @@ __all__ = ["Task", "HTCondorWorkflow"]
 
 import os
 import math
+import functools
 
 import law
 import luigi
 
-law.contrib.load("htcondor", "tasks", "telegram", "root")
+from hgc.util import (
+    path_exists_cached, start_resource_accounting, stop_resource_accounting, staged_targets,
+)
+from hgc.resources import resource_usage, ResourceHistory, apply_margin
+
+# only load contribs whose classes are needed to define tasks, others are loaded where needed
+law.contrib.load("htcondor", "tasks", "telegram")
 
 
 class Task(law.Task):
@@ -63,6 +70,85 @@ class Task(law.Task):
         cls = law.LocalDirectoryTarget if kwargs.pop("dir", False) else law.LocalFileTarget
         return cls(self.local_path(*args, store=kwargs.pop("store", None)), **kwargs)
 
+    def complete(self):
+        # check the existence of local outputs of non-workflow tasks with cached directory
+        # listings that are validated by the directory mtime, so that checking many branches only
+        # requires one listing per directory
+        if isinstance(self, law.BaseWorkflow) and self.is_workflow():
+            return super(Task, self).complete()
+
+        targets = flatten_targets(self.output())
+        local_types = (law.LocalFileTarget, law.LocalDirectoryTarget)
+        if not targets or not all(isinstance(t, local_types) for t in targets):
+            return super(Task, self).complete()
+
+        return all(path_exists_cached(t.path) for t in targets)
+
+    def resource_sidecar(self):
+        # json file next to the first local output file in which the resources used by commands
+        # are stored, see hgc.util.accounted_popen, only for branches of workflows that record
+        # their resources in the history, so that no files end up in e.g. software submodules
+        if not isinstance(self, HTCondorWorkflow) or not self.is_branch():
+            return None
+        if self.resource_history_key() is None:
+            return None
+        for target in flatten_targets(self.output()):
+            if isinstance(target, law.LocalFileTarget):
+                return law.LocalFileTarget(target.path + ".resources.json")
+        return None
+
+
+@Task.event_handler(luigi.Event.START)
+def start_resource_accounting_on_start(task):
+    task._resource_records = start_resource_accounting()
+
+
+@Task.event_handler(luigi.Event.SUCCESS)
+def write_resource_sidecar_on_success(task):
+    records = getattr(task, "_resource_records", None)
+    if records is None:
+        return
+    stop_resource_accounting(records)
+
+    sidecar = task.resource_sidecar() if records else None
+    if sidecar:
+        sidecar.dump(records, formatter="json", indent=4)
+
+
+@Task.event_handler(luigi.Event.FAILURE)
+def stop_resource_accounting_on_failure(task, exception):
+    records = getattr(task, "_resource_records", None)
+    if records is not None:
+        stop_resource_accounting(records)
+
+
+def flatten_targets(struct):
+    targets = []
+    for target in law.util.flatten(struct):
+        if isinstance(target, law.TargetCollection):
+            targets.extend(flatten_targets(target.targets))
+        else:
+            targets.append(target)
+    return targets
+
+
+def stage_outputs(fn):
+    """
+    Decorator for task methods that makes ``task.output()`` return temporary local targets during
+    the call, which are staged to the actual outputs afterwards using
+    :py:func:`hgc.util.staged_targets`. Outputs on the same device are renamed instead of copied.
+    """
+    @functools.wraps(fn)
+    def wrapper(task, *args, **kwargs):
+        with staged_targets(task.output()) as tmp_outputs:
+            task.output = lambda: tmp_outputs
+            try:
+                return fn(task, *args, **kwargs)
+            finally:
+                del task.output
+
+    return wrapper
+
 
 class HTCondorWorkflow(law.HTCondorWorkflow):
     """
@@ -75,8 +161,21 @@ class HTCondorWorkflow(law.HTCondorWorkflow):
         "runtime in hours")
     only_missing = luigi.BoolParameter(default=True, significant=False, description="skip tasks "
         "that are considered complete")
+    parallel_branches = luigi.IntParameter(default=0, significant=False, description="number of "
+        "branches that are run in parallel processes within a job when --tasks-per-job is larger "
+        "than one, 0 means all, default: 0")
+    resource_history = luigi.BoolParameter(default=True, significant=False, description="record "
+        "resources used by branches and use them to set job requirements, default: True")
+    resource_margin = luigi.FloatParameter(default=0.3, significant=False, description="relative "
+        "safety margin added to resources taken from the history, default: 0.3")
     cmst3 = luigi.BoolParameter(default=False, significant=False, description="use the CMS T3 "
         "HTCondor quota for jobs, default: False")
+    env_snapshot = luigi.BoolParameter(default=True, significant=False, description="let jobs "
+        "restore the environment from a snapshot written by a previous job with the same setup "
+        "instead of running the full setup, default: True")
+
+    # time in seconds added to runtimes taken from the history for the job setup and stageout
+    htcondor_runtime_overhead = 1800
 
     def htcondor_output_directory(self):
         return law.LocalDirectoryTarget(self.local_path(store="$HGC_STORE"))
@@ -90,6 +189,27 @@ class HTCondorWorkflow(law.HTCondorWorkflow):
     def htcondor_use_local_scheduler(self):
         return True
 
+    def htcondor_request_cpus(self):
+        # number of cpus to request per branch
+        return 1
+
+    def resource_history_key(self):
+        # parameters that determine the resources used by a branch, None disables the history
+        return None
+
+    def resource_history_values(self, processing_time):
+        # additional values to store in the resource history
+        return {}
+
+    def resource_estimate(self):
+        # returns the maximum resources used by previous branches with the same parameters, which
+        # is determined once per workflow and reused for all its jobs
+        if not hasattr(self, "_resource_estimate"):
+            key = self.resource_history_key() if self.resource_history else None
+            self._resource_estimate = None if key is None else \
+                ResourceHistory(self.task_family).estimate(key)
+        return self._resource_estimate
+
     def htcondor_job_config(self, config, job_num, branches):
         # render_data is rendered into all files sent with a job
         config.render_variables["hgc_base"] = os.getenv("HGC_BASE")
@@ -103,10 +223,65 @@ class HTCondorWorkflow(law.HTCondorWorkflow):
         # the CERN htcondor setup requires a "log" config, but we can safely set it to /dev/null
         # if you are interested in the logs of the batch system itself, set a meaningful value here
         config.custom_content.append(("log", "/dev/null"))
+        # run branches packed into one job in parallel processes, each running the job script for
+        # one branch, at most n_workers at a time, see the wrapper file
+        n_workers = min(self.parallel_branches or len(branches), len(branches))
+        n_sequential = int(math.ceil(float(len(branches)) / n_workers))
+        config.render_variables["hgc_parallel_branches"] = str(n_workers)
+        config.render_variables["hgc_env_snapshot"] = "1" if self.env_snapshot else "0"
+        # determine requirements, refined by resources used by previous branches, if any
+        max_runtime = int(math.floor(self.max_runtime * 3600)) - 1
+        request_cpus = self.htcondor_request_cpus()
+        request_memory = None
+        estimate = self.resource_estimate()
+        if estimate:
+            margin = self.resource_margin
+            if estimate.get("wall_time"):
+                runtime = apply_margin(estimate["wall_time"], margin) * n_sequential
+                runtime += self.htcondor_runtime_overhead
+                max_runtime = min(max_runtime, runtime)
+                if estimate.get("cpu_time"):
+                    cpus = apply_margin(estimate["cpu_time"] / estimate["wall_time"], margin)
+                    request_cpus = max(1, min(request_cpus, cpus))
+            if estimate.get("max_rss"):
+                request_memory = apply_margin(estimate["max_rss"], margin) * n_workers
         # set the maximum runtime
-        config.custom_content.append(("+MaxRuntime", int(math.floor(self.max_runtime * 3600)) - 1))
+        config.custom_content.append(("+MaxRuntime", max_runtime))
+        # request multiple cpus
+        request_cpus *= n_workers
+        if request_cpus > 1:
+            config.custom_content.append(("request_cpus", request_cpus))
+        # request memory in MB
+        if request_memory:
+            config.custom_content.append(("request_memory", request_memory))
         # CMS T3 group settings
         if self.cmst3:
             config.custom_content.append(("+AccountingGroup", "group_u_CMST3.all"))
 
         return config
+
+
+@HTCondorWorkflow.event_handler(luigi.Event.START)
+def store_resource_usage_on_start(task):
+    task._resource_usage_start = resource_usage()
+
+
+@HTCondorWorkflow.event_handler(luigi.Event.PROCESSING_TIME)
+def record_resource_usage(task, processing_time):
+    if not task.is_branch() or not task.resource_history:
+        return
+    key = task.resource_history_key()
+    if key is None:
+        return
+
+    usage = resource_usage()
+    start = getattr(task, "_resource_usage_start", None)
+    if start:
+        usage["cpu_time"] -= start["cpu_time"]
+    # peak memory of the commands run by this branch, measured per command as the process itself
+    # might have run other branches before
+    records = getattr(task, "_resource_records", None)
+    if records:
+        usage["max_rss"] = max(r["max_rss"] for r in records)
+    usage.update(task.resource_history_values(processing_time))
+    ResourceHistory(task.task_family).record(key, wall_time=processing_time, **usage)
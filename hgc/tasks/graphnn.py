@@ -5,18 +5,25 @@ Tasks related to conversion and preprocessing of simulated events for use in Gra
 """
 
 
-__all__ = ["ConverterTask", "MergeConvertedFiles"]
+__all__ = ["ConverterTask", "ConverterBatchTask", "MergeConvertedFiles"]
 
 
 import os
+import json
+import math
+import shutil
+from multiprocessing.pool import ThreadPool
 
 import law
 import luigi
+from law.workflow.base import BaseWorkflowProxy
 
-from hgc.tasks.base import HTCondorWorkflow
+from hgc.tasks.base import HTCondorWorkflow, stage_outputs
 from hgc.tasks.simulation import GeneratorParameters, ParallelProdWorkflow, NtupTask
 from hgc.tasks.software import CompileConverter, CompileDeepJetCore
-from hgc.util import hadd_task
+from hgc.util import (
+    hadd_task, plan_cascade_merge, accounted_popen, fetch_input, stage_file, split_root_file,
+)
 
 
 luigi.namespace("gnn", scope=__name__)
@@ -41,60 +48,284 @@ class ConverterTask(ParallelProdWorkflow):
 
     @law.decorator.notify
     def run(self):
-        # determine the converter executable
         inp = self.input()
-        converter = inp["converter"].path
-        converter_dir = inp["converter"].parent
-
-        # read the config template
-        with converter_dir.child("config/config_template.txt").open("r") as f:
-            template = f.read()
 
         # temporary output directory
         output_dir = law.LocalDirectoryTarget(is_tmp=True)
         output_dir.touch()
 
-        # fill template variables
         with inp["ntup"].localize("r") as ntup_file:
-            config = template.format(
-                input_dir=ntup_file.parent.path,
-                input_file=ntup_file.basename,
-                output_dir=output_dir.path,
-                hist_output_file="no_used.root",
-                skim_output_prefix="output_file_",
-            )
-
-            # create a config file required by the converter
-            config_file = law.LocalFileTarget(is_tmp=True)
-            with config_file.open("w") as f:
-                f.write(config)
-
-            # run the converter
-            env_script = converter_dir.child("env.sh").path
-            cmd = "source {} '' && {} {}".format(env_script, converter, config_file.path)
-            code = law.util.interruptable_popen(cmd, shell=True, executable="/bin/bash")[0]
-            if code != 0:
-                raise Exception("conversion failed")
+            run_converter(inp["converter"], [ntup_file.path], [output_dir.path])
 
         # determine the skim output file and
         output_basename = output_dir.glob("output_file_*")[0]
-        self.output().copy_from_local(output_dir.child(output_basename))
+        stage_file(output_dir.child(output_basename), self.output())
+
+
+class ConverterBatchTask(ParallelProdWorkflow):
+    """
+    Converts the NTUP outputs of *batch_size* consecutive :py:class:`ConverterTask` branches in
+    each branch, so that the converter environment is set up and the job is started only once per
+    batch. Outputs are identical to those of :py:class:`ConverterTask`, so these tasks are
+    considered complete afterwards. Existing outputs are not converted again.
+    """
+
+    batch_size = luigi.IntParameter(default=10, description="number of ntuples converted per "
+        "branch, default: 10")
+
+    output_collection_cls = law.FileCollection
+
+    def create_branch_map(self):
+        n_batches = int(math.ceil(float(self.n_tasks) / self.batch_size))
+        return {
+            i: list(range(i * self.batch_size, min((i + 1) * self.batch_size, self.n_tasks)))
+            for i in range(n_batches)
+        }
+
+    def converter_tasks(self):
+        return [
+            ConverterTask.req(self, branch=b, _prefer_cli=["version"])
+            for b in self.branch_data
+        ]
+
+    def workflow_requires(self):
+        reqs = super(ConverterBatchTask, self).workflow_requires()
+        if not self.pilot:
+            reqs["ntup"] = NtupTask.req(self, _prefer_cli=["version"])
+        reqs["converter"] = CompileConverter.req(self)
+        return reqs
+
+    def requires(self):
+        return {
+            "ntup": [task.requires()["ntup"] for task in self.converter_tasks()],
+            "converter": CompileConverter.req(self),
+        }
+
+    def output(self):
+        return [task.output() for task in self.converter_tasks()]
+
+    def resource_history_values(self, processing_time):
+        if processing_time <= 0:
+            return {}
+        return {"events_per_second": self.n_events * len(self.branch_data) / processing_time}
+
+    @law.decorator.notify
+    def run(self):
+        inp = self.input()
+        outp = self.output()
+
+        # only convert missing outputs
+        todo = [i for i, target in enumerate(outp) if not target.exists()]
+        if not todo:
+            return
+
+        # fetch inputs into a local directory, local files are hardlinked when possible
+        fetch_dir = law.LocalDirectoryTarget(is_tmp=True)
+        fetch_dir.touch()
+        with self.publish_step("fetching {} ntuples ...".format(len(todo)), runtime=True):
+            ntup_paths = [fetch_input(inp["ntup"][i], fetch_dir) for i in todo]
+
+        # one temporary output directory per ntuple
+        output_dirs = [fetch_dir.child("output_{}".format(i), type="d") for i in todo]
+        for output_dir in output_dirs:
+            output_dir.touch()
+
+        with self.publish_step("converting {} ntuples ...".format(len(todo)), runtime=True):
+            run_converter(inp["converter"], ntup_paths, [d.path for d in output_dirs])
+
+        # split the results back into per-branch outputs
+        for i, output_dir in zip(todo, output_dirs):
+            output_basename = output_dir.glob("output_file_*")[0]
+            stage_file(output_dir.child(output_basename), outp[i])
+
+
+def run_converter(converter, ntup_paths, output_dirs):
+    """
+    Converts the ntuple files *ntup_paths* into the corresponding directories *output_dirs* with
+    the compiled *converter* target. A config file is created per ntuple and all configs are
+    processed in a single shell in which the converter environment is sourced only once.
+    """
+    converter_dir = converter.parent
+
+    # read the config template
+    with converter_dir.child("config/config_template.txt").open("r") as f:
+        template = f.read()
+
+    # create the config files required by the converter and list them in a file
+    config_files = []
+    for ntup_path, output_dir in zip(ntup_paths, output_dirs):
+        config_file = law.LocalFileTarget(is_tmp=True)
+        with config_file.open("w") as f:
+            f.write(template.format(
+                input_dir=os.path.dirname(ntup_path),
+                input_file=os.path.basename(ntup_path),
+                output_dir=output_dir,
+                hist_output_file="no_used.root",
+                skim_output_prefix="output_file_",
+            ))
+        config_files.append(config_file)
+    config_list = law.LocalFileTarget(is_tmp=True)
+    with config_list.open("w") as f:
+        f.write("".join("{}\n".format(c.path) for c in config_files))
+
+    # run the converter
+    env_script = converter_dir.child("env.sh").path
+    cmd = "source {} '' && while read -r cfg; do {} \"$cfg\" || exit $?; done < {}".format(
+        env_script, converter.path, config_list.path)
+    code = accounted_popen(cmd, label="converter", shell=True, executable="/bin/bash")[0]
+    if code != 0:
+        raise Exception("conversion failed")
 
 
 class MergeConvertedFiles(GeneratorParameters, law.CascadeMerge):
 
-    n_merged_files = luigi.IntParameter(description="number of files after merging")
+    n_merged_files = luigi.IntParameter(default=-1, description="number of files after merging, "
+        "derived from merge_target_size when that is positive, default: -1")
+    merge_target_size = luigi.FloatParameter(default=0.0, description="when positive, plan the "
+        "merging based on the sizes of the converted files to obtain merged files of this size in "
+        "MB, the plan is made once all files are converted and reused afterwards, default: 0.0")
+    max_merge_factor = luigi.IntParameter(default=10, significant=False, description="maximum "
+        "number of files merged in one step when merge_target_size is set, default: 10")
+    fetch_threads = luigi.IntParameter(default=4, significant=False, description="number of "
+        "threads for fetching input files, default: 4")
+    merge_chunk_size = luigi.IntParameter(default=0, significant=False, description="when "
+        "positive, merge fetched inputs in chunks of this size while others are still fetched, "
+        "default: 0")
+    merge_backend = luigi.ChoiceParameter(default="hadd", choices=["hadd", "uproot"],
+        significant=False, description="the merge backend to use, 'uproot' only supports flat "
+        "and singly jagged branches, default: hadd")
+    merge_workers = luigi.IntParameter(default=0, significant=False, description="number of "
+        "processes reading inputs with the 'uproot' merge backend, default: 0")
+    resumable_fetch = luigi.BoolParameter(default=True, significant=False, description="fetch "
+        "inputs into HGC_LOCAL_CACHE so that they can be reused when merging fails, default: True")
+    convert_batch_size = luigi.IntParameter(default=0, significant=False, description="when "
+        "positive, convert ntuples with the ConverterBatchTask in batches of this size, "
+        "default: 0")
 
     merge_factor = 10
 
+    _merge_plans = {}
+
+    @classmethod
+    def modify_param_values(cls, params):
+        params = super(MergeConvertedFiles, cls).modify_param_values(params)
+        return cls.resolve_n_merged_files(params)
+
+    @classmethod
+    def resolve_n_merged_files(cls, params):
+        if params.get("merge_target_size", 0) > 0:
+            # when the plan cannot be made yet, n_merged_files stays unresolved until all files
+            # are converted
+            plan = cls.load_merge_plan(params)
+            params["n_merged_files"] = plan["n_trees"] if plan else -1
+        elif params.get("n_merged_files", -1) <= 0:
+            raise ValueError("either n_merged_files or merge_target_size must be positive")
+        return params
+
+    @classmethod
+    def load_merge_plan(cls, params):
+        """
+        Returns the merge plan (see :py:func:`hgc.util.plan_cascade_merge`) for the parameter
+        values *params* or *None* when *merge_target_size* is not set. The plan is made from the
+        sizes of the converted files once all of them exist and stored in ``$HGC_DATA/merge_plans``.
+        It is reused for the same converted files and settings afterwards, so that the grouping of
+        files into merged files never changes. *None* is also returned when the plan does not exist
+        yet and not all files are converted.
+        """
+        if params.get("merge_target_size", 0) <= 0:
+            return None
+
+        # get the converter workflow
+        conv_params = {
+            key: value for key, value in params.items()
+            if key in ConverterTask.get_param_names() and key not in ("branch", "branches")
+        }
+        workflow = ConverterTask(**conv_params)
+
+        plan_key = {
+            "converter": workflow.task_id,
+            "merge_target_size": params["merge_target_size"],
+            "max_merge_factor": params["max_merge_factor"],
+        }
+        plan_file = law.LocalFileTarget(os.path.join(os.path.expandvars("$HGC_DATA"),
+            "merge_plans", law.util.create_hash(json.dumps(plan_key, sort_keys=True)) + ".json"))
+        if plan_file.path in cls._merge_plans:
+            return cls._merge_plans[plan_file.path]
+
+        if plan_file.exists():
+            plan = plan_file.load(formatter="json")["plan"]
+        else:
+            # sizes of converted files
+            targets = workflow.output()["collection"].targets
+            if not all(targets[b].exists() for b in targets):
+                return None
+            sizes = [targets[b].stat.st_size for b in sorted(targets)]
+
+            plan = plan_cascade_merge(sizes, params["merge_target_size"] * 1024.**2,
+                max_merge_factor=params["max_merge_factor"])
+
+            plan_file.parent.touch()
+            plan_file.dump(dict(plan_key, plan=plan), formatter="json", indent=4)
+
+        cls._merge_plans[plan_file.path] = plan
+        return plan
+
+    def __init__(self, *args, **kwargs):
+        super(MergeConvertedFiles, self).__init__(*args, **kwargs)
+
+        self.merge_plan = self.load_merge_plan(self.param_kwargs)
+        if self.merge_plan:
+            self.merge_factor = self.merge_plan["merge_factor"]
+        elif self.plan_pending() and not self.is_forest():
+            raise Exception("merge trees are only defined once all files are converted and merging "
+                "is planned, run the forest (--cascade-tree -1) instead")
+
+    def plan_pending(self):
+        # whether merging is planned but the converted files do not exist yet
+        return self.merge_target_size > 0 and self.n_merged_files <= 0
+
+    def complete(self):
+        if self.plan_pending():
+            return False
+        return super(MergeConvertedFiles, self).complete()
+
+    def requires(self):
+        if self.plan_pending():
+            # convert all files first, the planned trees are required in run
+            return {"cascade": self.cascade_workflow_requires()}
+        return super(MergeConvertedFiles, self).requires()
+
+    def run(self):
+        if self.plan_pending():
+            plan = self.load_merge_plan(self.param_kwargs)
+            if not plan:
+                raise Exception("cannot plan merging as not all files are converted")
+
+            tree_sizes = [tree["size"] for tree in plan["trees"]]
+            size_range = law.util.human_bytes(min(tree_sizes))
+            size_range += law.util.human_bytes(max(tree_sizes))
+            self.publish_message("merge plan: {} files, merge factor {}, depth {}, predicted sizes "
+                "between {:.2f} {} and {:.2f} {}".format(plan["n_trees"], plan["merge_factor"],
+                plan["depth"], *size_range))
+
+            # require the forest with resolved n_merged_files as dynamic dependency
+            yield self.req(self)
+            return
+
+        super(MergeConvertedFiles, self).run()
+
     def cascade_workflow_requires(self):
+        if self.convert_batch_size > 0:
+            return ConverterBatchTask.req(self, batch_size=self.convert_batch_size,
+                _prefer_cli=["workflow"])
         return ConverterTask.req(self, _prefer_cli=["workflow"])
 
     def trace_cascade_workflow_inputs(self, inputs):
         return self.n_tasks
 
     def cascade_requires(self, start_leaf, end_leaf):
-        return [ConverterTask.req(self, branch=b) for b in range(start_leaf, end_leaf)]
+        order = self.merge_plan["order"] if self.merge_plan else list(range(self.n_tasks))
+        return [ConverterTask.req(self, branch=order[b]) for b in range(start_leaf, end_leaf)]
 
     def cascade_output(self):
         return law.SiblingFileCollection(
@@ -103,22 +334,70 @@ class MergeConvertedFiles(GeneratorParameters, law.CascadeMerge):
             for i in range(self.n_merged_files)
         )
 
-    def merge(self, *args, **kwargs):
-        return hadd_task(self, *args, **kwargs)
+    def merge_backend_kwargs(self):
+        if self.merge_backend == "uproot":
+            return {"n_workers": self.merge_workers}
+        return {}
+
+    def merge(self, inputs, output):
+        cache_dir = os.getenv("HGC_LOCAL_CACHE") if self.resumable_fetch else None
+        hadd_task(self, inputs, output, fetch_threads=self.fetch_threads,
+            chunk_size=self.merge_chunk_size or None, cache_dir=cache_dir,
+            backend=self.merge_backend, backend_kwargs=self.merge_backend_kwargs())
+
+        # compare the predicted and actual size of final outputs
+        if self.merge_plan and self.cascade_depth == 0:
+            predicted = self.merge_plan["trees"][self.cascade_tree]["size"]
+            actual = output.stat.st_size
+            values = law.util.human_bytes(predicted) + law.util.human_bytes(actual)
+            values += (100. * (actual - predicted) / predicted,)
+            self.publish_message("predicted size: {:.2f} {}, actual size: {:.2f} {} "
+                "({:+.1f}%)".format(*values))
 
 
 class CreateMLDataset(GeneratorParameters, law.LocalWorkflow, HTCondorWorkflow):
 
     n_merged_files = MergeConvertedFiles.n_merged_files
+    merge_target_size = MergeConvertedFiles.merge_target_size
+    max_merge_factor = MergeConvertedFiles.max_merge_factor
     data_structure = luigi.ChoiceParameter(default="hitlist",
         choices=["hitlist", "hitlist_layercluster"], description="name of the data structure to "
         "convert, prefixed by 'TrainData_', default: hitlist")
+    n_chunks = luigi.IntParameter(default=1, description="number of event ranges of each merged "
+        "file that are converted separately into shards, default: 1")
+    n_workers = luigi.IntParameter(default=1, significant=False, description="number of chunks "
+        "converted in parallel, also sets the number of cpus requested per job, default: 1")
+    chunk_memory = luigi.FloatParameter(default=0.0, significant=False, description="when "
+        "positive, the virtual memory limit in MB of each conversion process, default: 0.0")
+
+    @classmethod
+    def modify_param_values(cls, params):
+        params = super(CreateMLDataset, cls).modify_param_values(params)
+        return MergeConvertedFiles.resolve_n_merged_files(params)
 
     def store_parts(self):
-        return super(CreateMLDataset, self).store_parts() + (self.data_structure,)
+        parts = super(CreateMLDataset, self).store_parts() + (self.data_structure,)
+        # different chunk layouts must not share outputs and cache directories
+        if self.n_chunks != 1:
+            parts += ("chunks{}".format(self.n_chunks),)
+        return parts
+
+    def workflow_complete(self):
+        # used by the workflow proxy instead of its default check, see law.BaseWorkflow, as the
+        # branch map, and therefore the outputs, of a workflow whose merging is planned is only
+        # known once the merge plan exists, and the workflow cannot be complete before
+        if self.n_merged_files <= 0 and not MergeConvertedFiles.load_merge_plan(self.param_kwargs):
+            return False
+        return super(BaseWorkflowProxy, self.workflow_proxy).complete()
 
     def create_branch_map(self):
-        return {i: i for i in range(self.n_merged_files)}
+        n_merged_files = self.n_merged_files
+        if n_merged_files <= 0:
+            plan = MergeConvertedFiles.load_merge_plan(self.param_kwargs)
+            if not plan:
+                raise Exception("number of merged files is not known before merging is planned")
+            n_merged_files = plan["n_trees"]
+        return {i: i for i in range(n_merged_files)}
 
     def workflow_requires(self):
         reqs = super(CreateMLDataset, self).workflow_requires()
@@ -137,44 +416,178 @@ class CreateMLDataset(GeneratorParameters, law.LocalWorkflow, HTCondorWorkflow):
             "deepjetcore": CompileDeepJetCore.req(self),
         }
 
+    def htcondor_request_cpus(self):
+        return self.n_workers
+
+    def chunk_basenames(self):
+        basename = os.path.splitext(self.input()["merged"].basename)[0]
+        if self.n_chunks == 1:
+            return [basename]
+        return ["{}_{}".format(basename, i) for i in range(self.n_chunks)]
+
     def output(self):
         basename = os.path.splitext(self.input()["merged"].basename)[0]
         return law.SiblingFileCollection({
-            "x": self.local_target(basename + ".x.0"),
-            "y": self.local_target(basename + ".y.0"),
-            "meta": self.local_target(basename + ".meta"),
             "dc": self.local_target(basename + ".dc"),
+            "chunks": [
+                {
+                    "x": self.local_target(chunk_basename + ".x.0"),
+                    "y": self.local_target(chunk_basename + ".y.0"),
+                    "meta": self.local_target(chunk_basename + ".meta"),
+                }
+                for chunk_basename in self.chunk_basenames()
+            ],
         })
 
     @law.decorator.notify
     def run(self):
-        with self.input()["merged"].localize("r") as inp:
-            # write the path of the input file to a temporary file
-            samples_file = law.LocalFileTarget(is_tmp=True)
-            samples_file.touch(content="{}\n".format(inp.path))
-
-            # tmp dir for output files
-            tmp_dir = law.LocalDirectoryTarget(is_tmp=True)
-
-            # create the conversion command
-            compile_task = self.requires()["deepjetcore"]
-            cmd = """
-                {} &&
-                export HGCALML="$HGC_BASE/modules/HGCalML"
-                export DEEPJETCORE_SUBPACKAGE="$HGCALML"
-                export PYTHONPATH="$HGCALML/modules:$HGCALML/modules/datastructures:$PYTHONPATH"
-                convertFromRoot.py -n 0 --noRelativePaths -c TrainData_{} -o "{}" -i "{}"
-            """.format(compile_task.get_setup_cmd(), self.data_structure, tmp_dir.path,
-                samples_file.path)
-
-            # run the command
-            code = law.util.interruptable_popen(cmd, env=compile_task.get_setup_env(), shell=True,
-                executable="/bin/bash")[0]
-            if code != 0:
-                raise Exception("convertFromRoot.py failed")
-
         outp = self.output()
-        outp["x"].copy_from_local(tmp_dir.child(outp["x"].basename))
-        outp["y"].copy_from_local(tmp_dir.child(outp["y"].basename))
-        outp["meta"].copy_from_local(tmp_dir.child(outp["meta"].basename))
-        outp["dc"].copy_from_local(tmp_dir.child("dataCollection.dc"))
+        chunk_basenames = self.chunk_basenames()
+
+        # converted chunks are kept in a directory next to the outputs that is only removed after
+        # all chunks were converted, so that a failed job, also on a different machine, can be
+        # resumed with the missing chunks, while inputs and conversions in progress are placed in
+        # the local cache directory
+        state_dir = law.LocalDirectoryTarget(outp["dc"].path + ".tmp")
+        state_dir.touch()
+        cache_dir = law.LocalDirectoryTarget(os.path.join(os.path.expandvars("$HGC_LOCAL_CACHE"),
+            "mldataset_" + law.util.create_hash(outp["dc"].path)))
+        cache_dir.touch()
+        chunk_dirs = [state_dir.child(basename, type="d") for basename in chunk_basenames]
+        todo = [i for i, chunk_dir in enumerate(chunk_dirs) if not chunk_dir.exists()]
+        if len(todo) < len(chunk_dirs):
+            self.publish_message("resuming with {} of {} chunks".format(len(todo), len(chunk_dirs)))
+
+        with self.input()["merged"].localize("r") as inp:
+            # split the merged file into event ranges
+            if self.n_chunks == 1:
+                chunk_inputs = [inp.path]
+            else:
+                chunk_inputs = [
+                    cache_dir.child(basename + ".root", type="f").path
+                    for basename in chunk_basenames
+                ]
+                if todo:
+                    with self.publish_step("splitting into {} chunks ...".format(self.n_chunks),
+                            runtime=True):
+                        split_root_file(inp.path, chunk_inputs)
+
+            # convert chunks in parallel processes
+            def convert(i):
+                self.convert_chunk(chunk_inputs[i], chunk_dirs[i], cache_dir)
+                return i
+
+            with self.publish_step("converting {} chunks ...".format(len(todo)), runtime=True):
+                pool = ThreadPool(max(1, min(self.n_workers, len(todo))))
+                try:
+                    for n, i in enumerate(pool.imap_unordered(convert, todo)):
+                        self.publish_message("converted chunk {} ({} / {})".format(i, n + 1,
+                            len(todo)))
+                finally:
+                    pool.close()
+                    pool.join()
+
+        # combine the data collections, with samples referring to the shards next to the output
+        if self.n_chunks == 1:
+            dc = chunk_dirs[0].child("dataCollection.dc", type="f")
+        else:
+            dc = law.LocalFileTarget(is_tmp="dc")
+            self.merge_data_collections(
+                [chunk_dir.child("dataCollection.dc", type="f").path for chunk_dir in chunk_dirs],
+                [basename + ".meta" for basename in chunk_basenames], dc.path)
+
+        for chunk_dir, basename, chunk_outp in zip(chunk_dirs, chunk_basenames, outp["chunks"]):
+            stage_file(chunk_dir.child(basename + ".x.0", type="f"), chunk_outp["x"])
+            stage_file(chunk_dir.child(basename + ".y.0", type="f"), chunk_outp["y"])
+            stage_file(chunk_dir.child(basename + ".meta", type="f"), chunk_outp["meta"])
+        stage_file(dc, outp["dc"])
+
+        state_dir.remove()
+        cache_dir.remove()
+
+    def get_setup_cmd(self):
+        return hgcalml_setup_cmd(self.requires()["deepjetcore"])
+
+    def convert_chunk(self, input_path, chunk_dir, work_dir):
+        # write the path of the input file to a temporary file
+        samples_file = law.LocalFileTarget(is_tmp=True)
+        with samples_file.open("w") as f:
+            f.write("{}\n".format(input_path))
+
+        # convertFromRoot.py creates the output directory in work_dir, move it when done
+        tmp_dir = work_dir.child(chunk_dir.basename + ".tmp", type="d")
+        if tmp_dir.exists():
+            tmp_dir.remove()
+
+        # create the conversion command, optionally with a memory limit
+        cmd = "{}\n".format(self.get_setup_cmd())
+        if self.chunk_memory > 0:
+            cmd += "ulimit -v {:d} && ".format(int(self.chunk_memory * 1024))
+        cmd += "convertFromRoot.py -n 0 --noRelativePaths -c TrainData_{} -o \"{}\" -i \"{}\"" \
+            .format(self.data_structure, tmp_dir.path, samples_file.path)
+
+        # run the command
+        compile_task = self.requires()["deepjetcore"]
+        code = accounted_popen(cmd, label="convertFromRoot", env=compile_task.get_setup_env(),
+            shell=True, executable="/bin/bash")[0]
+        if code != 0:
+            raise Exception("convertFromRoot.py failed for {}".format(input_path))
+
+        # move across devices to a temporary name first, so that chunk_dir is always complete
+        part_path = chunk_dir.path + ".part"
+        if os.path.exists(part_path):
+            shutil.rmtree(part_path)
+        shutil.move(tmp_dir.path, part_path)
+        os.rename(part_path, chunk_dir.path)
+
+    def merge_data_collections(self, dc_paths, samples, output_path):
+        # merges the DeepJetCore data collections dc_paths into output_path with new samples
+        script = law.LocalFileTarget(is_tmp="py")
+        with script.open("w") as f:
+            f.write(merge_dc_script)
+
+        cmd = "{}\npython \"{}\" \"{}\" \"{}\" {}".format(self.get_setup_cmd(), script.path,
+            output_path, ",".join(samples), " ".join("\"{}\"".format(p) for p in dc_paths))
+
+        compile_task = self.requires()["deepjetcore"]
+        code = accounted_popen(cmd, label="mergeDataCollections",
+            env=compile_task.get_setup_env(), shell=True, executable="/bin/bash")[0]
+        if code != 0:
+            raise Exception("merging of data collections failed")
+
+
+def hgcalml_setup_cmd(compile_task=None):
+    """
+    Returns the command that sets up the DeepJetCore env for the HGCalML data structures, using the
+    setup command of the :py:class:`CompileDeepJetCore` *compile_task*.
+    """
+    if compile_task is None:
+        compile_task = CompileDeepJetCore()
+    return """
+        {} &&
+        export HGCALML="$HGC_BASE/modules/HGCalML"
+        export DEEPJETCORE_SUBPACKAGE="$HGCALML"
+        export PYTHONPATH="$HGCALML/modules:$HGCALML/modules/datastructures:$PYTHONPATH"
+    """.format(compile_task.get_setup_cmd())
+
+
+# script that merges DeepJetCore data collections, arguments: output path, comma-separated
+# samples of the merged collection and paths of the collections to merge
+merge_dc_script = """
+import sys
+from DeepJetCore.DataCollection import DataCollection
+
+output_path, samples, dc_paths = sys.argv[1], sys.argv[2].split(","), sys.argv[3:]
+
+dc = DataCollection()
+dc.readFromFile(dc_paths[0])
+dc.sampleentries, dc.originRoots = [], []
+for path in dc_paths:
+    _dc = DataCollection()
+    _dc.readFromFile(path)
+    dc.sampleentries.extend(_dc.sampleentries)
+    dc.originRoots.extend(_dc.originRoots)
+dc.samples = samples
+dc.nsamples = sum(dc.sampleentries)
+dc.writeToFile(output_path)
+"""
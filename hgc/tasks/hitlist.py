@@ -0,0 +1,135 @@
+# coding: utf-8
+
+"""
+Tasks that build hitlist training arrays and graphs directly from ntuples, bypassing the converter
+and DeepJetCore steps of :py:mod:`hgc.tasks.graphnn`.
+
+The array layout defined in :py:mod:`hgc.hitlist` is not yet verified to match
+``TrainData_hitlist`` of :py:class:`hgc.tasks.graphnn.CreateMLDataset`, therefore this module is not
+listed in the ``[modules]`` section of law.cfg and its tasks are not indexed by default. It should
+be added there once ``python -m hgc.bench.hitlist --parity`` reports identical arrays.
+"""
+
+
+__all__ = ["CreateHitlistDataset", "CreateHitlistGraphs"]
+
+
+import law
+import luigi
+
+from hgc.tasks.base import stage_outputs
+from hgc.tasks.simulation import ParallelProdWorkflow, NtupTask
+
+
+luigi.namespace("gnn", scope=__name__)
+
+
+class CreateHitlistDataset(ParallelProdWorkflow):
+    """
+    Builds hitlist training arrays directly from the outputs of :py:class:`NtupTask` with
+    :py:func:`hgc.hitlist.create_hitlist`, i.e., without the converter, merging and DeepJetCore
+    steps. Features and truth of each branch are stored as npy files that can be memory-mapped,
+    together with the number of hits of each event before the padding.
+
+    The layout of the arrays is not verified to match ``TrainData_hitlist`` of
+    :py:class:`hgc.tasks.graphnn.CreateMLDataset` yet, see the module description.
+    """
+
+    previous_task = ("ntup", NtupTask)
+
+    max_hits = luigi.IntParameter(default=2500, description="maximum number of hits per event, "
+        "default: 2500")
+    n_showers = luigi.IntParameter(default=5, description="number of most energetic simclusters "
+        "per event in the truth, default: 5")
+    chunk_size = luigi.IntParameter(default=100, significant=False, description="number of events "
+        "read at once, default: 100")
+
+    def store_parts(self):
+        return super(CreateHitlistDataset, self).store_parts() + \
+            ("h{}_s{}".format(self.max_hits, self.n_showers),)
+
+    def output(self):
+        basename = "hitlist_{}_n{}".format(self.branch, self.n_events)
+        return {
+            "x": self.local_target(basename + ".x.npy"),
+            "y": self.local_target(basename + ".y.npy"),
+            "n_hits": self.local_target(basename + ".n_hits.npy"),
+        }
+
+    @law.decorator.notify
+    @stage_outputs
+    def run(self):
+        from hgc.hitlist import create_hitlist
+
+        outp = self.output()
+        with self.input()["ntup"].localize("r") as inp:
+            with self.publish_step("building hitlist arrays ...", runtime=True):
+                n_events = create_hitlist(inp.path, outp["x"].path, outp["y"].path,
+                    self.max_hits, self.n_showers, chunk_size=self.chunk_size,
+                    n_hits_path=outp["n_hits"].path)
+        self.publish_message("converted {} events".format(n_events))
+
+
+class CreateHitlistGraphs(ParallelProdWorkflow):
+    """
+    Precomputes the neighbour graph of the hits of each event of :py:class:`CreateHitlistDataset`
+    with :py:func:`hgc.graphs.build_graphs`, so that training does not need to build graphs on the
+    fly. The hits of each event are taken from the hit counts stored by
+    :py:class:`CreateHitlistDataset`. The int32 CSR arrays are stored next to the hitlist arrays.
+
+    As it is built on :py:class:`CreateHitlistDataset` rather than on the shards of
+    :py:class:`hgc.tasks.graphnn.CreateMLDataset`, it is subject to the same parity check before
+    its module is indexed, see the module description.
+    """
+
+    previous_task = ("hitlist", CreateHitlistDataset)
+
+    max_hits = CreateHitlistDataset.max_hits
+    n_showers = CreateHitlistDataset.n_showers
+    graph_mode = luigi.ChoiceParameter(default="knn", choices=["knn", "radius"], description="knn "
+        "to connect each hit to its k nearest neighbours, radius to connect all hits within "
+        "graph_radius, default: knn")
+    k = luigi.IntParameter(default=8, description="number of neighbours per hit in knn mode, "
+        "default: 8")
+    graph_radius = luigi.FloatParameter(default=1.0, description="maximum distance of connected "
+        "hits in radius mode, default: 1.0")
+    coordinates = luigi.ChoiceParameter(default="xyz", choices=["xyz", "etaphilayer"],
+        description="hit features that define distances, default: xyz")
+    n_workers = luigi.IntParameter(default=1, significant=False, description="number of processes "
+        "that build graphs in parallel, also sets the number of cpus requested per job, "
+        "default: 1")
+    chunk_size = luigi.IntParameter(default=100, significant=False, description="number of events "
+        "per parallel job, default: 100")
+
+    def htcondor_request_cpus(self):
+        return self.n_workers
+
+    def graph_postfix(self):
+        if self.graph_mode == "knn":
+            return "knn{}_{}".format(self.k, self.coordinates)
+        else:
+            return "r{}_{}".format(self.graph_radius, self.coordinates)
+
+    def output(self):
+        x = self.input()["hitlist"]["x"]
+        basename = "{}.{}".format(x.basename[:-len(".x.npy")], self.graph_postfix())
+        return {
+            key: x.parent.child("{}.{}.npy".format(basename, key), type="f")
+            for key in ("indptr", "indices", "offsets")
+        }
+
+    @law.decorator.notify
+    @stage_outputs
+    def run(self):
+        from hgc.graphs import build_graphs
+
+        outp = self.output()
+        inp = self.input()["hitlist"]
+        with inp["x"].localize("r") as x, inp["n_hits"].localize("r") as n_hits:
+            with self.publish_step("building {} graphs ...".format(self.graph_postfix()),
+                    runtime=True):
+                n_edges = build_graphs(x.path, n_hits.path, outp["indptr"].path,
+                    outp["indices"].path, outp["offsets"].path, mode=self.graph_mode, k=self.k,
+                    radius=self.graph_radius, coordinates=self.coordinates,
+                    n_workers=self.n_workers, chunk_size=self.chunk_size)
+        self.publish_message("built graphs with {} edges".format(n_edges))
@@ -0,0 +1,116 @@
+# coding: utf-8
+
+"""
+Tasks that monitor other tasks.
+"""
+
+
+__all__ = ["ResourceSummary"]
+
+
+import collections
+
+import law
+import luigi
+
+from hgc.tasks.simulation import GeneratorParameters
+
+
+luigi.namespace("mon", scope=__name__)
+
+
+class ResourceSummary(GeneratorParameters):
+    """
+    Aggregates the resources used by commands of all branches of a workflow, which are stored in
+    json files next to the branch outputs, and prints tables of the resources per command and of
+    the slowest and heaviest branches.
+    """
+
+    workflow = luigi.ChoiceParameter(choices=["sim.GSDTask", "sim.RecoTask", "sim.NtupTask",
+        "sim.NtupCacheTask", "sim.SimChainTask", "gnn.ConverterTask"], description="the workflow "
+        "to summarize")
+    n_top = luigi.IntParameter(default=10, significant=False, description="number of branches to "
+        "show in the tables of slowest and heaviest branches, default: 10")
+
+    def store_parts(self):
+        return super(ResourceSummary, self).store_parts() + (self.workflow,)
+
+    def workflow_task(self):
+        cls = luigi.task_register.Register.get_task_cls(self.workflow)
+        return cls.req(self, _prefer_cli=["version"])
+
+    def output(self):
+        return self.local_target("resources.json")
+
+    def run(self):
+        branches = []
+        commands = collections.OrderedDict()
+
+        for branch, task in self.workflow_task().get_branch_tasks().items():
+            sidecar = task.resource_sidecar()
+            if not sidecar or not sidecar.exists():
+                continue
+            records = sidecar.load(formatter="json")
+
+            branches.append({
+                "branch": branch,
+                "wall_time": sum(r["wall_time"] for r in records),
+                "cpu_time": sum(r["user_time"] + r["sys_time"] for r in records),
+                "max_rss": max(r["max_rss"] for r in records),
+                "read_bytes": sum(r["read_bytes"] for r in records),
+                "write_bytes": sum(r["write_bytes"] for r in records),
+            })
+
+            for r in records:
+                c = commands.setdefault(r["label"] or "unlabeled", collections.OrderedDict([
+                    ("label", r["label"] or "unlabeled"), ("n", 0), ("wall_time", 0.),
+                    ("cpu_time", 0.), ("max_rss", 0.), ("read_bytes", 0), ("write_bytes", 0),
+                ]))
+                c["n"] += 1
+                c["wall_time"] += r["wall_time"]
+                c["cpu_time"] += r["user_time"] + r["sys_time"]
+                c["max_rss"] = max(c["max_rss"], r["max_rss"])
+                c["read_bytes"] += r["read_bytes"]
+                c["write_bytes"] += r["write_bytes"]
+
+        if not branches:
+            raise Exception("no resource information found for any branch of {}".format(
+                self.workflow))
+
+        slowest = sorted(branches, key=lambda b: -b["wall_time"])[:self.n_top]
+        heaviest = sorted(branches, key=lambda b: -b["max_rss"])[:self.n_top]
+
+        print("\nresources per command, {} branches".format(len(branches)))
+        print_table(list(commands.values()), "label")
+        print("\nslowest branches")
+        print_table(slowest, "branch")
+        print("\nheaviest branches")
+        print_table(heaviest, "branch")
+
+        self.output().dump({
+            "commands": list(commands.values()),
+            "slowest": slowest,
+            "heaviest": heaviest,
+        }, formatter="json", indent=4)
+
+
+def print_table(rows, first):
+    def fmt_bytes(n):
+        return "{:.1f} {}".format(*law.util.human_bytes(n))
+
+    columns = [
+        (first, str),
+        ("n", str),
+        ("wall_time", lambda v: law.util.human_time_diff(seconds=v)),
+        ("cpu_time", lambda v: law.util.human_time_diff(seconds=v)),
+        ("max_rss", lambda v: "{:.1f} MB".format(v)),
+        ("read_bytes", fmt_bytes),
+        ("write_bytes", fmt_bytes),
+    ]
+    columns = [(name, fmt) for name, fmt in columns if name in rows[0]]
+
+    cells = [[name for name, _ in columns]]
+    cells.extend([fmt(row[name]) for name, fmt in columns] for row in rows)
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    for line in cells:
+        print("  ".join(cell.ljust(width) for cell, width in zip(line, widths)))
@@ -7,11 +7,14 @@ Plotting tasks.
 __all__ = ["PlotTask"]
 
 
+import multiprocessing
+
 import law
 import luigi
 
 from hgc.tasks.base import Task
 from hgc.tasks.simulation import NtupTask
+from hgc.util import stage_file
 
 
 luigi.namespace("plot", scope=__name__)
@@ -20,6 +23,15 @@ luigi.namespace("plot", scope=__name__)
 class PlotTask(Task):
 
     n_events = NtupTask.n_events
+    n_workers = luigi.IntParameter(default=1, significant=False, description="number of processes "
+        "used for plotting, default: 1")
+    chunk_size = luigi.IntParameter(default=50, significant=False, description="number of events "
+        "read and plotted at once, default: 50")
+
+    branches = [
+        "rechit_eta", "rechit_phi", "rechit_z",
+        "gunparticle_eta", "gunparticle_phi", "gunparticle_energy",
+    ]
 
     def requires(self):
         return NtupTask.req(self, n_tasks=1)
@@ -32,16 +44,52 @@ class PlotTask(Task):
 
     @law.decorator.notify
     def run(self):
-        from hgc.plots.plots import particle_rechit_eta_phi_plot
+        from hgc.ntuple import NtupleReader
 
         # ensure that the output directory exists
         output = self.output()
         output.dir.touch()
 
-        # load the data to a structured numpy array
-        input_target = self.input()["collection"][0]
-        data = input_target.load(formatter="root_numpy", treename="ana/hgc")
-
-        for i, event in enumerate(data):
-            with output[i].localize("w") as tmp_out:
-                particle_rechit_eta_phi_plot(event, "gunparticle", tmp_out.path)
+        with self.input()["collection"][0].localize("r") as inp:
+            reader = NtupleReader(inp.path, branches=self.branches, chunk_size=self.chunk_size)
+            n_events = len(reader)
+
+            # render into a temporary directory
+            tmp_dir = law.LocalDirectoryTarget(is_tmp=True)
+            tmp_dir.touch()
+            plot_paths = [
+                tmp_dir.child(output[i].basename, type="f").path
+                for i in range(n_events)
+            ]
+
+            # event ranges that are read and plotted by each process
+            jobs = []
+            for start in range(0, n_events, self.chunk_size):
+                stop = min(start + self.chunk_size, n_events)
+                jobs.append((inp.path, start, stop, self.branches, plot_paths[start:stop]))
+
+            with self.publish_step("plotting {} events ...".format(n_events), runtime=True):
+                n_workers = max(1, min(self.n_workers, len(jobs)))
+                if n_workers == 1:
+                    for job in jobs:
+                        _plot_range(job)
+                else:
+                    pool = multiprocessing.Pool(n_workers)
+                    try:
+                        pool.map(_plot_range, jobs, chunksize=1)
+                    finally:
+                        pool.terminate()
+                        pool.join()
+
+        for i, plot_path in enumerate(plot_paths):
+            stage_file(plot_path, output[i])
+
+
+def _plot_range(args):
+    from hgc.ntuple import NtupleReader
+    from hgc.plots.plots import particle_rechit_eta_phi_plots
+
+    path, start, stop, branches, plot_paths = args
+    reader = NtupleReader(path, branches=branches)
+    return particle_rechit_eta_phi_plots(reader.read_events(start, stop), "gunparticle",
+        plot_paths)
@@ -5,17 +5,21 @@ HGCAL simulation tasks.
 """
 
 
-__all__ = ["GSDTask", "RecoTask", "NtupTask"]
+__all__ = ["GSDTask", "RecoTask", "NtupTask", "NtupCacheTask", "SimChainTask"]
 
 
 import os
+import abc
+import math
+import json
 import random
 
 import law
 import luigi
 
-from hgc.tasks.base import Task, HTCondorWorkflow
-from hgc.util import cms_run_and_publish, log_runtime
+from hgc.tasks.base import Task, HTCondorWorkflow, flatten_targets, stage_outputs
+from hgc.util import cms_run_and_publish, log_runtime, link_or_copy, stage_file
+from hgc.resources import ResourceHistory
 
 
 luigi.namespace("sim", scope=__name__)
@@ -70,8 +74,86 @@ class GeneratorParameters(Task):
 
 class ParallelProdWorkflow(GeneratorParameters, law.LocalWorkflow, HTCondorWorkflow):
 
+    progress_interval = luigi.FloatParameter(default=30.0, significant=False, description="minimum "
+        "time in seconds between two progress updates sent to the scheduler, default: 30.0")
+    progress_step = luigi.FloatParameter(default=5.0, significant=False, description="minimum "
+        "progress in percent that triggers an update sent to the scheduler, default: 5.0")
+    cms_log_file = luigi.Parameter(default="", significant=False, description="file to which the "
+        "cmsRun output is written, '{branch}' is replaced by the branch number, default: empty")
+    cms_log_echo = luigi.BoolParameter(default=True, significant=False, description="print the "
+        "cmsRun output, default: True")
+    total_events = luigi.IntParameter(default=0, significant=False, description="when positive, "
+        "the total number of events to produce, n_events and n_tasks are then derived from "
+        "target_runtime and event rates measured in previous branches, default: 0")
+    target_runtime = luigi.FloatParameter(default=2.0, significant=False, description="target "
+        "runtime of a branch in hours when total_events is set, default: 2.0")
+    n_threads = luigi.IntParameter(default=1, significant=False, description="number of threads "
+        "used by cmsRun, also sets the number of cpus requested per job, default: 1")
+    n_streams = luigi.IntParameter(default=0, significant=False, description="number of "
+        "concurrent events processed by cmsRun, 0 means n_threads, default: 0")
+    content_store = luigi.BoolParameter(default=False, significant=False, description="reuse "
+        "outputs with identical generator settings, cmsRun config and CMSSW release from the "
+        "content-addressed store, regardless of the version, and add new outputs to it, "
+        "default: False")
+
     previous_task = None
 
+    # task families whose event rates are considered when deriving n_events from total_events
+    sharding_families = ("sim.GSDTask", "sim.RecoTask", "sim.NtupTask", "sim.SimChainTask")
+
+    # significant gun parameters, which determine the event rate and the resources per event
+    gun_param_names = ("gun_type", "gun_min", "gun_max", "particle_ids", "delta_r", "n_particles",
+        "exact_shoot", "random_shoot")
+
+    @classmethod
+    def modify_param_values(cls, params):
+        params = super(ParallelProdWorkflow, cls).modify_param_values(params)
+        if params.get("total_events", 0) > 0:
+            params.update(cls.resolve_sharding(params))
+        return params
+
+    @classmethod
+    def resolve_sharding(cls, params):
+        """
+        Derives the number of events per branch and the number of branches from the parameters
+        *total_events* and *target_runtime* in *params*, using the smallest average event rate of
+        recent branches with the same generator settings among :py:attr:`sharding_families`. The
+        result is stored in ``$HGC_DATA/sharding`` and reused for the same settings, so that
+        outputs and seeds do not change when the measured rates change.
+        """
+        rate_key = {name: params[name] for name in cls.gun_param_names}
+        rate_key["n_threads"] = params["n_threads"]
+        sharding_key = dict(rate_key, version=params["version"], seed=params["seed"],
+            total_events=params["total_events"], target_runtime=params["target_runtime"])
+        sharding_file = law.LocalFileTarget(os.path.join(os.path.expandvars("$HGC_DATA"),
+            "sharding", law.util.create_hash(json.dumps(sharding_key, sort_keys=True)) + ".json"))
+        if sharding_file.exists():
+            sharding = sharding_file.load(formatter="json")
+            return {"n_events": sharding["n_events"], "n_tasks": sharding["n_tasks"]}
+
+        # smallest average rate
+        rates = []
+        for family in cls.sharding_families:
+            records = ResourceHistory(family).lookup(rate_key, partial=True)
+            values = [r["events_per_second"] for r in records if r.get("events_per_second")]
+            if values:
+                rates.append(sum(values) / len(values))
+        if not rates:
+            raise Exception("no event rates measured for the requested generator settings yet, "
+                "run a few branches with explicit n_events first")
+        rate = min(rates) / (1. + params.get("resource_margin", 0.))
+
+        # maximum number of events per branch, then balance events over branches
+        max_events = max(1, int(rate * params["target_runtime"] * 3600))
+        n_tasks = int(math.ceil(float(params["total_events"]) / max_events))
+        n_events = int(math.ceil(float(params["total_events"]) / n_tasks))
+
+        sharding_file.parent.touch()
+        sharding_file.dump(dict(sharding_key, n_events=n_events, n_tasks=n_tasks,
+            events_per_second=rate), formatter="json", indent=4)
+
+        return {"n_events": n_events, "n_tasks": n_tasks}
+
     def create_branch_map(self):
         return {i: i for i in range(self.n_tasks)}
 
@@ -89,16 +171,137 @@ class ParallelProdWorkflow(GeneratorParameters, law.LocalWorkflow, HTCondorWorkf
             reqs[key] = cls.req(self, _prefer_cli=["version"])
         return reqs
 
+    def run_cms(self, cfg_file, args):
+        # run cmsRun using a helper that publishes the current progress to the scheduler
+        log_file = self.cms_log_file.format(branch=self.branch) if self.cms_log_file else None
+        return cms_run_and_publish(self, cfg_file, args, progress_interval=self.progress_interval,
+            progress_step=self.progress_step, log_file=log_file, echo=self.cms_log_echo,
+            n_threads=self.n_threads, n_streams=self.n_streams)
+
+    def htcondor_request_cpus(self):
+        return self.n_threads
+
+    def resource_history_values(self, processing_time):
+        if processing_time <= 0:
+            return {}
+        return {"events_per_second": self.n_events / processing_time}
+
+    def resource_history_key(self):
+        key = {name: getattr(self, name) for name in self.gun_param_names}
+        key.update(n_events=self.n_events, n_threads=self.n_threads)
+        return key
+
+
+class CMSProdWorkflow(ParallelProdWorkflow):
+    """
+    Workflow of a cmsRun step whose outputs are produced by :py:meth:`produce`, which must be
+    implemented by subclasses, or reused from the content-addressed store.
+    """
+
+    # cmsRun config file that defines the content of outputs, also used for the content hash
+    cms_config = None
+
+    def run(self):
+        if not self.reuse_from_content_store():
+            self.produce()
+            self.add_to_content_store()
+
+    @abc.abstractmethod
+    def produce(self):
+        # produces the outputs of the branch
+        return
+
+    def content_hash_parts(self):
+        """
+        Returns a dictionary with all information that determines the content of the outputs of
+        this branch: the generator parameters, the contents of the :py:attr:`cms_config` file, the
+        CMSSW release and the content hash of the previous task, if any. Neither the version nor
+        the store location are included.
+        """
+        names = set(GeneratorParameters.get_param_names()) - set(Task.get_param_names())
+        names.discard("n_tasks")
+        params = {name: getattr(self, name) for name in names}
+        params["branch"] = self.branch
+
+        with open(os.path.expandvars(self.cms_config), "r") as f:
+            config = f.read()
+
+        parts = {
+            "task_family": self.task_family,
+            "params": params,
+            "config": law.util.create_hash(config, l=32),
+            "cmssw_version": os.getenv("CMSSW_VERSION"),
+            "scram_arch": os.getenv("SCRAM_ARCH"),
+        }
+
+        if self.previous_task:
+            parts["previous"] = self.requires()[self.previous_task[0]].content_hash()
+
+        return parts
+
+    def content_hash(self):
+        return law.util.create_hash(json.dumps(self.content_hash_parts(), sort_keys=True), l=32)
+
+    def content_store_dir(self):
+        # the content-addressed store lives in the same store as the outputs so that files can
+        # be hardlinked between both
+        store = os.path.expandvars(os.path.expanduser(
+            self.default_eos_store if self.eos else self.default_store))
+        h = self.content_hash()
+        return law.LocalDirectoryTarget(os.path.join(store, "cas", self.task_family, h[:2], h))
+
+    def reuse_from_content_store(self):
+        """
+        Links outputs with the same content hash from the content-addressed store to the outputs of
+        this branch and returns *True*, or returns *False* when the store is disabled or does not
+        contain all outputs yet.
+        """
+        if not self.content_store:
+            return False
+
+        cas_dir = self.content_store_dir()
+        targets = flatten_targets(self.output())
+        sources = [cas_dir.child(t.basename, type="f") for t in targets]
+        if not all(src.exists() for src in sources):
+            return False
+
+        for src, target in zip(sources, targets):
+            target.parent.touch()
+            link_or_copy(src.path, target.path)
+        self.publish_message("reused outputs from content store {}".format(cas_dir.path))
+
+        return True
+
+    def add_to_content_store(self):
+        """
+        Links the outputs of this branch into the content-addressed store when it is enabled.
+        """
+        if not self.content_store:
+            return
+
+        cas_dir = self.content_store_dir()
+        cas_dir.touch()
+        for target in flatten_targets(self.output()):
+            dst = cas_dir.child(target.basename, type="f")
+            if not dst.exists():
+                link_or_copy(target.path, dst.path)
+
+        # store what the hash was built from for bookkeeping
+        info = cas_dir.child("content.json", type="f")
+        if not info.exists():
+            info.dump(self.content_hash_parts(), formatter="json", indent=4, sort_keys=True)
+
 
-class GSDTask(ParallelProdWorkflow):
+class GSDTask(CMSProdWorkflow):
+
+    cms_config = "$HGC_BASE/hgc/files/gsd_cfg.py"
 
     def output(self):
         return self.local_target("gsd_{}_n{}.root".format(self.branch, self.n_events))
 
-    @law.decorator.localize()
-    def run(self):
-        # run the command using a helper that publishes the current progress to the scheduler
-        cms_run_and_publish(self, "$HGC_BASE/hgc/files/gsd_cfg.py", dict(
+    @stage_outputs
+    def produce(self):
+        self.run_cms(self.cms_config, dict(
             outputFile=self.output().path,
             maxEvents=self.n_events,
             gunType=self.gun_type,
@@ -113,41 +316,189 @@ class GSDTask(ParallelProdWorkflow):
         ))
 
 
-class RecoTask(ParallelProdWorkflow):
+class RecoTask(CMSProdWorkflow):
 
     previous_task = ("gsd", GSDTask)
 
+    cms_config = "$HGC_BASE/hgc/files/reco_cfg.py"
+
     def output(self):
         return {
             "reco": self.local_target("reco_{}_n{}.root".format(self.branch, self.n_events)),
             "dqm": self.local_target("dqm_{}_n{}.root".format(self.branch, self.n_events)),
         }
 
-    @law.decorator.localize()
-    def run(self):
+    @stage_outputs
+    def produce(self):
         inp = self.input()
         outp = self.output()
 
-        cms_run_and_publish(self, "$HGC_BASE/hgc/files/reco_cfg.py", dict(
+        self.run_cms(self.cms_config, dict(
             inputFiles=[inp["gsd"].path],
             outputFile=outp["reco"].path,
             outputFileDQM=outp["dqm"].path,
         ))
 
 
-class NtupTask(ParallelProdWorkflow):
+class NtupTask(CMSProdWorkflow):
 
     previous_task = ("reco", RecoTask)
 
+    cms_config = "$HGC_BASE/hgc/files/ntup_cfg.py"
+
     def output(self):
         return self.local_target("ntup_{}_n{}.root".format(self.branch, self.n_events))
 
-    @law.decorator.localize()
-    def run(self):
+    @stage_outputs
+    def produce(self):
         inp = self.input()
         outp = self.output()
 
-        cms_run_and_publish(self, "$HGC_BASE/hgc/files/ntup_cfg.py", dict(
+        self.run_cms(self.cms_config, dict(
             inputFiles=[inp["reco"]["reco"].path],
             outputFile=outp.path,
         ))
+
+
+class NtupCacheTask(ParallelProdWorkflow):
+    """
+    Converts NTUP outputs once into a columnar cache that can be memory-mapped for fast, repeated
+    access via :py:class:`hgc.ntuple.NtupleCache`.
+    """
+
+    previous_task = ("ntup", NtupTask)
+
+    def output(self):
+        return self.local_target("ntup_{}_n{}".format(self.branch, self.n_events), dir=True)
+
+    def run(self):
+        from hgc.ntuple import create_ntuple_cache
+
+        outp = self.output()
+        outp.parent.touch()
+
+        # create the cache next to the output and rename it at the end
+        tmp = law.LocalDirectoryTarget(outp.path + ".tmp")
+        if tmp.exists():
+            tmp.remove()
+
+        with self.input()["ntup"].localize("r") as inp:
+            with self.publish_step("creating columnar cache ...", runtime=True):
+                meta = create_ntuple_cache(inp.path, tmp.path)
+            if meta["skipped"]:
+                self.publish_message("skipped nested branches: {}".format(
+                    ",".join(meta["skipped"])))
+
+        os.rename(tmp.path, outp.path)
+
+
+class SimChainTask(ParallelProdWorkflow):
+    """
+    Fused workflow that runs the GSD, RECO and NTUP steps back-to-back in the local scratch
+    directory of a job and only stores the data tiers given in *keep_tiers*. Stored outputs are
+    identical to those of :py:class:`GSDTask`, :py:class:`RecoTask` and :py:class:`NtupTask`, so
+    these tasks are considered complete afterwards. Existing intermediate outputs are reused.
+    """
+
+    keep_tiers = law.CSVParameter(default=("ntup",), description="data tiers to store, choices: "
+        "gsd, reco, ntup, default: ntup")
+
+    output_collection_cls = law.FileCollection
+
+    tiers = ("gsd", "reco", "ntup")
+
+    def __init__(self, *args, **kwargs):
+        super(SimChainTask, self).__init__(*args, **kwargs)
+
+        if not self.keep_tiers:
+            raise ValueError("at least one data tier must be stored")
+        unknown = set(self.keep_tiers) - set(self.tiers)
+        if unknown:
+            raise ValueError("unknown data tiers {}, choices are {}".format(
+                ",".join(sorted(unknown)), ",".join(self.tiers)))
+
+    def tier_tasks(self):
+        return {
+            "gsd": GSDTask.req(self, _prefer_cli=["version"]),
+            "reco": RecoTask.req(self, _prefer_cli=["version"]),
+            "ntup": NtupTask.req(self, _prefer_cli=["version"]),
+        }
+
+    def output(self):
+        tasks = self.tier_tasks()
+        return {tier: tasks[tier].output() for tier in self.tiers if tier in self.keep_tiers}
+
+    def run(self):
+        tasks = self.tier_tasks()
+        outp = self.output()
+
+        # local scratch directory
+        tmp_dir = law.LocalDirectoryTarget(is_tmp=True)
+        tmp_dir.touch()
+        tmp = {
+            "gsd": tmp_dir.child("gsd_{}_n{}.root".format(self.branch, self.n_events), type="f"),
+            "reco": tmp_dir.child("reco_{}_n{}.root".format(self.branch, self.n_events), type="f"),
+            "dqm": tmp_dir.child("dqm_{}_n{}.root".format(self.branch, self.n_events), type="f"),
+            "ntup": tmp_dir.child("ntup_{}_n{}.root".format(self.branch, self.n_events), type="f"),
+        }
+
+        # the chain ends with the last stored tier
+        last = max(self.tiers.index(tier) for tier in self.keep_tiers)
+
+        # resume after the latest step whose output exists, provided that the stored outputs of all
+        # earlier steps exist as well
+        start = 0
+        for i in range(last, -1, -1):
+            if all(tasks[tier].complete() for tier in self.tiers[:i + 1]
+                    if tier in outp or tier == self.tiers[i]):
+                start = i + 1
+                break
+        if start > last:
+            return
+        elif start == 2:
+            stage_file(tasks["reco"].output()["reco"], tmp["reco"], keep=True)
+        elif start == 1:
+            stage_file(tasks["gsd"].output(), tmp["gsd"], keep=True)
+
+        if start <= 0:
+            with self.publish_step("running GSD step ...", runtime=True):
+                self.run_cms(GSDTask.cms_config, dict(
+                    outputFile=tmp["gsd"].path,
+                    maxEvents=self.n_events,
+                    gunType=self.gun_type,
+                    gunMin=self.gun_min,
+                    gunMax=self.gun_max,
+                    particleIds=self.particle_ids,
+                    deltaR=self.delta_r,
+                    nParticles=self.n_particles,
+                    exactShoot=self.exact_shoot,
+                    randomShoot=self.random_shoot,
+                    seed=self.seed + self.branch,
+                ))
+            if "gsd" in outp:
+                stage_file(tmp["gsd"], outp["gsd"], keep=True)
+            if last == 0:
+                return
+
+        if start <= 1:
+            with self.publish_step("running RECO step ...", runtime=True):
+                self.run_cms(RecoTask.cms_config, dict(
+                    inputFiles=[tmp["gsd"].path],
+                    outputFile=tmp["reco"].path,
+                    outputFileDQM=tmp["dqm"].path,
+                ))
+            tmp["gsd"].remove()
+            if "reco" in outp:
+                stage_file(tmp["reco"], outp["reco"]["reco"], keep=True)
+                stage_file(tmp["dqm"], outp["reco"]["dqm"])
+            if last == 1:
+                return
+
+        with self.publish_step("running NTUP step ...", runtime=True):
+            self.run_cms(NtupTask.cms_config, dict(
+                inputFiles=[tmp["reco"].path],
+                outputFile=tmp["ntup"].path,
+            ))
+        tmp["reco"].remove()
+        if "ntup" in outp:
+            stage_file(tmp["ntup"], outp["ntup"])
@@ -14,6 +14,7 @@ import law
 import luigi
 
 from hgc.tasks.base import Task
+from hgc.util import accounted_popen
 
 
 luigi.namespace("sw", scope=__name__)
@@ -41,7 +42,8 @@ class CompileCMSSW(Task, law.RunOnceTask):
         cwd = os.path.expandvars("$CMSSW_BASE/src")
 
         # run the command
-        code = law.util.interruptable_popen(cmd, cwd=cwd, shell=True, executable="/bin/bash")[0]
+        code = accounted_popen(cmd, label="compile cmssw", cwd=cwd, shell=True,
+            executable="/bin/bash")[0]
         if code != 0:
             raise Exception("CMSSW compilation failed")
 
@@ -64,7 +66,8 @@ class CompileConverter(Task):
         cwd = self.output().parent.path
 
         # run the command
-        code = law.util.interruptable_popen(cmd, cwd=cwd, shell=True, executable="/bin/bash")[0]
+        code = accounted_popen(cmd, label="compile converter", cwd=cwd, shell=True,
+            executable="/bin/bash")[0]
         if code != 0:
             raise Exception("converter compilation failed")
 
@@ -107,7 +110,7 @@ class CompileDeepJetCore(Task):
         cmd += " && make -j {}".format(self.n_cores)
 
         # run the command
-        code = law.util.interruptable_popen(cmd, env=self.get_setup_env(), shell=True,
-            executable="/bin/bash")[0]
+        code = accounted_popen(cmd, label="compile deepjetcore", env=self.get_setup_env(),
+            shell=True, executable="/bin/bash")[0]
         if code != 0:
             raise Exception("DeepJetCore compilation failed")
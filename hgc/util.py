@@ -5,21 +5,167 @@ Helpful utilities.
 """
 
 
-__all__ = ["cms_run", "parse_cms_run_event", "cms_run_and_publish", "log_runtime", "hadd_task"]
+__all__ = [
+    "start_resource_accounting", "stop_resource_accounting", "accounted_popen", "listdir_cached",
+    "path_exists_cached", "clear_listdir_cache", "cms_run", "parse_cms_run_event",
+    "CMSRunLogStream", "cms_run_and_publish", "log_runtime", "hadd", "uproot_merge",
+    "merge_backends", "split_root_file", "fetch_input", "link_or_copy", "stage_file",
+    "staged_targets", "hadd_task", "plan_cascade_merge",
+]
 
 
 import os
+import sys
 import re
+import math
+import stat
 import time
+import json
+import shutil
+import functools
+import collections
 import contextlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import six
 import law
 
+from hgc.resources import wrap_cmd
+
+
+# stack of lists that collect the resources used by commands run through accounted_popen
+_accounting_stack = []
+
+
+def start_resource_accounting():
+    """
+    Starts collecting the resources used by commands run through :py:func:`accounted_popen` and
+    returns the list to which records are added until :py:func:`stop_resource_accounting` is
+    called with it.
+    """
+    records = []
+    _accounting_stack.append(records)
+    return records
+
+
+def stop_resource_accounting(records):
+    for i, _records in enumerate(_accounting_stack):
+        if _records is records:
+            del _accounting_stack[i]
+            break
+    return records
+
+
+def accounted_popen(cmd, label=None, yield_output=False, **kwargs):
+    """
+    Runs the shell command *cmd* like ``law.util.interruptable_popen``, or
+    ``law.util.readable_popen`` when *yield_output* is *True*, and measures its wall time, cpu
+    time, peak memory and block I/O with :py:func:`hgc.resources.main`. The resulting record,
+    tagged with *label*, is added to all lists of records started by
+    :py:func:`start_resource_accounting`. When the ``HGC_RESOURCE_LOG`` environment variable is
+    set, the record is also appended to the file it points to as a json line. *kwargs* are
+    forwarded to the popen function.
+    """
+    stats_file = law.LocalFileTarget(is_tmp="json")
+    wrapped_cmd = wrap_cmd(cmd, stats_file.path, label=label)
+
+    def collect():
+        if not stats_file.exists():
+            return
+        with open(stats_file.path, "r") as f:
+            record = json.load(f)
+        stats_file.remove()
+        for records in _accounting_stack:
+            records.append(record)
+        log_path = os.getenv("HGC_RESOURCE_LOG")
+        if log_path:
+            # a single small write in append mode does not interleave with concurrent writers
+            with open(os.path.expandvars(os.path.expanduser(log_path)), "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    if not yield_output:
+        try:
+            return law.util.interruptable_popen(wrapped_cmd, **kwargs)
+        finally:
+            collect()
+
+    def iter_output():
+        try:
+            for obj in law.util.readable_popen(wrapped_cmd, **kwargs):
+                yield obj
+        finally:
+            collect()
+
+    return iter_output()
+
+
+# cache of directory listings, mapping paths to a tuple (mtime of the directory, set of names)
+_listdir_cache = {}
+
+
+def listdir_cached(path):
+    """
+    Returns a set with the names of all elements in the directory *path*, or an empty set when
+    it does not exist. Listings are cached and reused as long as the modification time of the
+    directory is unchanged, so that listings are never outdated, also when files are written by
+    other processes. Listings of directories modified within the last second are not cached as
+    coarse timestamps of some file systems would not reflect subsequent changes. Missing
+    directories are never cached.
+    """
+    path = os.path.expandvars(os.path.expanduser(path))
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        _listdir_cache.pop(path, None)
+        return set()
+
+    cached = _listdir_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
 
-def cms_run(cfg_file, args, yield_output=False):
-    if isinstance(args, dict):
-        args = list(args.items())
+    try:
+        names = set(os.listdir(path))
+    except OSError:
+        _listdir_cache.pop(path, None)
+        return set()
+    if time.time() - mtime > 1:
+        _listdir_cache[path] = (mtime, names)
+    else:
+        _listdir_cache.pop(path, None)
+
+    return names
+
+
+def path_exists_cached(path):
+    """
+    Returns whether a file or directory at *path* exists using :py:func:`listdir_cached` on its
+    parent directory.
+    """
+    path = os.path.expandvars(os.path.expanduser(path)).rstrip(os.sep)
+    dirname, basename = os.path.split(path)
+    return basename in listdir_cached(dirname)
+
+
+def clear_listdir_cache(path=None):
+    """
+    Removes the cached listing of the directory *path*, or all cached listings when *None*.
+    """
+    if path is None:
+        _listdir_cache.clear()
+    else:
+        _listdir_cache.pop(os.path.expandvars(os.path.expanduser(path)), None)
+
+
+def cms_run(cfg_file, args, yield_output=False, n_threads=None, n_streams=None):
+    # copy to not alter the arguments of the caller, e.g. when retrying
+    args = list(args.items()) if isinstance(args, dict) else list(args)
+
+    # multi-threading options, translated into process.options by all configs
+    if n_threads is not None:
+        args.append(("nThreads", n_threads))
+    if n_streams is not None:
+        args.append(("nStreams", n_streams))
 
     def cms_run_arg(key, value):
         return " ".join("{}={}".format(key, v) for v in law.util.make_list(value))
@@ -28,36 +174,194 @@ def cms_run(cfg_file, args, yield_output=False):
     args_str = " ".join(cms_run_arg(*tpl) for tpl in args)
     cmd = "cmsRun {} {}".format(cfg_file, args_str)
 
-    fn = law.util.interruptable_popen if not yield_output else law.util.readable_popen
-    return fn(cmd, shell=True, executable="/bin/bash")
+    label = "cmsRun " + os.path.basename(cfg_file)
+    return accounted_popen(cmd, label=label, yield_output=yield_output, shell=True,
+        executable="/bin/bash")
 
 
 def parse_cms_run_event(line):
-    if not isinstance(line, str):
+    if not isinstance(line, six.string_types):
+        return None
+
+    # fast path: avoid the regex for the vast majority of lines
+    line = line.lstrip()
+    if not line.startswith(CMSRunLogStream.event_prefix):
         return None
 
-    match = re.match(r"^Begin\sprocessing\sthe\s(\d+)\w{2,2}\srecord\..+$", line.strip())
+    match = CMSRunLogStream.event_re.match(line.rstrip())
     if not match:
         return None
 
     return int(match.group(1))
 
 
-def cms_run_and_publish(task, cfg_file, args):
+class CMSRunLogStream(object):
+    """
+    Consumer of cmsRun output lines that parses the event progress, coalesces progress updates
+    that are sent to the scheduler of *task* and writes log lines in buffered chunks. Progress is
+    published when it advanced by at least *progress_step* percent or when *progress_interval*
+    seconds passed since the last update. Log lines are echoed to stdout when *echo* is *True* and
+    appended to *log_file* when set. The last *tail_size* lines are always kept in :py:attr:`tail`
+    for error reporting.
+    """
+
+    event_prefix = "Begin processing the "
+    event_re = re.compile(r"^Begin\sprocessing\sthe\s(\d+)\w{2,2}\srecord\..+$")
+
+    def __init__(self, task=None, n_events=None, progress_interval=30., progress_step=5.,
+            log_file=None, echo=True, buffer_size=200, tail_size=50):
+        super(CMSRunLogStream, self).__init__()
+
+        self.task = task
+        self.n_events = n_events if n_events is not None else getattr(task, "n_events", None)
+        self.progress_interval = progress_interval
+        self.progress_step = progress_step
+        self.log_file = log_file
+        self.echo = echo
+        self.buffer_size = buffer_size
+
+        self.tail = collections.deque(maxlen=tail_size)
+        self.n_lines = 0
+        self.last_event = 0
+        self.n_published = 0
+
+        self._buffer = []
+        self._log_file = None
+        self._t0 = None
+        self._t_first_event = None
+        self._t_last_event = None
+        self._last_publish_time = None
+        self._last_publish_perc = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        self._t0 = time.time()
+        if self.log_file:
+            path = os.path.expandvars(os.path.expanduser(self.log_file))
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self._log_file = open(path, "a")
+
+    def close(self):
+        self.flush()
+        if self._log_file:
+            self._log_file.close()
+            self._log_file = None
+
+    def feed(self, line):
+        self.n_lines += 1
+        self.tail.append(line)
+
+        if self.echo or self._log_file:
+            self._buffer.append(line)
+            if len(self._buffer) >= self.buffer_size:
+                self.flush()
+
+        n_event = parse_cms_run_event(line)
+        if n_event:
+            now = time.time()
+            if self._t_first_event is None:
+                self._t_first_event = now
+            self._t_last_event = now
+            self.last_event = n_event
+            self._publish_progress(n_event, now)
+
+        return n_event
+
+    def flush(self):
+        if not self._buffer:
+            return
+
+        chunk = "\n".join(self._buffer) + "\n"
+        del self._buffer[:]
+
+        if self.echo:
+            sys.stdout.write(chunk)
+            sys.stdout.flush()
+        if self._log_file:
+            self._log_file.write(chunk)
+            self._log_file.flush()
+
+    def _publish_progress(self, n_event, now, force=False):
+        if self.task is None:
+            return
+
+        perc = 100. * n_event / self.n_events if self.n_events else None
+
+        if not force and self._last_publish_time is not None:
+            dt = now - self._last_publish_time
+            dp = perc - self._last_publish_perc if perc is not None else 0.
+            if dt < self.progress_interval and dp < self.progress_step:
+                return
+
+        if perc is not None:
+            self.task.publish_progress(perc)
+        self.task._publish_message("processing event {}".format(n_event))
+
+        self._last_publish_time = now
+        self._last_publish_perc = perc
+        self.n_published += 1
+
+    def rate(self):
+        """
+        Returns the event processing rate in events per second, measured from the first to the last
+        processed event, or *None* when less than two events were seen.
+        """
+        if self.last_event < 2 or self._t_last_event == self._t_first_event:
+            return None
+        return (self.last_event - 1) / (self._t_last_event - self._t_first_event)
+
+    def summary(self):
+        runtime = time.time() - self._t0 if self._t0 is not None else 0.
+        msg = "processed {} events in {}".format(self.last_event,
+            law.util.human_time_diff(seconds=runtime))
+        rate = self.rate()
+        if rate is not None:
+            msg += " ({:.3f} events/s)".format(rate)
+        return msg
+
+    def finish(self):
+        # publish the final state unconditionally, then the summary
+        if self.last_event and self._last_publish_perc != 100.:
+            self._publish_progress(self.last_event, time.time(), force=True)
+
+        msg = self.summary()
+        self._buffer.append(msg)
+        self.flush()
+        if self.task is not None:
+            self.task._publish_message(msg)
+
+        return msg
+
+
+def cms_run_and_publish(task, cfg_file, args, progress_interval=30., progress_step=5.,
+        log_file=None, echo=True, n_threads=None, n_streams=None):
+    stream = CMSRunLogStream(task, progress_interval=progress_interval,
+        progress_step=progress_step, log_file=log_file, echo=echo)
+
     # run the command, parse output as it comes
-    for obj in cms_run(cfg_file, args, yield_output=True):
-        if isinstance(obj, six.string_types):
-            print(obj)
-
-            # try to parse the event number
-            n_event = parse_cms_run_event(obj)
-            if n_event:
-                task.publish_progress(100. * n_event / task.n_events)
-                task._publish_message("processing event {}".format(n_event))
-        else:
-            # obj is the popen object
-            if obj.returncode != 0:
-                raise Exception("cmsRun failed failed")
+    with stream:
+        for obj in cms_run(cfg_file, args, yield_output=True, n_threads=n_threads,
+                n_streams=n_streams):
+            if isinstance(obj, six.string_types):
+                stream.feed(obj)
+            elif obj.returncode != 0:
+                # obj is the popen object, show the last lines when not echoing for debugging
+                stream.flush()
+                if not echo:
+                    sys.stdout.write("\n".join(stream.tail) + "\n")
+                raise Exception("cmsRun failed with exit code {}".format(obj.returncode))
+
+        stream.finish()
+
+    return stream
 
 
 @contextlib.contextmanager
@@ -81,32 +385,434 @@ def log_runtime(log_fn=None, log_prefix=""):
         log_fn(msg)
 
 
-def hadd_task(task, inputs, output):
+def hadd(output_path, input_paths, cwd=None):
+    cmd = "hadd -n 0 -d {} {} {}".format(cwd or os.path.dirname(output_path), output_path,
+        " ".join(input_paths))
+    code = accounted_popen(cmd, label="hadd", shell=True, executable="/bin/bash", cwd=cwd)[0]
+    if code != 0:
+        raise Exception("hadd failed")
+
+
+def _read_tree_chunk(path, treename, entry_start, entry_stop):
+    # flat branches are returned as numpy arrays, singly jagged ones as awkward arrays
+    import uproot
+    import awkward as ak
+
+    with uproot.open(path) as f:
+        arrays = f[treename].arrays(library="ak", entry_start=entry_start, entry_stop=entry_stop)
+
+    chunk = collections.OrderedDict()
+    for name in arrays.fields:
+        arr = arrays[name]
+        if arr.ndim == 1:
+            chunk[name] = ak.to_numpy(arr)
+        elif arr.ndim == 2:
+            chunk[name] = arr
+        else:
+            raise Exception("uproot merging only supports flat and singly jagged branches, but "
+                "branch {} of tree {} is nested {} times".format(name, treename, arr.ndim - 1))
+    return chunk
+
+
+def _iter_tree_chunks(ranges, n_workers=0):
+    # yields chunks in order, reading at most 2 * n_workers chunks ahead to bound the memory
+    if n_workers <= 1:
+        for r in ranges:
+            yield _read_tree_chunk(*r)
+        return
+
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        pending = collections.deque()
+        for r in ranges:
+            pending.append(pool.apply_async(_read_tree_chunk, r))
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def uproot_merge(output_path, input_paths, cwd=None, treenames=None, step_size=100000,
+        n_workers=0, compression_level=1):
+    """
+    Merges TTrees in *input_paths* into *output_path* without ROOT by concatenating their columns
+    in chunks of *step_size* entries using uproot (version 4 or newer) and awkward. Branches must be
+    flat or singly jagged, e.g. ``std::vector<float>``, which are written as variable-size arrays
+    with a counter branch, named after the counter in the input or ``"n" + name``. Deeper nested
+    branches such as ``std::vector<std::vector<int>>`` in ntuples are not supported, so such files
+    must be merged with :py:func:`hadd`. When *treenames* is not set, all trees of the first input
+    file are merged, other objects are not copied. Chunks are read and decompressed in *n_workers*
+    processes when larger than one. Relative paths are resolved with respect to *cwd*.
+    """
+    import numpy as np
+    import uproot
+
+    def abspath(path):
+        return os.path.join(cwd, path) if cwd else path
+
+    input_paths = [abspath(path) for path in input_paths]
+    output_path = abspath(output_path)
+
+    # determine the trees to merge, their counter branches and the entries to read from each file
+    ranges = collections.OrderedDict()
+    counters = {}
+    with uproot.open(input_paths[0]) as f:
+        if treenames is None:
+            treenames = [
+                key.rsplit(";", 1)[0] for key, cls in f.classnames().items()
+                if cls == "TTree"
+            ]
+        treenames = sorted(set(law.util.make_list(treenames)))
+        for treename in treenames:
+            counters[treename] = {
+                name: branch.count_branch.name for name, branch in f[treename].items()
+                if branch.count_branch is not None
+            }
+    for treename in treenames:
+        ranges[treename] = []
+        for path in input_paths:
+            with uproot.open(path) as f:
+                n_entries = f[treename].num_entries
+            for start in range(0, n_entries, step_size):
+                ranges[treename].append((path, treename, start, min(start + step_size, n_entries)))
+
+    compression = uproot.ZLIB(compression_level) if compression_level else None
+    with uproot.recreate(output_path, compression=compression) as f:
+        for treename in treenames:
+            tree_counters = counters[treename]
+            counter_names = set(tree_counters.values())
+            for chunk in _iter_tree_chunks(ranges[treename], n_workers=n_workers):
+                # counters are written along with their jagged branches
+                chunk = collections.OrderedDict(
+                    (name, arr) for name, arr in chunk.items() if name not in counter_names
+                )
+
+                if treename not in f:
+                    types = {
+                        name: (arr.dtype if isinstance(arr, np.ndarray) else arr.type.content)
+                        for name, arr in chunk.items()
+                    }
+                    f.mktree(treename, types,
+                        counter_name=lambda name: tree_counters.get(name, "n" + name))
+                f[treename].extend(chunk)
+
+
+merge_backends = {
+    "hadd": hadd,
+    "uproot": uproot_merge,
+}
+
+
+def split_root_file(input_path, output_paths):
+    """
+    Splits all trees in the ROOT file *input_path*, including those in subdirectories, into
+    ``len(output_paths)`` consecutive entry ranges of similar size that are written to
+    *output_paths*. Other objects are not copied. Existing output files are kept and new ones are
+    created under a temporary name first, so that an interrupted split can be resumed.
+    """
+    import ROOT
+    ROOT.gROOT.SetBatch(True)
+
+    n_outputs = len(output_paths)
+    input_file = ROOT.TFile.Open(input_path)
+    try:
+        # find all trees
+        tree_paths = []
+
+        def find_trees(directory, prefix):
+            for name in sorted(set(key.GetName() for key in directory.GetListOfKeys())):
+                cls = ROOT.TClass.GetClass(directory.GetKey(name).GetClassName())
+                if cls.InheritsFrom("TTree"):
+                    tree_paths.append(prefix + name)
+                elif cls.InheritsFrom("TDirectory"):
+                    find_trees(directory.Get(name), prefix + name + "/")
+
+        find_trees(input_file, "")
+        if not tree_paths:
+            raise Exception("no trees found in {}".format(input_path))
+
+        for i, output_path in enumerate(output_paths):
+            if os.path.exists(output_path):
+                continue
+
+            tmp_path = output_path + ".part.root"
+            output_file = ROOT.TFile(tmp_path, "RECREATE")
+            try:
+                for tree_path in tree_paths:
+                    tree = input_file.Get(tree_path)
+                    n_entries = int(tree.GetEntries())
+                    start = i * n_entries // n_outputs
+                    stop = (i + 1) * n_entries // n_outputs
+
+                    # create subdirectories
+                    output_dir = output_file
+                    for name in tree_path.split("/")[:-1]:
+                        output_dir = output_dir.GetDirectory(name) or output_dir.mkdir(name)
+                    output_dir.cd()
+
+                    output_tree = tree.CopyTree("", "", stop - start, start)
+                    output_tree.Write()
+            finally:
+                output_file.Close()
+
+            os.rename(tmp_path, output_path)
+    finally:
+        input_file.Close()
+
+
+def fetch_input(inp, fetch_dir, link=True):
+    """
+    Fetches an input target *inp* into the local directory target *fetch_dir* and returns the path
+    of the fetched file. Files that already exist in *fetch_dir*, e.g. from a previous attempt, are
+    reused. When *link* is *True*, local files on the same device as *fetch_dir* are hardlinked
+    rather than copied, all other files are copied to a temporary file first which is renamed once
+    the copy succeeded.
+    """
+    dst = fetch_dir.child(inp.unique_basename, type="f")
+    if dst.exists():
+        return dst.path
+
+    if link and isinstance(inp, law.LocalFileTarget):
+        src = os.path.expandvars(os.path.expanduser(inp.path))
+        if os.stat(src).st_dev == os.stat(fetch_dir.path).st_dev:
+            try:
+                os.link(src, dst.path)
+                return dst.path
+            except OSError:
+                pass
+
+    tmp = fetch_dir.child(inp.unique_basename + ".part", type="f")
+    inp.copy_to_local(tmp, cache=False)
+    os.rename(tmp.path, dst.path)
+
+    return dst.path
+
+
+def link_or_copy(src, dst, link=True):
+    """
+    Hardlinks the file *src* to *dst*, or copies it when linking is not possible, e.g. across
+    devices, or when *link* is *False*. The file is created under a temporary name first and
+    renamed at the end, so that *dst* never exists in an incomplete state.
+    """
+    src = os.path.expandvars(os.path.expanduser(src))
+    dst = os.path.expandvars(os.path.expanduser(dst))
+    tmp = "{}.{}.part".format(dst, os.getpid())
+    try:
+        if not link:
+            raise OSError("linking disabled")
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.rename(tmp, dst)
+
+
+def stage_file(src, target, keep=False):
+    """
+    Stages the local file *src*, given as a path or local file target, to the file *target* and
+    returns the target. When *target* is local and on the same device, *src* is renamed, or
+    hardlinked when *keep* is *True*. Otherwise, it is copied to a temporary file next to *target*
+    first which is renamed at the end, so that *target* never exists in an incomplete state.
+    Non-local targets are copied via ``copy_from_local``. Unless *keep* is *True*, *src* is removed.
+    As the permissions of local targets are changed afterwards, *src* is only renamed or linked
+    when this does not alter the permissions of other paths of the same file, i.e., a *src* that
+    is itself a hardlink of another file is copied instead.
+    """
+    src = src.path if isinstance(src, law.LocalFileTarget) else src
+    src = os.path.expandvars(os.path.expanduser(src))
+
+    if not isinstance(target, law.LocalFileTarget):
+        target.copy_from_local(src)
+        if not keep:
+            os.remove(src)
+        return target
+
+    # the permissions that copy_from_local would set
+    perm = None
+    if law.config.has_option("local_fs", "default_file_perm"):
+        perm = law.config.getint("local_fs", "default_file_perm") or None
+
+    target.parent.touch()
+    dst = os.path.expandvars(os.path.expanduser(target.path))
+    if keep:
+        # a hardlink shares its permissions with src, so copy when they would change
+        link = not perm or stat.S_IMODE(os.stat(src).st_mode) == perm
+        link_or_copy(src, dst, link=link)
+    elif os.stat(src).st_nlink > 1:
+        # src shares its file with other paths, e.g. a fetched input, which must not be altered
+        link_or_copy(src, dst, link=False)
+        os.remove(src)
+    else:
+        try:
+            os.rename(src, dst)
+        except OSError:
+            # different devices
+            link_or_copy(src, dst)
+            os.remove(src)
+
+    if perm:
+        os.chmod(dst, perm)
+
+    return target
+
+
+@contextlib.contextmanager
+def staged_targets(struct):
+    """
+    Context manager that yields a structure of temporary local file targets with the same layout as
+    the file targets in *struct*. When the context is left without an error, the temporary files
+    that were created are staged to their targets using :py:func:`stage_file`. If staging fails,
+    targets that were already staged are removed again.
+    """
     tmp_dir = law.LocalDirectoryTarget(is_tmp=True)
     tmp_dir.touch()
 
-    with task.publish_step("fetching inputs ...", runtime=True):
-        def fetch(inp):
-            inp.copy_to_local(tmp_dir.child(inp.unique_basename, type="f"), cache=False)
-            return inp.unique_basename
-
-        def callback(i):
-            task.publish_message("fetch file {} / {}".format(i + 1, len(inputs)))
-
-        bases = law.util.map_verbose(fetch, inputs, every=5, callback=callback)
-
-    with task.publish_step("merging ...", runtime=True):
-        with output.localize("w") as tmp_out:
-            if len(bases) == 1:
-                tmp_out.path = tmp_dir.child(bases[0]).path
-            else:
-                # merge using hadd
-                bases = " ".join(bases)
-                cmd = "hadd -n 0 -d {} {} {}".format(tmp_dir.path, tmp_out.path, bases)
-                code = law.util.interruptable_popen(cmd, shell=True, executable="/bin/bash",
-                    cwd=tmp_dir.path)[0]
-                if code != 0:
-                    raise Exception("hadd failed")
-
-                task.publish_message("merged file size: {:.2f} {}".format(
-                    *law.util.human_bytes(os.stat(tmp_out.path).st_size)))
+    counter = [0]
+
+    def tmp_target(target):
+        counter[0] += 1
+        return tmp_dir.child("{}_{}".format(counter[0], target.basename), type="f")
+
+    tmp_struct = law.util.map_struct(tmp_target, struct)
+
+    yield tmp_struct
+
+    staged = []
+    try:
+        for tmp, target in zip(law.util.flatten(tmp_struct), law.util.flatten(struct)):
+            if tmp.exists():
+                staged.append(stage_file(tmp, target))
+    except Exception:
+        for target in staged:
+            target.remove()
+        raise
+
+
+def hadd_task(task, inputs, output, fetch_threads=4, chunk_size=None, cache_dir=None,
+        backend="hadd", backend_kwargs=None):
+    """
+    Merges *inputs* into *output* using a *backend* defined in :py:attr:`merge_backends`, passing
+    *backend_kwargs* as additional arguments. Inputs are fetched concurrently with
+    *fetch_threads* threads. When *chunk_size* is set, fetched inputs are merged in chunks of that
+    size while remaining inputs are still being fetched, and the partial files are merged at the
+    end. When *cache_dir* is set, inputs are fetched into a subdirectory that is unique to
+    *output* and only removed after a successful merge, so that a failed merge can be resumed
+    without fetching all inputs again.
+    """
+    tmp_dir = law.LocalDirectoryTarget(is_tmp=True)
+    tmp_dir.touch()
+
+    if cache_dir:
+        output_hash = law.util.create_hash(output.path)
+        fetch_dir = law.LocalDirectoryTarget(os.path.join(
+            os.path.expandvars(os.path.expanduser(cache_dir)), "hadd_" + output_hash))
+    else:
+        fetch_dir = tmp_dir
+    fetch_dir.touch()
+
+    merge = functools.partial(merge_backends[backend], **(backend_kwargs or {}))
+
+    n_inputs = len(inputs)
+    paths = []
+    partial_paths = []
+
+    # a single input is staged as the output itself, so it must not be a hardlink of the input
+    fetch = functools.partial(fetch_input, fetch_dir=fetch_dir, link=n_inputs > 1)
+
+    with task.publish_step("fetching and merging {} inputs ...".format(n_inputs), runtime=True):
+        pool = ThreadPool(max(1, min(fetch_threads, n_inputs)))
+        try:
+            fetched = pool.imap(fetch, inputs)
+            for i, path in enumerate(fetched):
+                paths.append(path)
+                if (i + 1) % 5 == 0 or i + 1 == n_inputs:
+                    task.publish_message("fetched file {} / {}".format(i + 1, n_inputs))
+
+                # merge a chunk while the pool continues fetching
+                if chunk_size and len(paths) >= chunk_size and i + 1 < n_inputs:
+                    partial_path = tmp_dir.child("partial_{}.root".format(len(partial_paths)),
+                        type="f").path
+                    merge(partial_path, paths, cwd=tmp_dir.path)
+                    partial_paths.append(partial_path)
+                    task.publish_message("merged chunk {} with {} files".format(
+                        len(partial_paths), len(paths)))
+                    paths = []
+        finally:
+            pool.close()
+            pool.join()
+
+        paths = partial_paths + paths
+
+        if len(paths) == 1:
+            stage_file(paths[0], output)
+        else:
+            merged_path = tmp_dir.child("merged.root", type="f").path
+            merge(merged_path, paths, cwd=tmp_dir.path)
+
+            task.publish_message("merged file size: {:.2f} {}".format(
+                *law.util.human_bytes(os.stat(merged_path).st_size)))
+
+            stage_file(merged_path, output)
+
+    if cache_dir:
+        fetch_dir.remove()
+
+
+def plan_cascade_merge(sizes, target_size, max_merge_factor=10, n_trees=None):
+    """
+    Plans the cascade merging of leaves with *sizes*, e.g. in bytes or number of events, into
+    files of roughly *target_size*. Unless *n_trees* is given, the number of merged files is
+    chosen so that their sizes are closest to *target_size*. Leaves are distributed over trees in
+    decreasing order of size, each going to the tree with the smallest total size that still has
+    capacity, while the number of leaves per tree follows the even split of the cascade merge
+    (the first ``n_leaves % n_trees`` trees receive one more leaf). The merge factor is the
+    smallest one that yields the minimal tree depth allowed by *max_merge_factor*. A dictionary
+    is returned with the fields ``n_trees``, ``merge_factor``, ``depth``, ``order`` (the leaf
+    indices in the order in which they should be mapped to cascade leaves) and ``trees`` (a list
+    of dictionaries with the fields ``leaves`` and ``size``).
+    """
+    n_leaves = len(sizes)
+    if n_leaves == 0:
+        raise ValueError("cannot plan merging without leaves")
+    if max_merge_factor < 2:
+        raise ValueError("max_merge_factor must be at least 2, got {}".format(max_merge_factor))
+
+    # number of trees
+    if not n_trees:
+        n_trees = int(round(float(sum(sizes)) / target_size))
+    n_trees = min(max(n_trees, 1), n_leaves)
+
+    # capacities of trees
+    n_min, n_extra = divmod(n_leaves, n_trees)
+    capacities = n_extra * [n_min + 1] + (n_trees - n_extra) * [n_min]
+
+    # distribute leaves
+    trees = [{"leaves": [], "size": 0} for _ in range(n_trees)]
+    for leaf in sorted(range(n_leaves), key=lambda i: (-sizes[i], i)):
+        tree = min((t for t, c in enumerate(capacities) if len(trees[t]["leaves"]) < c),
+            key=lambda t: (trees[t]["size"], t))
+        trees[tree]["leaves"].append(leaf)
+        trees[tree]["size"] += sizes[leaf]
+    for tree in trees:
+        tree["leaves"].sort()
+
+    # minimal depth and the smallest merge factor that reaches it
+    n_max = capacities[0]
+    depth = 0
+    while max_merge_factor**depth < n_max:
+        depth += 1
+    merge_factor = max_merge_factor
+    if depth > 0:
+        merge_factor = max(2, int(math.ceil(n_max**(1. / depth))))
+        while merge_factor**depth < n_max:
+            merge_factor += 1
+
+    return {
+        "n_trees": n_trees,
+        "merge_factor": merge_factor,
+        "depth": depth,
+        "order": sum((tree["leaves"] for tree in trees), []),
+        "trees": trees,
+    }
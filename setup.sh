@@ -28,6 +28,128 @@ action() {
     # base directory
     export HGC_BASE="$( cd "$this_dir" && pwd )"
 
+
+    #
+    # helper functions
+    #
+
+    hgc_install_pip() {
+        pip install --ignore-installed --no-cache-dir --prefix "$HGC_SOFTWARE" "$@"
+    }
+    export -f hgc_install_pip
+
+    hgc_add_py() {
+        [ ! -z "$1" ] && export PYTHONPATH="$1:$PYTHONPATH"
+    }
+    export -f hgc_add_py
+
+    hgc_add_bin() {
+        [ ! -z "$1" ] && export PATH="$1:$PATH"
+    }
+    export -f hgc_add_bin
+
+    hgc_cmssw_base() {
+        if [ -z "$CMSSW_VERSION" ]; then
+            2>&1 echo "CMSSW_VERSION must be set for hgc_cmssw_path"
+            return "1"
+        fi
+        echo "$HGC_BASE/cmssw/$( whoami )/$CMSSW_VERSION"
+    }
+    export -f hgc_cmssw_base
+
+    # configs that depend on the run location, also applied to restored snapshots
+    hgc_setup_location() {
+        if [ "$HGC_ON_HTCONDOR" = "1" ] || [ "$HGC_ON_GRID" = "1" ]; then
+            export HGC_LOCAL_CACHE="$LAW_JOB_HOME/cache"
+            export HGC_LUIGI_WORKER_KEEP_ALIVE="False"
+            export HGC_LUIGI_WORKER_FORCE_MULTIPROCESSING="True"
+        else
+            export HGC_LOCAL_CACHE="$HGC_DATA/cache"
+            export HGC_LUIGI_WORKER_KEEP_ALIVE="False"
+            export HGC_LUIGI_WORKER_FORCE_MULTIPROCESSING="False"
+        fi
+
+        if [ -z "$HGC_SCHEDULER_HOST" ]; then
+            2>&1 echo "NOTE: HGC_SCHEDULER_HOST is not set, use '--local-scheduler' in your tasks!"
+            export HGC_SCHEDULER_HOST=""
+        fi
+        export HGC_SCHEDULER_PORT="80"
+
+        if [ "$HGC_ON_HTCONDOR" = "1" ] || [ "$HGC_ON_GRID" = "1" ]; then
+            # jobs neither need completion nor a fresh index, which is created by the interactive
+            # setup on the submitting machine, so only index when it is missing
+            [ ! -f "${LAW_INDEX_FILE:-$LAW_HOME/index}" ] && law index
+        else
+            # source law's bash completion scipt
+            source "$( law completion )" ""
+
+            # rerun the task indexing
+            law index --verbose
+        fi
+    }
+
+
+    #
+    # environment snapshot
+    #
+
+    # print everything that determines the environment created by the setup below
+    hgc_setup_inputs() {
+        cat "$HGC_BASE/setup.sh"
+        [ -f "$HGC_BASE/setup_user.sh" ] && cat "$HGC_BASE/setup_user.sh"
+        whoami
+        [[ "$( hostname )" = lxplus*.cern.ch ]] && echo "lxplus"
+        local name
+        for name in HGC_BASE HGC_GRID_USER HGC_DATA HGC_SOFTWARE HGC_STORE HGC_STORE_EOS_USER \
+                HGC_STORE_EOS HGC_CONDA_DIR HGC_CMSSW_VERSION PATH PYTHONPATH LD_LIBRARY_PATH \
+                GFAL_PLUGIN_DIR; do
+            eval "echo \"$name=\$$name\""
+        done
+    }
+
+    # checks that a snapshot exists and that the paths it depends on were not changed since
+    hgc_snapshot_valid() {
+        [ -f "$1" ] || return "1"
+        local line
+        local mtime
+        while read -r line; do
+            case "$line" in
+                "# check "*)
+                    line="${line#\# check }"
+                    mtime="$( stat -c %Y "${line#* }" 2> /dev/null || echo "-" )"
+                    [ "$mtime" = "${line%% *}" ] || return "1"
+                    ;;
+                "#"*)
+                    ;;
+                *)
+                    break
+                    ;;
+            esac
+        done < "$1"
+    }
+
+    # when enabled, restore the environment of a previous setup with identical inputs, or remember
+    # the current environment to store the changes of the full setup in a snapshot (functions
+    # defined by the full setup below, such as hgc_install_software, are not part of it)
+    local snapshot_file=""
+    local env_before_file=""
+    if [ "$HGC_ENV_SNAPSHOT" = "1" ]; then
+        local snapshot_hash="$( hgc_setup_inputs | md5sum | cut -d " " -f 1 )"
+        snapshot_file="${HGC_DATA:-$HGC_BASE/.data}/env_snapshots/$snapshot_hash.sh"
+        if hgc_snapshot_valid "$snapshot_file" && source "$snapshot_file" ""; then
+            hgc_setup_location
+            export HGC_SETUP="1"
+            return "0"
+        fi
+        env_before_file="$( mktemp )"
+        env -0 > "$env_before_file"
+    fi
+
+
+    #
+    # location and user defaults
+    #
+
     # check if we're on lxplus
     if [[ "$( hostname )" = lxplus*.cern.ch ]]; then
         export HGC_ON_LXPLUS="1"
@@ -60,35 +182,6 @@ action() {
     [ "$?" != "0" ] && gfal2_bindings_file=""
 
 
-    #
-    # helper functions
-    #
-
-    hgc_install_pip() {
-        pip install --ignore-installed --no-cache-dir --prefix "$HGC_SOFTWARE" "$@"
-    }
-    export -f hgc_install_pip
-
-    hgc_add_py() {
-        [ ! -z "$1" ] && export PYTHONPATH="$1:$PYTHONPATH"
-    }
-    export -f hgc_add_py
-
-    hgc_add_bin() {
-        [ ! -z "$1" ] && export PATH="$1:$PATH"
-    }
-    export -f hgc_add_bin
-
-    hgc_cmssw_base() {
-        if [ -z "$CMSSW_VERSION" ]; then
-            2>&1 echo "CMSSW_VERSION must be set for hgc_cmssw_path"
-            return "1"
-        fi
-        echo "$HGC_BASE/cmssw/$( whoami )/$CMSSW_VERSION"
-    }
-    export -f hgc_cmssw_base
-
-
     #
     # CMSSW setup
     # (hardcoded for the moment)
@@ -212,28 +305,19 @@ action() {
     export LAW_HOME="$HGC_BASE/.law"
     export LAW_CONFIG_FILE="$HGC_BASE/law.cfg"
 
-    # configs that depend on the run location
-    if [ "$HGC_ON_HTCONDOR" = "1" ] || [ "$HGC_ON_GRID" = "1" ]; then
-        export HGC_LOCAL_CACHE="$LAW_JOB_HOME/cache"
-        export HGC_LUIGI_WORKER_KEEP_ALIVE="False"
-        export HGC_LUIGI_WORKER_FORCE_MULTIPROCESSING="True"
-    else
-        export HGC_LOCAL_CACHE="$HGC_DATA/cache"
-        export HGC_LUIGI_WORKER_KEEP_ALIVE="False"
-        export HGC_LUIGI_WORKER_FORCE_MULTIPROCESSING="False"
+    # write the environment changes to the snapshot, which is only used as long as the CMSSW and
+    # software directories are not changed
+    if [ ! -z "$env_before_file" ]; then
+        local env_after_file="$( mktemp )"
+        env -0 > "$env_after_file"
+        python "$HGC_BASE/hgc/files/env_snapshot.py" "$env_before_file" "$env_after_file" \
+            "$snapshot_file" "$CMSSW_BASE" "$CMSSW_BASE/.SCRAM/$SCRAM_ARCH" "$HGC_SOFTWARE" \
+            "$HGC_SOFTWARE/lib/python2.7/site-packages" \
+            || 2>&1 echo "could not write the environment snapshot $snapshot_file"
+        rm -f "$env_before_file" "$env_after_file"
     fi
 
-    if [ -z "$HGC_SCHEDULER_HOST" ]; then
-        2>&1 echo "NOTE: HGC_SCHEDULER_HOST is not set, use '--local-scheduler' in your tasks!"
-        export HGC_SCHEDULER_HOST=""
-    fi
-    export HGC_SCHEDULER_PORT="80"
-
-    # source law's bash completion scipt
-    source "$( law completion )" ""
-
-    # rerun the task indexing
-    law index --verbose
+    hgc_setup_location
 
     # remember that the setup run
     export HGC_SETUP="1"